@@ -0,0 +1,216 @@
+#!/usr/bin/env python -tt
+"""
+Script to measure collection throughput against simulated devices (lib/Simulator.py).
+No network or real routers needed, every run spawns fake jumpservers on local ptys.
+"""
+
+import argparse
+import functools
+import logging
+import os
+import sys
+import time
+
+from lib import ConnectionManager, HostManager, LoopManager, WorkerManager, Simulator, TimeoutManager, utils
+
+__author__ = "Thomas Jongerius"
+__copyright__ = "Copyright 2016, Thomas Jongerius"
+__credits__ = ["Thomas Jongerius", "Alan Holt"]
+__license__ = "GPL"
+__version__ = "0.1"
+__maintainer__ = "Thomas Jongerius"
+__email__ = "thomasjongerius@yaworks.nl"
+__status__ = "Development"
+
+
+def option_parser():
+    """Option parser allows command line options to be parsed.
+    Requires the argparse module."""
+
+    parser = argparse.ArgumentParser(
+        description='''Script to measure collection throughput against simulated devices.''',
+        epilog='Created by ' + __author__ + ', version ' + __version__ + ' ' + __copyright__)
+    parser.add_argument("--debug", "-d", metavar='LEVEL', type=str, default="CRITICAL", dest='debug',
+                        help="Logging level [DEBUG, INFO, WARNING, ERROR, CRITICAL] (Default: CRITICAL)")
+    parser.add_argument("--devices", "-n", help="Number of simulated devices (Default: 50)",
+                        type=int, default=50, dest='devices')
+    parser.add_argument("--commands", "-c", help="Number of show commands per device (Default: 5)",
+                        type=int, default=5, dest='commands')
+    parser.add_argument("-w", "--workers", help="Number of parallel workers (Default: 1)",
+                        type=int, default=1, dest='workers')
+    parser.add_argument("--sessions", metavar='N', help="Drive N sessions from one thread with a poll loop, "
+                                                        "0 disables (Default: 0)",
+                        type=int, default=0, dest='sessions')
+    parser.add_argument("--paths", help="Number of jump paths, each with own simulated jumpserver (Default: 1)",
+                        type=int, default=1, dest='paths')
+    parser.add_argument("--max_sessions", help="Maximum sessions per jumpserver (Default: unlimited)",
+                        type=int, default=None, dest='max_sessions')
+    parser.add_argument("--pipeline", metavar='N', help="Send N commands at once (Default: 0)",
+                        type=int, default=0, dest='pipeline')
+    parser.add_argument("--large_output", help="Collect all commands in large output mode",
+                        dest='large_output', action='store_true')
+    parser.add_argument("--latency", help="Seconds before output of every command (Default: 0.01)",
+                        type=float, default=0.01, dest='latency')
+    parser.add_argument("--connect_latency", help="Seconds before login prompt of device (Default: 0.05)",
+                        type=float, default=0.05, dest='connect_latency')
+    parser.add_argument("--output_lines", help="Lines of output for show commands (Default: 100)",
+                        type=int, default=100, dest='output_lines')
+    parser.add_argument("--fail_rate", help="Chance of login being denied (Default: 0)",
+                        type=float, default=0.0, dest='fail_rate')
+    parser.add_argument("--hang_rate", help="Chance of device hanging after a command (Default: 0)",
+                        type=float, default=0.0, dest='hang_rate')
+    parser.add_argument("--timeout", help="Timeout of connections and commands (Default: 5)",
+                        type=int, default=5, dest='timeout')
+    parser.add_argument("--breaker_threshold", metavar='N', help="Consecutive failures before circuit breaker "
+                                                                 "opens, 0 disables (Default: 0)",
+                        type=int, default=0, dest='breaker_threshold')
+    parser.add_argument("--breaker_reset", metavar='SECONDS', help="Seconds before a probe connection is tried "
+                                                                   "behind an open circuit breaker (Default: 60)",
+                        type=int, default=60, dest='breaker_reset')
+    parser.add_argument("--timeout_history", metavar='FILE', help="Derive timeouts from latency history in FILE",
+                        type=str, default=None, dest='timeout_history')
+    parser.add_argument("-s", "--storage_dir", help="Store output on disk instead of memory",
+                        type=str, default=None, dest='storage_dir')
+    parser.add_argument("-j", "--json_output", help="Write report to JSON file",
+                        type=str, default=None, dest='output_json')
+
+    return parser.parse_args()
+
+
+def simulator_command(args):
+    """
+    Function to return connection command starting a simulated jumpserver.
+    """
+
+    simulator = os.path.splitext(os.path.abspath(Simulator.__file__))[0] + '.py'
+
+    return ' '.join([sys.executable, simulator, 'simjump', '--jump',
+                     '--latency', str(args.latency),
+                     '--connect_latency', str(args.connect_latency),
+                     '--output_lines', str(args.output_lines),
+                     '--fail_rate', str(args.fail_rate),
+                     '--hang_rate', str(args.hang_rate)])
+
+
+def report(args, elapsed, hosts, failed, h):
+    """
+    Function to return report of benchmark run. Phases are taken from timing spans of Host Manager.
+    """
+
+    result = {'DEVICES': len(hosts),
+              'FAILED': len(failed),
+              'WORKERS': args.workers,
+              'SESSIONS': args.sessions,
+              'PATHS': args.paths,
+              'PIPELINE': args.pipeline,
+              'COMMANDS': args.commands,
+              'SECONDS': round(elapsed, 3),
+              'HOSTS_PER_SECOND': round((len(hosts) - len(failed)) / elapsed, 2),
+              'PHASES': h.timing_summary()}
+
+    return result
+
+
+def main():
+    args = option_parser()
+    logging.getLogger().setLevel(args.debug)
+
+    commands = ['show simulated {}'.format(n) for n in range(args.commands)]
+
+    # Every path has a jumpserver and site of its own, hosts of a path follow each other in the inventory.
+    jumpservers = {}
+    for n in range(args.paths):
+        jumpservers['simjump{}'.format(n)] = HostManager.Device('simjump{}'.format(n), prompt=r'simjump\$',
+                                                                ssh='ssh USER@HOST -p PORT',
+                                                                telnet='telnet HOST PORT', connection_type='SSH',
+                                                                timeout=args.timeout, port=22)
+    hosts = [HostManager.Device('sim{}'.format(n), path=('simjump{}'.format(n * args.paths // args.devices),),
+                                site='site{}'.format(n * args.paths // args.devices), timeout=args.timeout)
+             for n in range(args.devices)]
+
+    timeouts = TimeoutManager.AdaptiveTimeouts(args.timeout_history) if args.timeout_history else None
+
+    agent_factory = functools.partial(ConnectionManager.ConnectionAgent,
+                                      am=Simulator.StaticAccounts(),
+                                      ssh_command=simulator_command(args),
+                                      timeout=args.timeout,
+                                      jumpservers=[jumpservers['simjump0']],
+                                      large_output=['show'] if args.large_output else None,
+                                      timeouts=timeouts)
+
+    if args.storage_dir:
+        storage = HostManager.DiskStorage(args.storage_dir)
+    else:
+        storage = HostManager.MemoryStorage()
+    h = HostManager.HostManagment(storage=storage)
+
+    breakers = None
+    if args.breaker_threshold > 0:
+        breakers = WorkerManager.CircuitBreakers(threshold=args.breaker_threshold, reset_timeout=args.breaker_reset)
+
+    start = time.time()
+
+    if args.sessions > 0:
+        loop_factory = functools.partial(LoopManager.LoopAgent,
+                                         am=Simulator.StaticAccounts(),
+                                         ssh_command=simulator_command(args),
+                                         timeout=args.timeout,
+                                         large_output=['show'] if args.large_output else None,
+                                         timeouts=timeouts)
+        max_sessions = dict((j, args.max_sessions) for j in jumpservers) if args.max_sessions else None
+        failed = LoopManager.LoopPool(loop_factory, h, jumpservers, default_path=['simjump0'],
+                                      sessions=args.sessions, pipeline=args.pipeline,
+                                      max_sessions=max_sessions).run(hosts, commands)
+    elif args.workers > 1:
+        max_sessions = dict((j, args.max_sessions) for j in jumpservers) if args.max_sessions else None
+        chain_pool = ConnectionManager.PathPools(agent_factory, jumpservers, default_path=['simjump0'],
+                                                 size=args.workers, max_sessions=max_sessions)
+        failed = WorkerManager.WorkerPool(chain_pool, h, workers=args.workers,
+                                          pipeline=args.pipeline, breakers=breakers).run(hosts, commands)
+        chain_pool.close_all()
+    else:
+        statuses = {}
+        d = None
+        for host in WorkerManager.release_parked(hosts, breakers):
+            if d is None or d.jumpservers[0].name != host.path[0]:
+                if d is not None:
+                    d.close()
+                d = agent_factory(jumpservers=[jumpservers[host.path[0]]])
+            try:
+                status = WorkerManager.collect_host(d, h, host, commands, pipeline=args.pipeline,
+                                                    breakers=breakers)
+            except (SystemExit, Exception):
+                # Agent exits when prompt got lost, start new jump chain.
+                status = 200
+                d.close()
+                d = agent_factory(jumpservers=[jumpservers[host.path[0]]])
+            # Parked hosts come back, hosts given up by breakers keep status 203.
+            statuses[host.name] = status
+        d.close()
+        failed = [name for name, status in statuses.items() if status not in (100, 101, 201)]
+
+    result = report(args, time.time() - start, hosts, failed, h)
+    storage.close()
+    if timeouts is not None:
+        timeouts.save()
+
+    sys.stdout.write("Devices: {DEVICES} (failed: {FAILED}), workers: {WORKERS}, sessions: {SESSIONS}, paths: {PATHS}, "
+                     "pipeline: {PIPELINE}\n"
+                     "Elapsed: {SECONDS}s, {HOSTS_PER_SECOND} hosts/s\n".format(**result))
+    for phase in ConnectionManager.ConnectionAgent.phases:
+        if phase not in result['PHASES']:
+            continue
+        p = result['PHASES'][phase]
+        sys.stdout.write("{:<14} n={:<5} p50={} p95={} p99={}\n".format(
+            phase, p['COUNT'], *['-' if v is None else '{:.4f}s'.format(v) for v in (p['P50'], p['P95'], p['P99'])]))
+
+    if args.output_json:
+        utils.write_dict_to_json_file(args.output_json, result)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stderr,
+                        level=logging.CRITICAL,
+                        format="[%(levelname)8s][%(asctime)s]:%(name)s:%(funcName)s(){l.%(lineno)d}:  %(message)s")
+
+    main()
@@ -5,12 +5,17 @@ There is an option to collect data via Jumpserver.
 """
 
 import argparse
+import atexit
+import collections
+import functools
+import itertools
 import logging
 import os
 import platform
 import sys
 
-from lib import ConnectionManager, HostManager, accountmgr, utils
+from lib import ConnectionManager, HostManager, InventoryManager, LoopManager, ParseManager, ProfileManager, \
+    TimeoutManager, WorkerManager, accountmgr, utils
 
 __author__ = "Thomas Jongerius"
 __copyright__ = "Copyright 2016, Thomas Jongerius"
@@ -21,6 +26,9 @@ __maintainer__ = "Thomas Jongerius"
 __email__ = "thomasjongerius@yaworks.nl"
 __status__ = "Development"
 
+BROKER_KEY_ENV = 'CLI_COLLECTOR_BROKER_KEY'
+PREFLIGHT_CHUNK = 1000  # Hosts of inventory checked at once by preflight (int)
+
 
 def option_parser():
     """Option parser allows command line options to be parsed.
@@ -41,13 +49,95 @@ def option_parser():
                         type=str, default=None, dest='output_dir')
     parser.add_argument("-j", "--json_output", help="Output JSON file",
                         type=str, default=None, dest='output_json')
+    parser.add_argument("--timings", metavar='FILE', type=str, default=None, dest='timings',
+                        help="Write p50/p95/p99 per collection phase, jumpserver and command to JSON file")
+    parser.add_argument("--cprofile", metavar='DIR', type=str, default=None, dest='cprofile',
+                        help="Write CPU profiles of run and every host (pstats format) and counters of "
+                             "expect calls, bytes read, pattern scan time and sleep time to DIR")
+    parser.add_argument("-n", "--ndjson_output", help="Stream one JSON record per host and command to file "
+                                                       "as output arrives. Compressed when file ends with "
+                                                       ".gz, .bz2 or .xz",
+                        type=str, default=None, dest='output_ndjson')
+    parser.add_argument("-s", "--storage_dir", help="Directory to write command output to as it arrives "
+                                                    "(keeps memory usage flat for large runs)",
+                        type=str, default=None, dest='storage_dir')
+    parser.add_argument("--dedup", help="Store output content-addressed in storage directory, "
+                                         "identical output is stored once", dest='dedup', action='store_true')
+    parser.add_argument("--delta", help="With --dedup, store changed output as delta against previous run",
+                        dest='delta', action='store_true')
+    parser.add_argument("--journal_dir", metavar='DIR', type=str, default=None, dest='journal_dir',
+                        help="Keep append-only journal of collected commands in DIR, "
+                             "so an interrupted run can be resumed (requires --storage_dir)")
+    parser.add_argument("--resume", metavar='RUN_ID', type=str, default=None, dest='resume',
+                        help="Resume run RUN_ID from its journal and storage directory (--storage_dir), commands "
+                             "already collected are skipped (Default journal directory: runs)")
     parser.add_argument("-c", "--connection", help="Connection Type (Default: SSH)",
                         type=str, default='SSH', dest='connection', choices=['SSH', 'TELNET'])
+    parser.add_argument("-t", "--transport", help="Transport to reach hosts. PEXPECT spawns the ssh/telnet binary, "
+                                                  "PARAMIKO connects in-process over direct-tcpip channels, "
+                                                  "SOCKET connects Telnet hosts directly without jumpservers "
+                                                  "(Default: PEXPECT)",
+                        type=str, default='PEXPECT', dest='transport',
+                        choices=['PEXPECT', 'PARAMIKO', 'SOCKET'])
+    parser.add_argument("--known_hosts", metavar='FILE', type=str, default=None, dest='known_hosts',
+                        help="Known hosts file used next to ~/.ssh/known_hosts (PARAMIKO transport)")
+    parser.add_argument("--accept_unknown_hostkeys", help="Connect to hosts with host keys not in known hosts "
+                                                          "(PARAMIKO transport, Default: rejected)",
+                        dest='accept_unknown_hostkeys', action='store_true')
+    parser.add_argument("-p", "--profile", help="Vendor profile for prompt detection (Default: IOS)",
+                        type=str, default='IOS', dest='profile', choices=['IOS', 'NXOS', 'JUNOS', 'LINUX'])
+    parser.add_argument("--pipeline", metavar='N', help="Send N commands at once and split output on "
+                                                        "echoed prompts (Default: 0, one by one)",
+                        type=int, default=0, dest='pipeline')
+    parser.add_argument("--large_output", metavar='COMMAND', action='append', default=[], dest='large_output',
+                        help="Commands starting with COMMAND have large output (show run, show tech), read in big "
+                             "chunks and only the tail is scanned for the prompt. Can be given more than once.")
+    parser.add_argument("--timeout_history", metavar='FILE', type=str, default=None, dest='timeout_history',
+                        help="Derive timeouts per host and command from latencies kept in FILE (p99 times "
+                             "TIMEOUT_MARGIN, between TIMEOUT_FLOOR and TIMEOUT_CEILING of settings). "
+                             "Commands still returning output are waited for until the ceiling.")
+    parser.add_argument("--breaker_threshold", metavar='N', type=int, default=0, dest='breaker_threshold',
+                        help="Park hosts behind a jumpserver or site (inventory) after N consecutive connection "
+                             "failures until a probe connection succeeds, 0 disables circuit breakers (Default: 0)")
+    parser.add_argument("--breaker_reset", metavar='SECONDS', type=int, default=60, dest='breaker_reset',
+                        help="Seconds before a probe connection is tried behind an open circuit breaker "
+                             "(Default: 60)")
+    parser.add_argument("--preflight", metavar='REPORT', nargs='?', const='', default=None, dest='preflight',
+                        help="Check reachability of hosts concurrently before collecting and skip unreachable "
+                             "hosts. Hosts without jumpservers are checked from this machine, hosts behind "
+                             "jumpservers from the last jumpserver of their path (bash /dev/tcp and timeout "
+                             "on jumpserver, PEXPECT transport only). Optionally write JSON report to REPORT.")
+    parser.add_argument("--preflight_concurrency", metavar='N', type=int, default=200,
+                        dest='preflight_concurrency',
+                        help="Maximum number of reachability checks in progress (Default: 200)")
+    parser.add_argument("--broker", metavar='ADDRESS', type=str, default=None, dest='broker',
+                        help="Get credentials from credential broker of another collector instead of keyring, "
+                             "at PORT or 127.0.0.1:PORT, or path of unix socket. "
+                             "Key is read from environment variable " + BROKER_KEY_ENV + ".")
+    parser.add_argument("--serve_broker", metavar='ADDRESS', type=str, default=None, dest='serve_broker',
+                        help="Serve credentials to other collectors (--broker) of this machine while collecting, "
+                             "on PORT or 127.0.0.1:PORT, or path of unix socket (mode 0600). "
+                             "Key is read from environment variable " + BROKER_KEY_ENV + ".")
+    parser.add_argument("--parse", help="Parse collected output with registered parsers after collection, "
+                                        "structured data is stored next to raw output",
+                        dest='parse', action='store_true')
+    parser.add_argument("--parse_templates", metavar='DIR', type=str, default=None, dest='parse_templates',
+                        help="Directory with TextFSM templates named after command (show_ip_route.textfsm)")
+    parser.add_argument("--parse_workers", metavar='N', type=int, default=None, dest='parse_workers',
+                        help="Number of parser processes (Default: number of CPUs)")
+    parser.add_argument("-w", "--workers", help="Number of parallel workers, each with own jumpserver "
+                                                "connection (Default: 1)",
+                        type=int, default=1, dest='workers')
+    parser.add_argument("--sessions", metavar='N', type=int, default=0, dest='sessions',
+                        help="Drive N sessions, each with own jump chain, from one thread with a poll loop "
+                             "instead of worker threads (PEXPECT transport only, 0 disables) (Default: 0)")
 
     parser.add_argument('setting_file', help="File containing connection settings",
                         type=str, metavar='SETTINGS_FILE')
     parser.add_argument('device_list', metavar='DEVICE_LIST', type=str,
-                        help="Text file with list of devices to collect data from.")
+                        help="Inventory of devices to collect data from. Text file with one device per line, "
+                             "or CSV (.csv) / JSON lines (.jsonl) with columns name, ipv4, port, prompt, "
+                             "connection_type, timeout, profile, path (jumpservers) and site.")
     parser.add_argument('command_list', metavar='COMMAND_LIST', type=str,
                         help="Text file with list of commands to collect.")
     parser.add_argument('credentials', help="File containing credentials and/or references",
@@ -56,6 +146,106 @@ def option_parser():
     return parser.parse_args()
 
 
+def broker_address(address):
+    """
+    Function to get broker address and key.
+
+    Args:
+        address: Address as HOST:PORT or PORT, otherwise path of unix socket (str)
+
+    Returns:
+        tuple: ((host, port) or path, key)
+    """
+
+    key = os.environ.get(BROKER_KEY_ENV)
+    if not key:
+        logging.critical("Credential broker key not set in environment variable {}!".format(BROKER_KEY_ENV))
+        sys.exit(201)
+
+    host, _, port = address.rpartition(':')
+    if not port.isdigit():
+        return address, key.encode('utf-8')
+    return (host or '127.0.0.1', int(port)), key.encode('utf-8')
+
+
+def account_manager(args):
+    """
+    Function to get account manager for this collector. Local AccountManager or client of
+    credential broker of another collector.
+    """
+
+    if args.broker:
+        address, key = broker_address(args.broker)
+        return accountmgr.BrokerClient(address, key)
+
+    am = accountmgr.AccountManager(config_file=args.credentials, reset=args.reset)
+
+    if args.serve_broker:
+        address, key = broker_address(args.serve_broker)
+        accountmgr.CredentialBroker(am, address=address, authkey=key).start()
+
+    return am
+
+
+def preflight(hosts, agent_factory, jumpservers, path, args):
+    """
+    Generator yielding hosts of inventory that are not known to be unreachable. Hosts are checked
+    per chunk as the inventory is read: hosts without jumpservers from this machine, hosts behind
+    jumpservers from the last jumpserver of their path. Report is written after the last host.
+    """
+
+    def target(d):
+        # Address and port of device, port by its own connection type.
+        return InventoryManager.address(d), InventoryManager.port(d, args.connection)
+
+    hosts = iter(hosts)
+    reachable, unreachable, unknown = [], [], 0
+
+    while True:
+        chunk = list(itertools.islice(hosts, PREFLIGHT_CHUNK))
+        if not chunk:
+            break
+
+        paths = collections.OrderedDict()
+        for d in chunk:
+            paths.setdefault(tuple(d.path or path), []).append(target(d))
+
+        down = set()
+        for host_path, targets in paths.items():
+            r, u = [], []
+            if not host_path:
+                r, u = utils.reachability_sweep(targets, concurrency=args.preflight_concurrency)
+            elif args.transport == 'PEXPECT' and all(j in jumpservers for j in host_path):
+                # Native transports have no shell on jumpserver, unknown jumpservers are reported when collecting.
+                try:
+                    agent = agent_factory(jumpservers=[jumpservers[j] for j in host_path])
+                except SystemExit:
+                    logging.error("Preflight could not connect to {}!".format(host_path[-1]))
+                else:
+                    try:
+                        r, u = agent.reachability_sweep(targets, batch_size=min(50, args.preflight_concurrency))
+                    finally:
+                        agent.close()
+
+            reachable.extend(r)
+            unreachable.extend(u)
+            unknown += len(targets) - len(r) - len(u)
+            down.update((host_path, t) for t in u)
+
+        for host_path, (host, port) in sorted(down):
+            logging.warn("Host {} is not reachable on port {}, skipping!".format(host, port))
+        for d in chunk:
+            if (tuple(d.path or path), target(d)) not in down:
+                yield d
+
+    logging.info("Preflight: {} hosts reachable, {} unreachable, {} unknown.".format(
+        len(reachable), len(unreachable), unknown))
+    if args.preflight:
+        utils.write_dict_to_json_file(args.preflight, {'REACHABLE': ['{}:{}'.format(*t) for t in reachable],
+                                                       'UNREACHABLE': ['{}:{}'.format(*t) for t in unreachable],
+                                                       'UNKNOWN': unknown})
+
+
 def main():
     args = option_parser()
 
@@ -65,16 +255,56 @@ def main():
     logging.info("System running: {} ({})".format(platform.system(), os.name))
     logging.info("Output directory: {}".format(args.output_dir))
     logging.info("JSON output file: {}".format(args.output_json))
+    logging.info("Timings file: {}".format(args.timings))
+    logging.info("CPU profile directory: {}".format(args.cprofile))
+    logging.info("NDJSON output file: {}".format(args.output_ndjson))
+    logging.info("Storage directory: {}".format(args.storage_dir))
+    logging.info("Deduplicated storage: {} (delta: {})".format(args.dedup, args.delta))
+    logging.info("Journal directory: {}".format(args.journal_dir))
+    logging.info("Resume run: {}".format(args.resume))
     logging.info("Credential file: {}".format(args.credentials))
     logging.info("Credential reset: {}".format(args.reset))
     logging.info("Settings file: {}".format(args.setting_file))
     logging.info("Device list file: {}".format(args.device_list))
     logging.info("Command list file: {}".format(args.command_list))
+    logging.info("Transport: {}".format(args.transport))
+    logging.info("Vendor profile: {}".format(args.profile))
+    logging.info("Workers: {}".format(args.workers))
+    logging.info("Sessions: {}".format(args.sessions))
+    logging.info("Pipeline: {}".format(args.pipeline))
+    logging.info("Large output commands: {}".format(', '.join(args.large_output)))
+    logging.info("Preflight: {}".format(args.preflight))
+    logging.info("Timeout history: {}".format(args.timeout_history))
+    logging.info("Circuit breakers: {} failures, reset {}s".format(args.breaker_threshold, args.breaker_reset))
+    logging.info("Parse: {} (templates: {})".format(args.parse, args.parse_templates))
+    logging.info("Credential broker: {}".format(args.broker or args.serve_broker))
+
+    if (args.journal_dir or args.resume) and not args.storage_dir:
+        # Output in memory is lost with the run, nothing could be resumed.
+        logging.critical("Run journal (--journal_dir, --resume) requires a storage directory (--storage_dir)!")
+        sys.exit(10)
+    if args.sessions > 0:
+        if args.workers > 1:
+            logging.critical("Sessions (--sessions) and workers (--workers) cannot be combined!")
+            sys.exit(10)
+        if args.transport != 'PEXPECT':
+            logging.critical("Sessions (--sessions) require the PEXPECT transport!")
+            sys.exit(10)
+        if args.breaker_threshold > 0:
+            logging.critical("Sessions (--sessions) do not support circuit breakers (--breaker_threshold)!")
+            sys.exit(10)
+
+    # Profile written at exit, also when agent exits halfway.
+    profiler = None
+    if args.cprofile:
+        profiler = ProfileManager.Profiler(args.cprofile)
+        profiler.start()
+        atexit.register(profiler.stop)
 
     # Open files that are required.
     try:
-        with open(args.device_list) as device_file:
-            hosts_list = device_file.read().splitlines()
+        # Inventory is read while collecting, not up-front.
+        hosts_list = InventoryManager.read_inventory(args.device_list)
         with open(args.command_list) as device_file:
             commands_list = device_file.read().splitlines()
     except IOError as e:
@@ -83,43 +313,161 @@ def main():
 
     s = utils.read_from_json_file(args.setting_file)
 
-    # Create list with jumpservers as Device objects
-    jumpservers = []
-
-    if 'PATH' in s['SETTINGS']:
-        if len(s['SETTINGS']['PATH']) > 0:
-            for j in s['SETTINGS']['PATH']:
-                if j in s['JUMPSERVERS']:
-                    jumpservers.append(HostManager.Device(j,
-                                                          prompt=s['JUMPSERVERS'][j]['PROMPT'],
-                                                          ssh=s['JUMPSERVERS'][j]['SSH_COMMAND'],
-                                                          telnet=s['JUMPSERVERS'][j]['TELNET_COMMAND'],
-                                                          connection_type=s['JUMPSERVERS'][j]['CONNECTION_TYPE'],
-                                                          timeout=s['JUMPSERVERS'][j]['TIMEOUT'],
-                                                          port=s['JUMPSERVERS'][j]['PORT']))
-                else:
-                    logging.critical("Jumpserver {} could not be found in settings!".format(j))
+    # Create jumpservers as Device objects, hosts reach them over SETTINGS.PATH or own path of inventory.
+    jumpservers = {}
+    max_sessions = {}
+    max_startups = {}
+
+    for j, settings in s['JUMPSERVERS'].items():
+        jumpservers[j] = HostManager.Device(j,
+                                            prompt=settings['PROMPT'],
+                                            ssh=settings['SSH_COMMAND'],
+                                            telnet=settings['TELNET_COMMAND'],
+                                            connection_type=settings['CONNECTION_TYPE'],
+                                            timeout=settings['TIMEOUT'],
+                                            port=settings['PORT'],
+                                            profile=settings.get('PROFILE'))
+        # Limits of sshd (MaxSessions, MaxStartups) of jumpserver.
+        if settings.get('MAX_SESSIONS'):
+            max_sessions[j] = settings['MAX_SESSIONS']
+        if settings.get('MAX_STARTUPS'):
+            max_startups[j] = settings['MAX_STARTUPS']
+
+    path = []
+    for j in s['SETTINGS'].get('PATH', []):
+        if j in jumpservers:
+            path.append(j)
+        else:
+            logging.critical("Jumpserver {} could not be found in settings!".format(j))
+
+    # Latency history is saved at exit, also when agent exits halfway.
+    timeouts = None
+    if args.timeout_history:
+        timeouts = TimeoutManager.AdaptiveTimeouts(args.timeout_history,
+                                                   margin=s['SETTINGS'].get('TIMEOUT_MARGIN', 3.0),
+                                                   floor=s['SETTINGS'].get('TIMEOUT_FLOOR', 2.0),
+                                                   ceiling=s['SETTINGS'].get('TIMEOUT_CEILING', 300.0))
+        atexit.register(timeouts.save)
 
     # Setting up connection and output collector objects
-    d = ConnectionManager.ConnectionAgent(am=accountmgr.AccountManager(
-                                              config_file=args.credentials, reset=args.reset),
-                                          client_connection_type=args.connection,
-                                          ssh_command=s['SETTINGS']['SSH_COMMAND'],
-                                          telnet_command=s['SETTINGS']['TELNET_COMMAND'],
-                                          timeout=s['SETTINGS']['TIMEOUT'],
-                                          shell=s['SETTINGS']['SHELL'],
-                                          jumpservers=jumpservers)
-    h = HostManager.HostManagment()
-
-
-    # Walk through list of hosts, connect, execute command and save to object.
-    for host in hosts_list:
-        h.add_host(host)
-        d.host_connect(host)
-        d.cisco_term_len()
-        for command in commands_list:
-            h.add_command(host, command, d.send_command(command))
-        d.disconnect_host()
+    am = account_manager(args)
+    agent_factory = functools.partial(ConnectionManager.ConnectionAgent,
+                                      am=am,
+                                      client_connection_type=args.connection,
+                                      ssh_command=s['SETTINGS']['SSH_COMMAND'],
+                                      telnet_command=s['SETTINGS']['TELNET_COMMAND'],
+                                      timeout=s['SETTINGS']['TIMEOUT'],
+                                      shell=s['SETTINGS']['SHELL'],
+                                      jumpservers=[jumpservers[j] for j in path],
+                                      profile=args.profile,
+                                      transport=args.transport,
+                                      known_hosts=args.known_hosts,
+                                      accept_unknown_hostkeys=args.accept_unknown_hostkeys,
+                                      large_output=args.large_output,
+                                      timeouts=timeouts)
+    if args.dedup:
+        if not args.storage_dir:
+            logging.critical("Content-addressed storage requires a storage directory (--storage_dir)!")
+            sys.exit(10)
+        storage = HostManager.ContentStorage(args.storage_dir, delta=args.delta)
+    elif args.storage_dir:
+        storage = HostManager.DiskStorage(args.storage_dir)
+    else:
+        storage = HostManager.MemoryStorage()
+    journal = None
+    if args.journal_dir or args.resume:
+        journal = HostManager.RunJournal(args.journal_dir or 'runs', run_id=args.resume, storage=storage)
+        logging.warn("Run ID: {} (resume with --resume {})".format(journal.run_id, journal.run_id))
+    exporter = None
+    if args.output_ndjson:
+        # Records written are flushed at exit, also when agent exits halfway.
+        exporter = HostManager.NDJSONExporter(args.output_ndjson)
+        atexit.register(exporter.close)
+    h = HostManager.HostManagment(storage=storage, journal=journal, exporter=exporter)
+
+    breakers = None
+    if args.breaker_threshold > 0:
+        breakers = WorkerManager.CircuitBreakers(threshold=args.breaker_threshold, reset_timeout=args.breaker_reset)
+
+    # Drop unreachable hosts before any jump chain is used, inventory is still read while collecting.
+    if args.preflight is not None:
+        hosts_list = preflight(hosts_list, agent_factory, jumpservers, path, args)
+
+    if args.sessions > 0:
+        # Sessions share one thread, they wait for their spawns in one poll loop.
+        loop_factory = functools.partial(LoopManager.LoopAgent,
+                                         am=am,
+                                         client_connection_type=args.connection,
+                                         ssh_command=s['SETTINGS']['SSH_COMMAND'],
+                                         telnet_command=s['SETTINGS']['TELNET_COMMAND'],
+                                         timeout=s['SETTINGS']['TIMEOUT'],
+                                         profile=args.profile,
+                                         large_output=args.large_output,
+                                         timeouts=timeouts)
+        LoopManager.LoopPool(loop_factory, h, jumpservers, default_path=path, sessions=args.sessions,
+                             pipeline=args.pipeline, max_sessions=max_sessions,
+                             max_startups=max_startups).run(hosts_list, commands_list)
+    elif args.workers > 1:
+        # Workers check out authenticated jump chains per jump path, within session limits of jumpservers.
+        chain_pool = ConnectionManager.PathPools(agent_factory, jumpservers, default_path=path, size=args.workers,
+                                                 max_sessions=max_sessions, max_startups=max_startups)
+        WorkerManager.WorkerPool(chain_pool, h, workers=args.workers, pipeline=args.pipeline,
+                                 profiler=profiler, breakers=breakers).run(hosts_list, commands_list)
+        chain_pool.close_all()
+    else:
+        # Walk through list of hosts, connect, execute command and save to object.
+        # Jump chain is rebuild when the jump path of host differs from the previous host.
+        d = None
+        current_path = None
+        for host in WorkerManager.release_parked(hosts_list, breakers):
+            host_path = tuple(host.path or path)
+            if d is None or host_path != current_path:
+                unknown = [j for j in host_path if j not in jumpservers]
+                if unknown:
+                    logging.error("Jumpserver {} of {} could not be found in settings, skipping!".format(
+                        ', '.join(unknown), host.name))
+                    continue
+                if d is not None:
+                    d.close()
+                    d = None
+                if breakers is not None:
+                    blocked = breakers.check(WorkerManager.jump_keys(host_path))
+                    if blocked is not None:
+                        breakers.park(blocked, host)
+                        continue
+                try:
+                    d = agent_factory(jumpservers=[jumpservers[j] for j in host_path])
+                except SystemExit:
+                    # Jump chain is required, only with circuit breakers the run continues.
+                    if breakers is None:
+                        raise
+                    breakers.failure(WorkerManager.jump_keys(host_path))
+                    continue
+                if breakers is not None:
+                    breakers.success(WorkerManager.jump_keys(host_path))
+                current_path = host_path
+            try:
+                WorkerManager.collect_host(d, h, host, commands_list, pipeline=args.pipeline, breakers=breakers,
+                                           profiler=profiler)
+            except (SystemExit, Exception) as e:
+                # Agent exits when prompt got lost, continue with next host on a new jump chain.
+                logging.error("Could not collect {} ({}), rebuilding jump chain!".format(host.name, repr(e)))
+                d.close()
+                d = None
+
+    # Summary of timing spans, shows which phase or jumpserver is slow.
+    summary = h.timing_summary()
+    for phase in ConnectionManager.ConnectionAgent.phases:
+        if phase in summary:
+            logging.info("Timing {}: {COUNT} spans, p50 {P50}s, p95 {P95}s, p99 {P99}s".format(phase, **summary[phase]))
+    if args.timings:
+        utils.write_dict_to_json_file(args.timings, summary)
+
+    # Parse output in worker processes, after collection all connections are closed.
+    if args.parse:
+        if args.parse_templates:
+            ParseManager.register_templates(args.parse_templates)
+        ParseManager.ParsePool(workers=args.parse_workers).run(h)
 
     # Saving output if neeeded.
     if args.output_dir:
@@ -127,6 +475,11 @@ def main():
         h.write_to_txt_files(args.output_dir)
     if args.output_json:
         h.write_to_json(args.output_json)
+    if exporter is not None:
+        exporter.close()
+    storage.close()
+    if journal is not None:
+        journal.close()
 
     logging.debug("Script ended")
 
@@ -3,12 +3,17 @@
 Connection Manager library for managing connections to hosts.
 """
 
+import contextlib
+import functools
 import logging
 import sys
 import pexpect
+import threading
 import time
 import accountmgr
 import re
+import TransportManager
+import utils
 
 __author__ = "Thomas Jongerius"
 __copyright__ = "Copyright 2016, Thomas Jongerius"
@@ -23,36 +28,682 @@ __status__ = "Development"
 class ConnectionHandler(object):
     """
     ConnectionHandler for universal connection responses for pExpect in this module.
+    Patterns are compiled once per vendor profile and expected prompt and shared by all agents.
     """
 
-    def __init__(self):
-
-        self.handlers = [pexpect.TIMEOUT, pexpect.EOF,
-                         '[U|u]sername: ',
-                         '[P|p]assword: ',
-                         '\w+#',
-                         '\w+>',
-                         'Permission denied',
-                         '.*Connection refused.*',
-                         '.*Offending RSA key.*']
-
-    def get_handlers(self, added_value=None):
-        # type: (str) -> lst
+    # Prompt patterns per vendor profile. Prompts are anchored to the end of the buffer,
+    # messages are searched without leading/trailing '.*' so every read scans in linear time.
+    profiles = {
+        'IOS': {'USERNAME': r'[Uu]sername:\s*$',
+                'PASSWORD': r'[Pp]assword:\s*$',
+                'ENABLE_PROMPT': r'[\w.\-]+#\s*$',
+                'PRIV_PROMPT': r'[\w.\-]+>\s*$'},
+        'NXOS': {'USERNAME': r'(?:[Uu]sername|login):\s*$',
+                 'PASSWORD': r'[Pp]assword:\s*$',
+                 'ENABLE_PROMPT': r'[\w.\-]+(?:\([\w\-]+\))?#\s*$',
+                 'PRIV_PROMPT': r'[\w.\-]+(?:\([\w\-]+\))?>\s*$'},
+        'JUNOS': {'USERNAME': r'login:\s*$',
+                  'PASSWORD': r'[Pp]assword:\s*$',
+                  'ENABLE_PROMPT': r'[\w.\-]+@[\w.\-]+#\s*$',
+                  'PRIV_PROMPT': r'[\w.\-]+@[\w.\-]+>\s*$'},
+        'LINUX': {'USERNAME': r'(?:[Uu]sername|login):\s*$',
+                  'PASSWORD': r'[Pp]assword:\s*$',
+                  'ENABLE_PROMPT': r'[\w.\-@:~/]+#\s*$',
+                  'PRIV_PROMPT': r'[\w.\-@:~/]+\$\s*$'},
+    }
+
+    # Messages shared by all profiles.
+    messages = {'DENIED': r'Permission denied',
+                'REFUSED': r'Connection refused',
+                'HOSTKEY': r'Offending (?:RSA|ECDSA|ED25519) key'}
+
+    _registry = {}  # Compiled handler lists per (added value, profile), shared by all handlers.
+    _pattern_registry = {}  # Compiled pattern lists per (pattern, eof), shared by all handlers.
+
+    def __init__(self, profile='IOS'):
+
+        if profile not in self.profiles:
+            logging.error("Unknown vendor profile {}, falling back to IOS.".format(profile))
+            profile = 'IOS'
+
+        self.profile = profile
+
+        # Event names for responses of get_handlers(), first is the added value.
+        self.events = ['PROMPT', 'TIMEOUT', 'EOF',
+                       'USERNAME', 'PASSWORD',
+                       'ENABLE_PROMPT', 'PRIV_PROMPT',
+                       'DENIED', 'REFUSED', 'HOSTKEY']
+
+        self.handlers = self.get_handlers()[1:]
+
+    def get_handlers(self, added_value=None, profile=None):
+        # type: (str, str) -> lst
         """
         Function to return handler and allow user to add first handler.
+        Returned list is compiled and cached, use with expect_list().
 
         Args:
             added_value: String that can be used as re.compile
+            profile: Vendor profile, defaults to profile of handler (str)
+
+        Returns:
+            list: List of compiled patterns (and pexpect.TIMEOUT, pexpect.EOF).
+        """
+
+        if profile is None:
+            profile = self.profile
+
+        key = (added_value, profile)
+
+        if key not in self._registry:
+            patterns = self.profiles.get(profile, self.profiles[self.profile])
+
+            # Without added value, the first handler is the enable prompt of the profile.
+            if added_value is None:
+                added_value = patterns['ENABLE_PROMPT']
+
+            return_value = [re.compile(added_value), pexpect.TIMEOUT, pexpect.EOF]
+
+            for event in self.events[3:]:
+                return_value.append(re.compile(patterns.get(event, self.messages.get(event))))
+
+            self._registry[key] = return_value
+
+        return self._registry[key]
+
+    def get_patterns(self, pattern, eof=False):
+        """
+        Function to return cached compiled pattern with pexpect.TIMEOUT (and pexpect.EOF).
+
+        Args:
+            pattern: Regular expression (str)
+            eof: Add pexpect.EOF as third pattern (bool)
+
+        Returns:
+            list: List for expect_list().
+        """
+
+        key = (pattern, eof)
+
+        if key not in self._pattern_registry:
+            return_value = [re.compile(pattern), pexpect.TIMEOUT]
+            if eof:
+                return_value.append(pexpect.EOF)
+            self._pattern_registry[key] = return_value
+
+        return self._pattern_registry[key]
+
+
+class SessionLimiter(object):
+    """
+    Session limits of jumpservers, shared by the JumpChainPools of all jump paths.
+    Every jump chain holds a session on every jumpserver of its path. Chains being built
+    count as startups, sshd drops or delays logins above MaxStartups.
+    """
+
+    def __init__(self, max_sessions=None, max_startups=None):
+        """
+        Session limiter.
+
+        Args:
+            max_sessions: Jumpserver -> maximum concurrent sessions, not set is unlimited (dict)
+            max_startups: Jumpserver -> maximum concurrent logins, not set is unlimited (dict)
+        """
+
+        self.max_sessions = max_sessions or {}
+        self.max_startups = max_startups or {}
+
+        self.sessions = {}  # Jumpserver -> open sessions (dict)
+        self.startups = {}  # Jumpserver -> logins in progress (dict)
+
+        # Shared by all pools and schedulers using this limiter (obj)
+        self.condition = threading.Condition()
+
+    def available(self, path):
+        """
+        Function to check if a chain over path can be build. Caller holds condition.
+        """
+
+        for jumpserver in path:
+            if self.sessions.get(jumpserver, 0) >= self.max_sessions.get(jumpserver, sys.maxsize):
+                return False
+            if self.startups.get(jumpserver, 0) >= self.max_startups.get(jumpserver, sys.maxsize):
+                return False
+        return True
+
+    def full(self, path):
+        """
+        Function to return jumpservers of path without free sessions. Caller holds condition.
+        """
+
+        return [j for j in path if self.sessions.get(j, 0) >= self.max_sessions.get(j, sys.maxsize)]
+
+    def acquire(self, path):
+        """
+        Function to reserve session and startup on every jumpserver of path. Caller holds condition.
+        """
+
+        for jumpserver in path:
+            self.sessions[jumpserver] = self.sessions.get(jumpserver, 0) + 1
+            self.startups[jumpserver] = self.startups.get(jumpserver, 0) + 1
+
+    def started(self, path):
+        """
+        Function to end startup on every jumpserver of path, chain is logged in or failed.
+        """
+
+        with self.condition:
+            for jumpserver in path:
+                self.startups[jumpserver] -= 1
+            self.condition.notify_all()
+
+    def release(self, path):
+        """
+        Function to release session on every jumpserver of path. Caller holds condition.
+        """
+
+        for jumpserver in path:
+            self.sessions[jumpserver] -= 1
+
+
+class JumpChainPool(object):
+    """
+    Pool of ConnectionAgents with authenticated jump chains.
+    Agents are checked out per host and checked back in at the fallback prompt,
+    so jumpserver hops and logins are only paid once per chain.
+    """
+
+    def __init__(self, agent_factory, size=1, check_idle=60, path=(), limiter=None):
+        """
+        Jump chain pool.
+
+        Args:
+            agent_factory: Callable returning a connected ConnectionAgent (func)
+            size: Maximum number of jump chains (int)
+            check_idle: Seconds a chain may be idle before checking it on checkout (int)
+            path: Names of jumpservers of chains, for session limits (tuple)
+            limiter: SessionLimiter shared with pools of other paths (obj)
+        """
+
+        self.agent_factory = agent_factory
+        self.size = max(1, size)
+        self.check_idle = check_idle
+        self.path = tuple(path)
+        self.limiter = limiter
+
+        self.idle = []  # Idle chains as (agent, checkin time) (lst)
+        self.created = 0  # Number of chains created and not closed (int)
+
+        # Pools of one limiter share the condition, so a closed chain wakes every path.
+        self.condition = limiter.condition if limiter is not None else threading.Condition()
+
+    def ready(self):
+        """
+        Function to check if checkout would not block. Caller holds condition.
+        """
+
+        if self.idle:
+            return True
+        if self.created >= self.size:
+            return False
+        return self.limiter is None or self.limiter.available(self.path)
+
+    def reserve(self):
+        """
+        Function to take idle chain or reserve slot for a new chain, without blocking.
+        Caller holds condition. Pass result to claim().
+
+        Returns:
+            tuple: (agent, checkin time) of idle chain, (None, None) for new chain, None when not ready.
+        """
+
+        if self.idle:
+            return self.idle.pop()
+        if not self.ready():
+            return None
+
+        self.created += 1
+        if self.limiter is not None:
+            self.limiter.acquire(self.path)
+        return None, None
+
+    def claim(self, reservation):
+        """
+        Function to build reserved chain or check idle chain, outside of condition.
+
+        Returns:
+            object: ConnectionAgent at fallback prompt, None when idle chain was dead.
+        """
+
+        agent, checkin_time = reservation
+
+        if agent is None:
+            try:
+                logging.debug("Building new jump chain ({} of {})...".format(self.created, self.size))
+                return self.agent_factory()
+            except (SystemExit, Exception):
+                self._release()
+                raise
+            finally:
+                if self.limiter is not None:
+                    self.limiter.started(self.path)
+
+        if agent.chain_alive(check=time.time() - checkin_time > self.check_idle):
+            logging.debug("Reusing jump chain.")
+            return agent
+
+        logging.warn("Idle jump chain is not alive anymore, dropping chain.")
+        self._close(agent)
+        return None
+
+    def cancel(self, reservation):
+        """
+        Function to return reservation of reserve() without using it.
+        """
+
+        agent, checkin_time = reservation
+
+        if agent is None:
+            if self.limiter is not None:
+                self.limiter.started(self.path)
+            self._release()
+            return
+
+        with self.condition:
+            self.idle.append((agent, checkin_time))
+            self.condition.notify_all()
+
+    def checkout(self):
+        """
+        Function to obtain a connected agent. Reuses idle chain if possible.
+        Blocks when all chains are in use.
+
+        Returns:
+            object: ConnectionAgent at fallback prompt of last jumpserver.
+        """
+
+        while True:
+            with self.condition:
+                reservation = self.reserve()
+                while reservation is None:
+                    self.condition.wait()
+                    reservation = self.reserve()
+
+            # Chain is build outside of lock.
+            agent = self.claim(reservation)
+            if agent is not None:
+                return agent
+
+    def checkin(self, agent, broken=False):
+        """
+        Function to return agent to pool.
+
+        Args:
+            agent: ConnectionAgent from checkout() (obj)
+            broken: Agent is not at fallback prompt anymore, close chain (bool)
+        """
+
+        if broken or not agent.chain_alive():
+            self._close(agent)
+            return
+
+        with self.condition:
+            self.idle.append((agent, time.time()))
+            self.condition.notify_all()
+
+    def close_idle(self):
+        """
+        Function to close one idle chain, frees sessions for other paths.
+
+        Returns:
+            bool: True if a chain was closed.
+        """
+
+        with self.condition:
+            if not self.idle:
+                return False
+            agent, checkin_time = self.idle.pop(0)
+
+        logging.debug("Closing idle jump chain over {}.".format(', '.join(self.path)))
+        self._close(agent)
+        return True
+
+    def close_all(self):
+        """
+        Function to close all idle chains.
+        """
+
+        with self.condition:
+            idle = self.idle
+            self.idle = []
+
+        for agent, checkin_time in idle:
+            self._close(agent)
+
+    def _close(self, agent):
+        try:
+            agent.close()
+        except Exception as e:
+            logging.debug("Could not close jump chain ({}).".format(repr(e)))
+        self._release()
+
+    def _release(self):
+        with self.condition:
+            self.created -= 1
+            if self.limiter is not None:
+                self.limiter.release(self.path)
+            self.condition.notify_all()
+
+
+class PathPools(object):
+    """
+    JumpChainPools per jump path, created when a path is first used.
+    All pools share one SessionLimiter, so a jumpserver in several paths is never overloaded.
+    """
+
+    def __init__(self, agent_factory, jumpservers, default_path=(), size=1, check_idle=60,
+                 max_sessions=None, max_startups=None):
+        """
+        Path pools.
+
+        Args:
+            agent_factory: Callable returning a connected ConnectionAgent, takes jumpservers (func)
+            jumpservers: Jumpserver name -> Device (dict)
+            default_path: Names of jumpservers for hosts without path (lst)
+            size: Maximum number of jump chains per path (int)
+            check_idle: Seconds a chain may be idle before checking it on checkout (int)
+            max_sessions: Jumpserver -> maximum concurrent sessions (dict)
+            max_startups: Jumpserver -> maximum concurrent logins (dict)
+        """
+
+        self.agent_factory = agent_factory
+        self.jumpservers = jumpservers
+        self.default_path = tuple(default_path)
+        self.size = size
+        self.check_idle = check_idle
+
+        self.limiter = SessionLimiter(max_sessions, max_startups)
+        self.condition = self.limiter.condition
+        self.pools = {}  # Path -> JumpChainPool (dict)
+
+    def get(self, path=None):
+        """
+        Function to return pool of path.
+
+        Args:
+            path: Names of jumpservers, default path if not set (lst)
+
+        Returns:
+            object: JumpChainPool of path.
+        """
+
+        path = tuple(path) if path else self.default_path
+
+        with self.condition:
+            if path not in self.pools:
+                unknown = [j for j in path if j not in self.jumpservers]
+                if unknown:
+                    raise KeyError("Jumpserver {} could not be found in settings!".format(', '.join(unknown)))
+
+                # Chains of path never exceed smallest session limit of path.
+                size = min([self.size] + [self.limiter.max_sessions[j] for j in path
+                                          if j in self.limiter.max_sessions])
+                factory = functools.partial(self.agent_factory, jumpservers=[self.jumpservers[j] for j in path])
+                self.pools[path] = JumpChainPool(factory, size=size, check_idle=self.check_idle,
+                                                 path=path, limiter=self.limiter)
+            return self.pools[path]
+
+    def close_all(self):
+        """
+        Function to close idle chains of all paths.
+        """
+
+        with self.condition:
+            pools = list(self.pools.values())
+
+        for pool in pools:
+            pool.close_all()
+
+
+class LoginStateMachine(object):
+    """
+    Login and logout state machine for a host.
+    Reacts as soon as a pattern matches. Only waits on expect() timeouts.
+    Transition tables are shared by SSH and Telnet.
+    """
+
+    # (state, event): (action, next state). State '*' matches any state.
+    # Next state None keeps current state.
+    LOGIN_TRANSITIONS = {
+        ('*', 'PROMPT'): ('done', 'CONNECTED'),
+        ('*', 'ENABLE_PROMPT'): ('done', 'CONNECTED'),
+        ('*', 'PRIV_PROMPT'): ('done', 'CONNECTED'),
+        ('*', 'USERNAME'): ('send_username', 'USERNAME_SENT'),
+        ('*', 'PASSWORD'): ('send_password', 'PASSWORD_SENT'),
+        ('PASSWORD_SENT', 'DENIED'): ('reset_password', 'AUTH_RETRY'),
+        ('*', 'DENIED'): ('fail_authentication', 'FAILED'),
+        ('*', 'TIMEOUT'): ('retry', None),
+        ('*', 'EOF'): ('fail', 'FAILED'),
+        ('*', 'REFUSED'): ('fail', 'FAILED'),
+        ('*', 'HOSTKEY'): ('fail_hostkey', 'FAILED'),
+    }
+
+    LOGOUT_EVENTS = ['FALLBACK_PROMPT', 'TIMEOUT', 'EOF']
+
+    LOGOUT_TRANSITIONS = {
+        ('*', 'FALLBACK_PROMPT'): ('done', 'DISCONNECTED'),
+        ('*', 'TIMEOUT'): ('send_exit', 'EXIT_SENT'),
+        ('*', 'EOF'): ('fail', 'FAILED'),
+    }
+
+    def __init__(self, agent, host, user=None, password=None,
+                 expected_prompt=None, timeout=10, max_retry=5):
+        """
+        State machine for login and logout of a single host.
+
+        Args:
+            agent: Connection agent with prompt (spawn), am and ch attributes (obj)
+            host: Hostname or IP (str)
+            user: Username (str)
+            password: Password (str)
+            expected_prompt: Expected prompt after login (str)
+            timeout: Timeout for every expect (int)
+            max_retry: Maximum timeouts or retries before failing (int)
+        """
+
+        self.agent = agent
+        self.host = host
+        self.user = user
+        self.password = password
+        self.expected_prompt = expected_prompt
+        self.timeout = timeout
+        self.max_retry = max_retry
+
+        self.transitions = self.LOGIN_TRANSITIONS
+        self.events = agent.ch.events
+        self.state = 'START'
+        self.status = None  # Final status, None while running (int)
+        self.retry_count = 0
+        self.timings = []  # Time spend per state as (state, seconds) (lst)
+        self._state_start = time.time()
+
+    def start(self, transitions, events, state):
+        """
+        Function to (re)start state machine with transition table.
+        """
+
+        self.transitions = transitions
+        self.events = events
+        self.state = state
+        self.status = None
+        self.retry_count = 0
+        self._state_start = time.time()
+
+    def step(self, response):
+        """
+        Function to handle expect() response and move to next state.
+
+        Args:
+            response: Index of matched pattern (int)
+
+        Returns:
+            int: Final status if finished, otherwise None.
+        """
+
+        event = self.events[response]
+
+        if (self.state, event) in self.transitions:
+            action, next_state = self.transitions[(self.state, event)]
+        else:
+            action, next_state = self.transitions[('*', event)]
+
+        logging.debug("{}: {} + {} -> {} ({})".format(self.host, self.state, event,
+                                                     next_state or self.state, action))
+        getattr(self, '_' + action)()
+
+        if next_state is not None and next_state != self.state:
+            self._enter(next_state)
+
+        return self.status
+
+    def _enter(self, state):
+        now = time.time()
+        self.timings.append((self.state, now - self._state_start))
+        self.state = state
+        self._state_start = now
+
+    def login(self):
+        """
+        Function to login on host. Spawn must be started (or command send) already.
+
+        Returns:
+            int: Status (100 connected, 200 failed, 202 authentication issue).
+        """
+
+        return self.run(self.login_steps())
+
+    def logout(self, fallback_prompt, timeout=3, max_count=3):
+        """
+        Function to logout from host and wait for fallback prompt.
 
         Returns:
-            list: List of re.compile strings.
+            int: Status (100 fallen back, 200 failed).
         """
-        return_value = [added_value]
 
-        for v in self.handlers:
-            return_value.append(v)
+        return self.run(self.logout_steps(fallback_prompt, timeout=timeout, max_count=max_count))
 
-        return return_value
+    def run(self, steps):
+        """
+        Function to run steps of login_steps() or logout_steps(), blocking on expect_list() of agent.
+
+        Returns:
+            int: Final status.
+        """
+
+        try:
+            patterns, timeout = next(steps)
+            while True:
+                patterns, timeout = steps.send(self.agent.prompt.expect_list(patterns, timeout=timeout))
+        except StopIteration:
+            return self.status
+
+    def login_steps(self):
+        """
+        Generator of login steps. Yields (patterns, timeout) to wait for and is sent the index of
+        the matched pattern, so logins can be driven by expect_list() or by a poll loop (LoopManager).
+        """
+
+        self.start(self.LOGIN_TRANSITIONS, self.agent.ch.events, 'CONNECTING')
+        handlers = self.agent.ch.get_handlers(self.expected_prompt, profile=self.agent.current_profile)
+
+        while self.status is None:
+            self.step((yield handlers, self.timeout))
+
+        self.finish()
+        logging.debug("Login timings for {}: {}".format(self.host, self.format_timings()))
+
+    def logout_steps(self, fallback_prompt, timeout=3, max_count=3):
+        """
+        Generator of logout steps, see login_steps().
+        """
+
+        self.start(self.LOGOUT_TRANSITIONS, self.LOGOUT_EVENTS, 'EXIT_SENT')
+        self.max_retry = max_count - 1
+
+        self.agent.prompt.sendline()
+        self.agent.prompt.sendline('exit')
+
+        patterns = self.agent.ch.get_patterns(fallback_prompt, eof=True)
+        while self.status is None:
+            self.step((yield patterns, timeout))
+
+        self.finish()
+        logging.debug("Logout timings for {}: {}".format(self.host, self.format_timings()))
+
+    def finish(self):
+        """
+        Function to close timing of final state.
+        """
+
+        self._enter(self.state)
+
+    def format_timings(self):
+        return ', '.join('{} {:.3f}s'.format(state, seconds) for state, seconds in self.timings)
+
+    # Actions
+    def _done(self):
+        self.status = 100
+
+    def _fail(self):
+        logging.error("Connection issues, cannot connect to {} ({})!".format(self.host, self.state))
+        self.status = 200
+
+    def _fail_authentication(self):
+        logging.error("Authentication issue for {}".format(self.host))
+        self.status = 202
+
+    def _fail_hostkey(self):
+        logging.error("RSA Key seems not matching, "
+                      "make sure the correct key is on {} for {}!".
+                      format(self.agent.fallback_jumpserver_name, self.host))
+        self.status = 202
+
+    def _retry(self):
+        self.retry_count += 1
+        if self.retry_count > self.max_retry:
+            logging.error("Connection to {} timed out in state {}!".format(self.host, self.state))
+            self.status = 200
+        else:
+            logging.debug("Timeout for {} ({} out of {})...".format(self.host, self.retry_count, self.max_retry))
+
+    def _send_username(self):
+        if self.user is None:
+            self.user = self.agent.am.get_username(self.host)
+        self._count_attempt()
+        self.agent.prompt.sendline(self.user)
+
+    def _send_password(self):
+        if self.password is None:
+            self.password = self.agent.am.get_password(self.host, username=self.user)
+        self._count_attempt()
+        self.agent.prompt.sendline(self.password)
+
+    def _reset_password(self):
+        logging.error("Authentication issue for {}, asking for password again.".format(self.host))
+        self.password = self.agent.am.get_password(self.host, username=self.user, reset=True)
+
+    def _send_exit(self):
+        self._retry()
+        if self.status is None:
+            self.agent.prompt.sendline()
+            self.agent.prompt.sendline('exit')
+
+    def _count_attempt(self):
+        # Prompts keep returning (wrong credentials), do not loop forever.
+        self.retry_count += 1
+        if self.retry_count > self.max_retry:
+            logging.error("Too many login attempts for {}!".format(self.host))
+            self.status = 202
 
 
 # noinspection PyArgumentList,PyCallByClass,PyTypeChecker,PyUnresolvedReferences
@@ -62,6 +713,9 @@ class ConnectionAgent(object):
     May invoke JumphostAgent to connect to multiple jumphosts
     """
 
+    # Phases timed in spans, in order of a collection.
+    phases = ['JUMP', 'LOGIN_WAIT', 'LOGIN', 'PROMPT_DETECT', 'TERM_LEN', 'COMMAND', 'DISCONNECT']
+
     def __init__(self, am=accountmgr.AccountManager,
                  client_connection_type='SSH',
                  ssh_command='ssh USER@HOST -p PORT',
@@ -69,7 +723,14 @@ class ConnectionAgent(object):
                  timeout=10,
                  shell='/bin/bash',
                  jumpservers=None,
-                 max_retry=5):
+                 max_retry=5,
+                 profile='IOS',
+                 transport='PEXPECT',
+                 large_output=None,
+                 large_maxread=65536,
+                 timeouts=None,
+                 known_hosts=None,
+                 accept_unknown_hostkeys=False):
         """
         Connection Manager for managing connections. (Via Jumpnode)
 
@@ -82,22 +743,36 @@ class ConnectionAgent(object):
             shell: Shell command (future use) (str)
             jumpservers: List of Device objects (lst: -> obj)
             max_retry: Maximum retry attempts for connections (int)
+            profile: Default vendor profile of hosts [IOS || NXOS || JUNOS || LINUX] (str)
+            transport: Transport to reach hosts [PEXPECT || PARAMIKO || SOCKET] (str)
+            large_output: Command prefixes with large output (show run, show tech) (lst)
+            large_maxread: Bytes read at once for large output commands (int)
+            timeouts: AdaptiveTimeouts deriving timeouts from latency history, fixed timeout if not set (obj)
+            known_hosts: Known hosts file next to system host keys, PARAMIKO transport (str)
+            accept_unknown_hostkeys: Accept host keys not in known hosts, PARAMIKO transport (bool)
 
         Returns:
             object: Connection Object for maintaining connection to hosts.
         """
 
         self.prompt = pexpect.spawn  # PEXPECT Class definition for prompt.
-        self.ch = ConnectionHandler()  # Connection handler object (obj)
+        self.ch = ConnectionHandler(profile=profile)  # Connection handler object (obj)
+        self.current_profile = self.ch.profile  # Vendor profile of current connection (str)
         self.am = am
+        # Transport object (obj)
+        self.transport = TransportManager.get_transport(transport, timeout=timeout, known_hosts=known_hosts,
+                                                        accept_unknown_hostkeys=accept_unknown_hostkeys)
 
         # Connection settings
         self.ssh_command = ssh_command
         self.telnet_command = telnet_command
         self.timeout = timeout
         self.max_retry = max_retry
-        self.jumpservers = jumpservers
+        self.jumpservers = jumpservers or []
         self.conn_type = client_connection_type
+        self.large_output = [' '.join(c.split()) for c in large_output or []]
+        self.large_maxread = large_maxread
+        self.timeouts = timeouts
         # TODO
         self.initial_values = {'CONNECTION_TYPE': client_connection_type,
                                'SSH_COMMAND': ssh_command,
@@ -109,6 +784,9 @@ class ConnectionAgent(object):
         self.fallback_prompt = None  # Current fallback prompt (Last Jumpserver) (str)
         self.fallback_jumpserver_name = 'localhost'  # Current fallback prompt (Last Jumpserver) (str)
         self.current_connected_host = 'localhost'  # Name of host currently connected to (str)
+        self.last_timings = []  # Per state timings of last login/logout as (state, seconds) (lst)
+        self.spans = []  # Timing spans of phases since last pop_spans() (lst: -> dict)
+        self._span_depth = 0  # Phases in progress, nested phases count for outer phase (int)
 
         # TODO
         self.shell = shell
@@ -116,12 +794,60 @@ class ConnectionAgent(object):
         # TODO Initial setup without jumpserver support
         if len(self.jumpservers) > 0:
             self.connect_jumpserver(self.jumpservers)
+        elif self.transport.native:
+            logging.info("No jumpservers, connecting to hosts directly.")
         else:
             logging.error("For now connection can only be build through a jumpserver.")
             logging.error("Direct connection feature will be build in the near future.")
             logging.error("Script will exit now.")
             sys.exit(101)
 
+    @contextlib.contextmanager
+    def _span(self, phase, name=None):
+        """
+        Context manager recording duration of phase as span. Also recorded when phase exits.
+
+        Args:
+            phase: Phase of collection, see phases (str)
+            name: Jumpserver or command the phase belongs to (str)
+        """
+
+        self._span_depth += 1
+        start = time.time()
+        try:
+            yield
+        finally:
+            self._span_depth -= 1
+            if self._span_depth == 0:
+                self._add_span(phase, time.time() - start, name)
+
+    def _add_span(self, phase, seconds, name=None):
+        span = {'PHASE': phase, 'SECONDS': round(seconds, 6)}
+        if name is not None:
+            span['NAME'] = name
+        self.spans.append(span)
+
+    def _wait_login(self, host):
+        """
+        Function to wait for login rate limit of credential section of host (AAA protection).
+        Logins are limited per site when configured, site is the jumpserver the login starts from.
+        """
+
+        waited = self.am.acquire_login(host, site=self.fallback_jumpserver_name)
+        if waited > 0:
+            self._add_span('LOGIN_WAIT', waited, host)
+
+    def pop_spans(self):
+        """
+        Function to return spans recorded since last call.
+
+        Returns:
+            list: Spans as dict with PHASE, SECONDS and NAME (jumpserver or command).
+        """
+
+        spans, self.spans = self.spans, []
+        return spans
+
     @staticmethod
     def get_status():
         """
@@ -137,6 +863,7 @@ class ConnectionAgent(object):
                        200: 'FAILED',
                        201: 'FALLBACK',
                        202: 'AUTHENTICATION_ISSUE',
+                       203: 'CIRCUIT_OPEN',
                        300: 'UNKNOWN'}
 
         return status_pool
@@ -174,20 +901,25 @@ class ConnectionAgent(object):
 
     def host_connect(self, host, connection_type=None,
                      timeout=None, expected_prompt=None,
-                     port=None):
+                     port=None, profile=None):
         """
         Function to connect to host. And return status.
 
         host :: string for hostname or IP
+        expected_prompt :: prompt pattern, defaults to prompt pattern of vendor profile
+        profile :: vendor profile for prompt patterns, defaults to profile of agent
         """
 
         # Set values if given or use initial value.
         if connection_type is None:
             connection_type = self.conn_type
+        if profile is None:
+            profile = self.ch.profile
+        self.current_profile = profile
         if timeout is None:
             timeout = self.timeout
-        if expected_prompt is None:
-            expected_prompt = str(host) + "#"
+        timeout = self._timeout('LOGIN', host, default=timeout)
+        # Without expected prompt (inventory), the prompt of the vendor profile is detected.
 
         # Setting up connection per type selected.
         if connection_type == 'SSH':
@@ -195,17 +927,19 @@ class ConnectionAgent(object):
             if port is None:
                 port = 22
 
-            status = self.ssh_connection(host, timeout=timeout,
-                                         expected_prompt=expected_prompt,
-                                         port=port)
+            with self._span('LOGIN'):
+                status = self.ssh_connection(host, timeout=timeout,
+                                             expected_prompt=expected_prompt,
+                                             port=port)
         elif connection_type == 'TELNET':
             # Port settings, fallback to default if not set.
             if port is None:
                 port = 23
 
-            status = self.telnet_connection(host, timeout=timeout,
-                                            expected_prompt=expected_prompt,
-                                            port=port)
+            with self._span('LOGIN'):
+                status = self.telnet_connection(host, timeout=timeout,
+                                                expected_prompt=expected_prompt,
+                                                port=port)
         # No other connection type yet.
         else:
             logging.error("Other connection types not yet supported ({})!".format(connection_type))
@@ -213,7 +947,8 @@ class ConnectionAgent(object):
 
         # Detecting and validating prompt if connected
         if status == 100:
-            status = self.prompt_detect(host, expected_prompt=expected_prompt)
+            with self._span('PROMPT_DETECT'):
+                status = self.prompt_detect(host, expected_prompt=expected_prompt)
 
         # Acting on connection status
         # When not correctly connected. Try to fallback if connected to jumpserver.
@@ -223,7 +958,19 @@ class ConnectionAgent(object):
         #         and self._jumpconnect_check(host) is False:
         if status >= 102:
             logging.error('Could not detect prompt for {}. Trying to fall back! Status: {}'.format(host, status))
-            status = self.disconnect_host
+            if self.fallback_prompt is None and not self.transport.native:
+                # First jumpserver, nothing to fall back to.
+                status = 200
+            elif not self.transport.native and self.chain_alive(check=True):
+                # Host closed session itself (login denied), exit would close jumpserver.
+                status = 200
+            else:
+                self.current_connected_host = host
+                if self.disconnect_host() == 100:
+                    # Back at fallback prompt, connection failed.
+                    status = 200
+                else:
+                    status = 300
 
         if status == 100:
             logging.debug('Successfully connected to {}!'.format(host))
@@ -247,9 +994,10 @@ class ConnectionAgent(object):
         term = 'terminal length 0'
 
         logging.debug("Sending '{}' for extending terminal output...".format(term))
-        self.prompt.sendline(term)
 
-        response = self.prompt.expect([self.current_prompt, pexpect.TIMEOUT], timeout=self.timeout)
+        with self._span('TERM_LEN'):
+            self.prompt.sendline(term)
+            response = self._expect_output([self.current_prompt], 'TERM_LEN')
 
         if response == 0:
             pass
@@ -271,9 +1019,12 @@ class ConnectionAgent(object):
 
         if allow_more_show or search_show:
 
-            self.prompt.sendline(command)
-
-            response = self.prompt.expect([self.current_prompt, pexpect.TIMEOUT], timeout=self.timeout)
+            with self._span('COMMAND', command):
+                self.prompt.sendline(command)
+                if self.is_large_output(command):
+                    response = self._expect_prompt_large(command)
+                else:
+                    response = self._expect_output([self.current_prompt], command)
 
             if response == 0:
                 logging.info("Command {} executed!".format(command))
@@ -287,16 +1038,170 @@ class ConnectionAgent(object):
                          "This is no \"show\"-command. "
                          "Make sure you execute fully typed show commands.".format(command))
 
-    # noinspection PyUnusedLocal
+    def is_large_output(self, command):
+        """
+        Function to check if command is selected for large output mode.
+        """
+
+        command = ' '.join(command.split())
+        return any(command.startswith(prefix) for prefix in self.large_output)
+
+    def _timeout(self, key, host=None, default=None):
+        """
+        Function to return expect timeout for phase or command on host, from latency history
+        when adaptive timeouts are used.
+
+        Args:
+            key: Phase (LOGIN, PROMPT_DETECT, TERM_LEN) or command (str)
+            host: Hostname or IP, defaults to current connected host (str)
+            default: Timeout without history, defaults to timeout of agent (int)
+
+        Returns:
+            float: Timeout in seconds.
+        """
+
+        if default is None:
+            default = self.timeout
+        if self.timeouts is None:
+            return default
+
+        return self.timeouts.timeout(host or self.current_connected_host, ' '.join(key.split()), default)
+
+    def _observe(self, key, seconds, host=None):
+        if self.timeouts is not None:
+            self.timeouts.observe(host or self.current_connected_host, ' '.join(key.split()), seconds)
+
+    def _expect_output(self, markers, key, searchwindowsize=None):
+        """
+        Function to wait for one of markers after command (or phase) key. With adaptive timeouts,
+        the timeout is the time without new output: slow commands still returning output
+        are waited for until the ceiling.
+
+        Returns:
+            int: Index of marker, len(markers) on timeout (as expect_exact(markers + [TIMEOUT])).
+        """
+
+        timeout = self._timeout(key)
+        start = time.time()
+        received = 0
+
+        while True:
+            response = self.prompt.expect_exact(markers + [pexpect.TIMEOUT], timeout=timeout,
+                                                searchwindowsize=searchwindowsize)
+
+            if response < len(markers):
+                self._observe(key, time.time() - start)
+                return response
+
+            # Output since last match is kept on timeout, before only grows while output arrives.
+            if self.timeouts is None or len(self.prompt.before) == received \
+                    or time.time() - start >= self.timeouts.ceiling:
+                return response
+
+            received = len(self.prompt.before)
+            logging.debug("Command {} is still returning output after {:.1f}s, waiting.".format(
+                key, time.time() - start))
+
+    def _expect_prompt_large(self, command):
+        """
+        Function to wait for prompt after large output. Reads in chunks of large_maxread and
+        only scans the tail of the output for the prompt (searchwindowsize), pexpect keeps
+        the output as it arrives instead of searching all of it after every read.
+
+        Returns:
+            int: 0 when prompt returned, 1 on timeout (as expect_exact([prompt, TIMEOUT])).
+        """
+
+        maxread = self.prompt.maxread
+        self.prompt.maxread = self.large_maxread
+        try:
+            return self._expect_output([self.current_prompt], command,
+                                       searchwindowsize=self.large_maxread + len(self.current_prompt))
+        finally:
+            self.prompt.maxread = maxread
+
+    def send_commands(self, commands, allow_more_show=False, batch_size=10):
+        """
+        Function to send commands pipelined. Every batch is sent at once and the combined
+        output is split on the echoed prompt followed by the next command of the batch.
+
+        :param commands: Commands for execution (lst)
+        :param allow_more_show: Validation for 'show'-commands only. (bool)
+        :param batch_size: Commands sent at once, keep within typeahead buffer of device. (int)
+        :return: List of (command, response) in order of commands, response None if not executed.
+        """
+
+        batch = []
+
+        for command in commands:
+            if allow_more_show or re.search(r'show\s\w*', command):
+                batch.append(command)
+            else:
+                logging.warn("Command \"{}\" has not been executed! "
+                             "This is no \"show\"-command. "
+                             "Make sure you execute fully typed show commands.".format(command))
+
+        # Large output commands are sent on their own, pipelined output would be split by scanning.
+        outputs = []
+        pending = []
+        for command in batch + [None]:
+            if command is not None and not self.is_large_output(command):
+                pending.append(command)
+                continue
+
+            for n in range(0, len(pending), max(1, batch_size)):
+                outputs.extend(self._send_batch(pending[n:n + max(1, batch_size)]))
+            pending = []
+
+            if command is not None:
+                outputs.append((command, self.send_command(command, allow_more_show=True)))
+
+        # Responses in order of commands, commands not executed get None.
+        outputs.reverse()
+        return [outputs.pop() if outputs and outputs[-1][0] == c else (c, None) for c in commands]
+
+    def _send_batch(self, batch):
+        """
+        Function to send batch of commands at once and split output per command.
+        """
+
+        start = time.time()
+        for command in batch:
+            self.prompt.sendline(command)
+
+        outputs = []
+
+        for n, command in enumerate(batch):
+            # Device echoes next command after prompt when it reads it from typeahead.
+            if n + 1 < len(batch):
+                marker = self.current_prompt + batch[n + 1]
+            else:
+                marker = self.current_prompt
+
+            response = self._expect_output([marker], command)
+
+            # Span of pipelined command lasts until its output is complete.
+            self._add_span('COMMAND', time.time() - start, command)
+            start = time.time()
+
+            if response == 0:
+                logging.info("Command {} executed!".format(command))
+                # Echo of command is consumed by previous marker, add for same output as send_command.
+                outputs.append((command, self.prompt.before if n == 0 else command + self.prompt.before))
+            else:
+                logging.critical("Unknown response!")
+                self.disconnect_host()
+                sys.exit(200)
+
+        return outputs
+
     def disconnect_host(self):
         """
         Function to fallback to original prompt or disconnect self.prompt
-        """
 
-        back_to_prompt = False
-        count = 1
-        max_count = 3
-        timeout = 3
+        Returns:
+            int: Status (100 fallen back, 200 failed).
+        """
 
         # Logging only
         if self.current_connected_host is None:
@@ -304,211 +1209,150 @@ class ConnectionAgent(object):
         else:
             logging.debug('Trying to disconnect from {}...'.format(self.current_connected_host))
 
+        # Native transport session is a channel of its own, jump chain stays connected.
+        if self.transport.native:
+            self.transport.close_session(self.prompt)
+            self.prompt = None
+            self.current_connected_host = None
+            return 100
+
         # Validate if fallback prompt is set.
         if self.fallback_prompt is None:
             logging.error('Do not know what prompt to fall back to!')
-            raise
+            return 200
         else:
             logging.debug('Falling back to prompt: {}'.format(self.fallback_prompt))
 
-        # Send clear line and exit signal
-        self.prompt.sendline()
-        self.prompt.sendline('exit')
-
-        # Continue to try and fallback.
-        while back_to_prompt is False:
-            logging.debug('Trying to fall back ({} out of {})...'.format(count, max_count))
-
-            time.sleep(1)
-            response = self.prompt.expect([self.fallback_prompt, pexpect.TIMEOUT], timeout=timeout)
+        with self._span('DISCONNECT'):
+            sm = LoginStateMachine(self, self.current_connected_host)
+            status = sm.logout(self.fallback_prompt)
+        self.last_timings = sm.timings
 
-            if response == 0:
-                logging.debug('Disconnected from {}!'.format(self.current_connected_host))
-                back_to_prompt = True
-                self.current_connected_host = None
-                status = 100
-            elif response == 1:
-                self.prompt.sendline()
-                self.prompt.sendline('exit')
-            else:
-                logging.critical("Unknown error!")
-                raise
-
-            count += 1
+        if status == 100:
+            logging.debug('Disconnected from {}!'.format(self.current_connected_host))
+            self.current_connected_host = None
+        else:
+            logging.critical('Could not fall back to {}'.format(self.fallback_prompt))
 
-            if count > max_count:
-                logging.critical('Could not fall back to {}'.format(self.fallback_prompt))
-                status = 200
+        return status
 
-    # noinspection PyUnusedLocal
-    def password_handler(self, host, user,
-                         expected_prompt=None,
-                         password=None, password_type='Fixed',
-                         timeout=None, max_retry_count=5,
-                         ad=False):
+    def chain_alive(self, check=False):
         """
-        Password prompt handler.
+        Function to check if jump chain is still usable.
+
+        Args:
+            check: Send empty line and wait for fallback prompt (bool)
 
         Returns:
-            bool: Connection status.
+            bool: True if spawn is alive (and fallback prompt returned).
         """
 
-        # Connection handler list
-        connection_handler = self.ch.get_handlers(expected_prompt)
+        if not self.transport.alive():
+            return False
 
-        # Setup variables
-        prompt_detected = False
-        retry_count = 0
-        status = 0
+        if self.transport.native:
+            return True
 
-        if password is None:
-            password = self.am.get_password(host, username=user)
-        if timeout is None:
-            timeout = self.timeout
+        if check:
+            self.prompt.sendline()
+            response = self.prompt.expect_list(self.ch.get_patterns(self.fallback_prompt, eof=True),
+                                               timeout=self.timeout)
+            return response == 0
 
-        # If password is already detected, send password directly.
-        if ad:
-            logging.debug("Function called with prompt already detected. Sending password...")
-            self.prompt.sendline(password)
+        return True
 
-        # Loop until prompt detection.
-        while not prompt_detected and retry_count <= max_retry_count:
+    def reachability_sweep(self, hosts, timeout=5, batch_size=50):
+        """
+        Function to check reachability of hosts from the last jumpserver, hosts behind it are only
+        reachable from there. Batches of hosts are checked at once by the shell of the jumpserver.
 
-            time.sleep(1)
-            response = self.prompt.expect(connection_handler, timeout=timeout)
+        Args:
+            hosts: (host, port) tuples (lst)
+            timeout: Seconds to wait for a connect per host (int)
+            batch_size: Hosts checked at once, keeps command line short (int)
 
-            if not prompt_detected and retry_count > 0:
-                logging.debug("Password detection for {} ({} out of {})...".format(host, retry_count,
-                                                                                   max_retry_count))
+        Returns:
+            tuple: (reachable, unreachable) lists of (host, port), unknown hosts are in neither.
+        """
 
-            if response == 0:
-                logging.debug("Seems prompt has returned! (Expected)")
-                prompt_detected = True
-                status = 100
-            elif response == 1:
-                logging.error("Connection timed out! Reading current buffer...")
-                logging.error("Dumping due to development...")
-                logging.error(self.prompt)
-                status = 300
-            elif response == 3:
-                logging.warn("Seems like falling back to username. Re-entry username!")
-                self.user_handler(host, user=user, expected_prompt=expected_prompt,
-                                  timeout=timeout, ad=True)
-                status = 150
-            elif response == 4:
-                logging.debug("Password line detected!")
-                logging.debug("Sending password...")
-                self.prompt.sendline(password)
-                status = 151
-            elif response == 5 or response == 6:
-                logging.info("Seems prompt has returned! (Not expected)")
-                prompt_detected = True
-                status = 100
-            elif response == 7:
-                logging.error("Authentication issue for {}".format(host))
-                password = self.am.get_password(host, username=user, reset=True)
-                status = 202
-            elif response == 8:
-                logging.error("Connection issues, cannot connect!")
-                prompt_detected = True
-                status = 200
-            elif response == 9:
-                logging.error("Connection issues, cannot connect!")
-                logging.error("RSA Key seems not matching, "
-                              "make sure the correct key is on {} for {}!".
-                              format(self.fallback_jumpserver_name, host))
-                prompt_detected = True
-                status = 202
-            else:
-                raise
+        reachable, unreachable = [], []
 
-            retry_count += 1
+        if self.transport.native or self.fallback_prompt is None:
+            logging.warn("No jumpserver shell to check reachability from, {} hosts unknown.".format(len(hosts)))
+            return reachable, unreachable
 
-        return status
+        patterns = self.ch.get_patterns(self.fallback_prompt, eof=True)
+        for n in range(0, len(hosts), batch_size):
+            command = utils.reachability_command(hosts[n:n + batch_size], timeout=timeout, shell=self.shell)
+            if command is None:
+                continue
+
+            self.prompt.sendline(command)
+            response = self.prompt.expect_list(patterns, timeout=timeout + self.timeout)
+            if response != 0:
+                logging.error("No prompt of {} after reachability check!".format(self.fallback_jumpserver_name))
+                break
 
-    def user_handler(self, host, user=None,
-                     expected_prompt=None,
-                     timeout=None, max_retry_count=5, ad=False):
+            up, down = utils.parse_reachability(self.prompt.before)
+            reachable.extend(up)
+            unreachable.extend(down)
+
+        return reachable, unreachable
+
+    def close(self):
         """
-        User prompt handler.
+        Function to close all sessions and jump chain.
         """
 
-        # Connection handler list
-        if expected_prompt is None:
-            expected_prompt = '\w+[#|>]'
+        self.transport.close()
+        self.current_connected_host = None
 
-        connection_handler = self.ch.get_handlers(expected_prompt)
+    def login(self, host, user, password=None, expected_prompt=None, timeout=None):
+        """
+        Function to handle username and password prompts until a prompt returns.
 
-        # Setup variables
-        prompt_detected = False
-        retry_count = 0
-        status = 0
+        Returns:
+            int: Connection status.
+        """
 
-        if user is None:
-            user = self.am.get_username(host)
         if timeout is None:
             timeout = self.timeout
 
-        # If username prompt is already detected, send username directly.
-        if ad:
-            logging.debug("Function called with prompt already detected. Sending username...")
-            self.prompt.sendline(user)
+        start = time.time()
+        sm = LoginStateMachine(self, host, user=user, password=password,
+                               expected_prompt=expected_prompt,
+                               timeout=timeout, max_retry=self.max_retry)
+        status = sm.login()
+        self.last_timings = sm.timings
 
-        # Loop until prompt detection.
-        while not prompt_detected and retry_count <= max_retry_count:
-
-            time.sleep(1)
-            response = self.prompt.expect(connection_handler, timeout=timeout)
-
-            if not prompt_detected and retry_count > 0:
-                logging.debug("Retry for username for {}... "
-                              "({} out of {})...".format(host, retry_count, max_retry_count))
-
-            if response == 0 or response == 5 or response == 6:
-                logging.warn("Seems prompt has returned and no password is required!")
-                prompt_detected = True
-                status = 100
-            elif response == 1:
-                logging.error("Connection timed out! Reading current buffer...")
-                logging.error("Dumping due to development...")
-                logging.error(self.prompt)
-                status = 200
-            elif response == 3:
-                logging.debug("Username line detected!")
-                logging.debug("Sending username...")
-                self.prompt.sendline(user)
-                status = 150
-            elif response == 4:
-                logging.debug("Password line detected!")
-                prompt_detected = True
-                status = 151
-            else:
-                logging.critical("Unknown response!")
-                logging.error(self.prompt)
-                raise
-
-            retry_count += 1
+        if status == 100:
+            self._observe('LOGIN', time.time() - start, host)
 
         return status
 
     def prompt_detect(self, host, expected_prompt=None):
         """
         Prompt detector.
+
+        Returns:
+            int: Status (100 prompt, 101 priv mode prompt, 200 no prompt).
         """
 
         # Connection handler list
-        connection_handler = self.ch.get_handlers(expected_prompt)
+        connection_handler = self.ch.get_handlers(expected_prompt, profile=self.current_profile)
 
         detected = False
         detect_count = 1
         max_detect_count = 3
-        status = 0
+        status = 200
 
         logging.debug("Trying to receive prompt on {} ({})...".format(host, expected_prompt))
+        timeout = self._timeout('PROMPT_DETECT', host)
+        start = time.time()
         self.prompt.sendline()
 
         while not detected and detect_count < max_detect_count:
-            response = self.prompt.expect(connection_handler, timeout=self.timeout)
+            response = self.prompt.expect_list(connection_handler, timeout=timeout)
 
             if response == 0:
                 logging.debug("Expected prompt received!")
@@ -518,28 +1362,30 @@ class ConnectionAgent(object):
                 logging.debug("Enable mode prompt received!")
                 detected = True
                 status = 100
-            elif response == 6 and expected_prompt is not None:
+            elif response == 6:
                 logging.warn("Privilege mode prompt received!")
                 detected = True
                 status = 101
-            elif response == 0:
+            elif response == 1:
                 logging.debug("Action timed out, retry ({} out of {}).".format(detect_count, max_detect_count))
                 self.prompt.sendline()
             else:
-                logging.critical("Error!")
-                raise
+                # EOF or a prompt of another state, host is not at its prompt.
+                logging.error("Unexpected response while detecting prompt of {} ({})!".format(
+                    host, self.ch.events[response]))
+                break
 
             detect_count += 1
 
-        try:
-            r_line = self.prompt.after.splitlines()
-            actual_prompt = r_line[-1]
-            logging.debug("Detected prompt '{}'!".format(actual_prompt))
-            self.current_prompt = actual_prompt
-        except:
-            logging.critical("Could not detect prompt! "
-                             "Do not know where we are!")
-            raise
+        # Match (after) is only known when a prompt was received, not after timeout or EOF.
+        if not detected:
+            logging.critical("Could not detect prompt of {}! Do not know where we are!".format(host))
+            return status
+
+        self._observe('PROMPT_DETECT', time.time() - start, host)
+        actual_prompt = self.prompt.after.splitlines()[-1].strip()
+        logging.debug("Detected prompt '{}'!".format(actual_prompt))
+        self.current_prompt = actual_prompt
 
         return status
 
@@ -555,6 +1401,8 @@ class ConnectionAgent(object):
         user = self.am.get_username(host)
         password = self.am.get_password(host, user)
 
+        self._wait_login(host)
+
         # Default port detection.
         if port != 23:
             logging.info("Alternative Telnet port detected ({}). Using this port.".format(port))
@@ -564,31 +1412,20 @@ class ConnectionAgent(object):
         conn = conn.replace("PORT", str(port))
         # TODO Option parser to be added
 
-        logging.debug("Connecting using '{}' command...".format(conn))
-
-        # If no spawn instance exists. Create one.
-        if isinstance(self.prompt, pexpect.spawn):
-            self.prompt.sendline(conn)
+        if self.transport.native:
+            # Native Telnet session, login prompts are handled as usual.
+            try:
+                self.prompt = self.transport.open(host, timeout=timeout, port=port,
+                                                  connection_type='TELNET')
+            except Exception as e:
+                logging.error("Could not connect to {} ({})!".format(host, repr(e)))
+                return 200
         else:
-            self.prompt = pexpect.spawn(conn, timeout=timeout)
-
-        # User handling
-        status = self.user_handler(host, user=user,
-                                   expected_prompt=expected_prompt,
-                                   timeout=timeout, max_retry_count=self.max_retry)
-
-        # Password handling
-        if status == 100:
-            status = self.password_handler(host, user,
-                                           expected_prompt=expected_prompt,
-                                           password=password, timeout=timeout)
-        elif status == 151:
-            status = self.password_handler(host, user,
-                                           expected_prompt=expected_prompt,
-                                           password=password, timeout=timeout,
-                                           ad=True)
+            logging.debug("Connecting using '{}' command...".format(conn))
+            self.prompt = self.transport.open(host, conn, timeout=timeout)
 
-        return status
+        return self.login(host, user, password=password,
+                          expected_prompt=expected_prompt, timeout=timeout)
 
     def ssh_connection(self, host, timeout=10, port=22, expected_prompt=None):
         """
@@ -603,6 +1440,8 @@ class ConnectionAgent(object):
         password = self.am.get_password(host, user)
         password_type = self.am.get_password_type(host)
 
+        self._wait_login(host)
+
         # Default port detection.
         if port != 22:
             logging.info("Alternative SSH port detected ({}). Using this port.".format(port))
@@ -613,20 +1452,24 @@ class ConnectionAgent(object):
         cmd = cmd.replace("PORT", str(port))
         # TODO Option parser to be added
 
-        logging.debug("Connecting using '{}' command...".format(cmd))
-
-        # If no spawn instance exists. Create one.
-        if isinstance(self.prompt, pexpect.spawn):
-            self.prompt.sendline(cmd)
-        else:
-            self.prompt = pexpect.spawn(cmd, timeout=timeout)
+        # Native transport authenticates in-process, no login prompts to handle.
+        if self.transport.native:
+            if password_type != 'Fixed':
+                password = None
+            try:
+                self.prompt = self.transport.open(host, timeout=timeout, port=port,
+                                                  user=user, password=password,
+                                                  connection_type='SSH')
+            except Exception as e:
+                logging.error("Could not connect to {} ({})!".format(host, repr(e)))
+                return 200
+            return 100
 
-        status = self.password_handler(host, user,
-                                       expected_prompt=expected_prompt,
-                                       password=password, password_type=password_type,
-                                       timeout=timeout)
+        logging.debug("Connecting using '{}' command...".format(cmd))
+        self.prompt = self.transport.open(host, cmd, timeout=timeout)
 
-        return status
+        return self.login(host, user, password=password,
+                          expected_prompt=expected_prompt, timeout=timeout)
 
     def connect_jumpserver(self, path):
         """
@@ -653,13 +1496,24 @@ class ConnectionAgent(object):
 
             jumpserver_hostname = jumpserver.name
 
-            if current_jumpserver != jumpserver_hostname:
-                # Connect to jumphost
-                status = self.host_connect(jumpserver_hostname,
-                                           connection_type=jumpserver.connection_settings['CONNECTION_TYPE'],
-                                           timeout=jumpserver.connection_settings['TIMEOUT'],
-                                           port=jumpserver.connection_settings['CONNECTION_PORT'],
-                                           expected_prompt=jumpserver.connection_settings['PROMPT'])
+            if current_jumpserver != jumpserver_hostname and self.transport.native:
+                # Chain jumphost in-process, no shell on jumphost required.
+                with self._span('JUMP', jumpserver_hostname):
+                    status = self._native_jump(jumpserver)
+
+                if status != 100:
+                    logging.critical('Jumpserver connection unsuccessful! '
+                                     'Connection required!')
+                    sys.exit(103)
+            elif current_jumpserver != jumpserver_hostname:
+                # Connect to jumphost, login and prompt detection are part of jump span.
+                with self._span('JUMP', jumpserver_hostname):
+                    status = self.host_connect(jumpserver_hostname,
+                                               connection_type=jumpserver.connection_settings['CONNECTION_TYPE'],
+                                               timeout=jumpserver.connection_settings['TIMEOUT'],
+                                               port=jumpserver.connection_settings['CONNECTION_PORT'],
+                                               expected_prompt=jumpserver.connection_settings['PROMPT'],
+                                               profile=jumpserver.connection_settings['PROFILE'])
 
                 self.ssh_command = jumpserver.connection_settings['SSH_COMMAND']
                 self.telnet_command = jumpserver.connection_settings['TELNET_COMMAND']
@@ -676,3 +1530,37 @@ class ConnectionAgent(object):
             self.fallback_prompt = jumpserver.connection_settings['PROMPT']
 
         logging.debug("Connected to all jumpservers!")
+
+    def _native_jump(self, jumpserver):
+        """
+        Function to add jumpserver to chain of native transport.
+
+        Args:
+            jumpserver: Device object of jumpserver (obj)
+
+        Returns:
+            int: Connection status.
+        """
+
+        settings = jumpserver.connection_settings
+
+        if settings['CONNECTION_TYPE'] != 'SSH':
+            logging.error("Jumpserver {} must use SSH with transport {}!".format(
+                jumpserver.name, self.transport.__class__.__name__))
+            return 101
+
+        user = self.am.get_username(jumpserver.name)
+        password = None
+        if self.am.get_password_type(jumpserver.name) == 'Fixed':
+            password = self.am.get_password(jumpserver.name, user)
+
+        self._wait_login(jumpserver.name)
+
+        try:
+            self.transport.add_jump(jumpserver.name, port=settings['CONNECTION_PORT'] or 22,
+                                    user=user, password=password, timeout=settings['TIMEOUT'])
+        except Exception as e:
+            logging.error("Could not connect to jumpserver {} ({})!".format(jumpserver.name, repr(e)))
+            return 200
+
+        return 100
@@ -5,9 +5,25 @@ There is an option to collect data via Jumpserver.
 Feature wish list: Stacking jumpservers.
 """
 
+import bz2
 import logging
 import datetime
-from utils import write_dict_to_json_file
+import difflib
+import gzip
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    # Python 2, no xz compression.
+    lzma = None
+from utils import dir_check, percentiles
 
 __author__ = "Thomas Jongerius"
 __copyright__ = "Copyright 2016, Thomas Jongerius"
@@ -19,6 +35,16 @@ __email__ = "thomasjongerius@yaworks.nl"
 __status__ = "Development"
 
 
+def to_text(output):
+    '''
+    Function to return output as text for JSON. Python 2 str and Python 3 bytes are decoded as UTF-8,
+    invalid bytes are replaced as devices do not always send UTF-8.
+    '''
+    if isinstance(output, bytes):
+        return output.decode('utf-8', 'replace')
+    return output
+
+
 class Device(object):
     '''
     Device object containing device settings.
@@ -29,10 +55,12 @@ class Device(object):
                  password=None, port=None,
                  prompt=None, timeout=10,
                  ssh=None, telnet=None,
-                 connection_type='SSH'):
+                 connection_type='SSH', profile=None, path=None, site=None):
 
         self.name = name
         self.ipv4 = ipv4
+        self.path = path  # Names of jumpservers to reach device, default path if not set (tuple)
+        self.site = site  # Site of device, hosts of a site share a circuit breaker (str)
 
         self.connection_settings = {
             "USERNAME": username,
@@ -42,25 +70,452 @@ class Device(object):
             "TELNET_COMMAND": telnet,
             "CONNECTION_PORT": port,
             "TIMEOUT": timeout,
-            "CONNECTION_TYPE": connection_type
+            "CONNECTION_TYPE": connection_type,
+            "PROFILE": profile
         }
 
+class MemoryStorage(object):
+    '''
+    Storage backend keeping command output in memory (default).
+    '''
+
+    location = None  # Nothing on disk, output is gone after the run (str)
+
+    def store(self, host, command, output):
+        '''
+        Function to store output. Returns entry for Host Manager.
+        '''
+        return {'OUTPUT': output}
+
+    def load(self, entry):
+        '''
+        Function to return output of entry.
+        '''
+        return entry['OUTPUT']
+
+    def close(self):
+        pass
+
+
+class DiskStorage(object):
+    '''
+    Storage backend writing command output to an append-only data file as it arrives.
+    Only offset and size are kept in memory, output is read back on export.
+    '''
+
+    def __init__(self, directory, filename='outputs.dat'):
+        dir_check(directory)
+
+        self.filename = os.path.join(directory, filename)
+        self.location = os.path.abspath(self.filename)  # Data file, entries point into it (str)
+        self.lock = threading.Lock()
+
+        self.data = open(self.filename, 'ab')
+        self.data.seek(0, os.SEEK_END)
+
+    def store(self, host, command, output):
+        '''
+        Function to write output to data file. Returns entry for Host Manager.
+        '''
+        if output is None:
+            return {'OFFSET': None, 'SIZE': 0}
+
+        if not isinstance(output, bytes):
+            output = output.encode('utf-8')
+
+        with self.lock:
+            offset = self.data.tell()
+            self.data.write(output)
+            self.data.flush()
+
+        return {'OFFSET': offset, 'SIZE': len(output)}
+
+    def load(self, entry):
+        '''
+        Function to read output of entry from data file.
+        '''
+        if entry['OFFSET'] is None:
+            return None
+
+        with open(self.filename, 'rb') as data:
+            data.seek(entry['OFFSET'])
+            return data.read(entry['SIZE'])
+
+    def close(self):
+        self.data.close()
+
+
+class ContentStorage(object):
+    '''
+    Storage backend storing output content-addressed. Every output is stored once under its
+    SHA-256 hash, entries only point at the hash. With delta enabled, changed output is stored
+    as line delta against the version of the previous run.
+
+    Layout: objects/<2 hex>/<hash> (zlib) and index.json with latest hash per host and command.
+    '''
+
+    MAX_DELTA_DEPTH = 16  # Deltas on top of deltas before output is stored in full again (int)
+
+    def __init__(self, directory, delta=False):
+        dir_check(directory)
+
+        self.directory = directory
+        self.location = os.path.abspath(directory)  # Objects and index, entries point into it (str)
+        self.delta = delta
+        self.lock = threading.Lock()
+        self.index_file = os.path.join(directory, 'index.json')
+
+        # Latest hash per host and command, previous run is compared against this (dict)
+        self.index = {}
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as index:
+                self.index = json.load(index)
+
+    def _object_path(self, digest):
+        return os.path.join(self.directory, 'objects', digest[:2], digest)
+
+    def _read_object(self, digest):
+        # Returns (output, delta depth).
+        with open(self._object_path(digest), 'rb') as obj:
+            data = zlib.decompress(obj.read())
+
+        header, _, body = data.partition(b'\n')
+        fields = header.split()
+        if fields[0] == b'full':
+            return body, 0
+
+        base, depth = self._read_object(fields[1].decode('ascii'))
+        return self._apply_delta(base, body), int(fields[2])
+
+    def _write_object(self, digest, data):
+        path = self._object_path(digest)
+        if os.path.exists(path):
+            return
+
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                # Created by other worker meanwhile.
+                pass
+
+        # Written to temporary file and renamed, object is complete or not there.
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as obj:
+            obj.write(zlib.compress(data))
+        os.rename(tmp, path)
+
+    @staticmethod
+    def _make_delta(base, output):
+        # '= i1 i2' copies base lines, '+ size' inserts size bytes following the line.
+        base_lines = base.splitlines(True)
+        lines = output.splitlines(True)
+        delta = []
+
+        matcher = difflib.SequenceMatcher(None, base_lines, lines, autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == 'equal':
+                delta.append('= {} {}\n'.format(i1, i2).encode('ascii'))
+            elif j2 > j1:
+                insert = b''.join(lines[j1:j2])
+                delta.append('+ {}\n'.format(len(insert)).encode('ascii'))
+                delta.append(insert)
+
+        return b''.join(delta)
+
+    @staticmethod
+    def _apply_delta(base, delta):
+        base_lines = base.splitlines(True)
+        output = []
+        pos = 0
+
+        while pos < len(delta):
+            end = delta.index(b'\n', pos)
+            op = delta[pos:end].split()
+            pos = end + 1
+
+            if op[0] == b'=':
+                output.extend(base_lines[int(op[1]):int(op[2])])
+            else:
+                output.append(delta[pos:pos + int(op[1])])
+                pos += int(op[1])
+
+        return b''.join(output)
+
+    def store(self, host, command, output):
+        '''
+        Function to store output once by hash. Returns entry for Host Manager.
+        '''
+        with self.lock:
+            previous = self.index.get(host, {}).get(command)
+
+        if output is None:
+            return {'HASH': None, 'PREVIOUS': previous}
+
+        if not isinstance(output, bytes):
+            output = output.encode('utf-8')
+
+        digest = hashlib.sha256(output).hexdigest()
+
+        if not os.path.exists(self._object_path(digest)):
+            data = b'full\n' + output
+
+            if self.delta and previous is not None and previous != digest:
+                try:
+                    base, depth = self._read_object(previous)
+                except (IOError, OSError, zlib.error):
+                    logging.warn("Previous output of {} '{}' not readable, storing in full.".format(host, command))
+                else:
+                    delta = self._make_delta(base, output)
+                    if depth < self.MAX_DELTA_DEPTH and len(delta) < len(output):
+                        data = 'delta {} {}\n'.format(previous, depth + 1).encode('ascii') + delta
+
+            self._write_object(digest, data)
+
+        with self.lock:
+            self.index.setdefault(host, {})[command] = digest
+
+        return {'HASH': digest, 'PREVIOUS': previous}
+
+    def load(self, entry):
+        '''
+        Function to read output of entry from object store.
+        '''
+        if entry['HASH'] is None:
+            return None
+
+        return self._read_object(entry['HASH'])[0]
+
+    @staticmethod
+    def changed(entry):
+        '''
+        Function to check if output of entry differs from previous run.
+        '''
+        return entry['HASH'] != entry['PREVIOUS']
+
+    def close(self):
+        # Index is replaced at once, previous index stays valid when interrupted.
+        with self.lock:
+            fd, tmp = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, 'w') as index:
+                json.dump(self.index, index)
+            os.rename(tmp, self.index_file)
+
+
+class RunJournal(object):
+    '''
+    Append-only journal of a collection run. Every stored command output is recorded as
+    one JSON line with its storage entry, so an interrupted run can be resumed. Output itself
+    is never journaled, output kept in memory (MemoryStorage) is collected again on resume.
+    '''
+
+    def __init__(self, directory, run_id=None, storage=None):
+        '''
+        Run journal.
+
+        Args:
+            directory: Directory to keep journals in (str)
+            run_id: ID of run to resume, new run when not set (str)
+            storage: Storage backend the entries belong to (obj)
+        '''
+        dir_check(directory)
+
+        self.run_id = run_id or datetime.datetime.now().strftime('%Y%m%dT%H%M%S')
+        self.filename = os.path.join(directory, '{}.journal'.format(self.run_id))
+        self.storage_type = storage.__class__.__name__ if storage is not None else 'MemoryStorage'
+        self.storage_location = storage.location if storage is not None else None
+        self.lock = threading.Lock()
+
+        self.entries = self._read() if run_id else []  # Completed (host, command, entry) of run (lst)
+
+        self.journal = open(self.filename, 'a')
+        self.journal.seek(0, os.SEEK_END)
+        if not self.entries and self.journal.tell() == 0:
+            self._append({'RUN_ID': self.run_id, 'STORAGE': self.storage_type, 'LOCATION': self.storage_location})
+
+    def _read(self):
+        if not os.path.exists(self.filename):
+            logging.critical("No journal found for run {} ({})!".format(self.run_id, self.filename))
+            sys.exit(10)
+
+        entries = []
+        with open(self.filename) as journal:
+            for line in journal:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Last line is incomplete when run was killed while writing.
+                    logging.warn("Skipping incomplete journal line of run {}.".format(self.run_id))
+                    continue
+
+                if 'RUN_ID' in record:
+                    if record['STORAGE'] != self.storage_type:
+                        logging.critical("Run {} was stored with {}, resume with same storage!".format(
+                            self.run_id, record['STORAGE']))
+                        sys.exit(10)
+                    # Entries are offsets or hashes, only valid in the storage they were written to.
+                    if record.get('LOCATION') != self.storage_location:
+                        logging.critical("Run {} was stored in {}, resume with same storage location!".format(
+                            self.run_id, record.get('LOCATION')))
+                        sys.exit(10)
+                    continue
+
+                entries.append((record['HOST'], record['COMMAND'], record['ENTRY']))
+
+        if self.storage_type == 'MemoryStorage':
+            logging.warn("Run {} kept output in memory, {} commands are collected again.".format(
+                self.run_id, len(entries)))
+            return []
+
+        logging.info("Resuming run {}, {} commands already collected.".format(self.run_id, len(entries)))
+        return entries
+
+    def _append(self, record):
+        with self.lock:
+            self.journal.write(json.dumps(record) + '\n')
+            self.journal.flush()
+
+    def record(self, host, command, entry):
+        '''
+        Function to record stored output of command, by storage reference only.
+        '''
+        entry = dict((k, v) for k, v in entry.items() if k != 'OUTPUT')
+        self._append({'HOST': to_text(host), 'COMMAND': to_text(command), 'ENTRY': entry})
+
+    def close(self):
+        self.journal.close()
+
+
+class NDJSONExporter(object):
+    '''
+    Exporter writing one compact JSON record per host and command as output arrives.
+    Compressed by extension of filename (.gz, .bz2, .xz). Flushed periodically, so
+    the file can be followed while collecting (zcat for gzip).
+    '''
+
+    def __init__(self, filename, flush_every=100, flush_interval=5):
+        '''
+        NDJSON exporter.
+
+        Args:
+            filename: File to write records to (str)
+            flush_every: Records written before flushing (int)
+            flush_interval: Seconds before records written are flushed, also when no more arrive (int)
+        '''
+        logging.debug("Streaming NDJSON output to {}...".format(filename))
+        if os.path.exists(filename):
+            logging.warn("File {} already exists. Will be overwritten!".format(filename))
+
+        self.filename = filename
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+
+        self._pending = 0  # Records written since last flush (int)
+        self._closed = threading.Event()  # Set by close(), stops flusher (obj)
+
+        if filename.endswith('.gz'):
+            self.output = gzip.open(filename, 'wb')
+        elif filename.endswith('.bz2'):
+            self.output = bz2.BZ2File(filename, 'wb')
+        elif filename.endswith('.xz'):
+            if lzma is None:
+                logging.critical("No lzma library available, xz compression not supported!")
+                sys.exit(101)
+            self.output = lzma.open(filename, 'wb')
+        else:
+            self.output = open(filename, 'wb')
+
+        # Records of a collector waiting on slow hosts are flushed by timer, not by the next write.
+        self._flusher = threading.Thread(target=self._flush_periodically, name='NDJSONFlusher')
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def write(self, host, command, entry, output):
+        '''
+        Function to write record of command output.
+        '''
+        record = {'HOST': host, 'COMMAND': command, 'OUTPUT': to_text(output), 'TIMESTAMP': entry['TIMESTAMP']}
+        if 'HASH' in entry:
+            record['HASH'] = entry['HASH']
+
+        self._write(record)
+
+    def write_parsed(self, host, command, parsed):
+        '''
+        Function to write record of structured data parsed after collection.
+        '''
+        self._write({'HOST': host, 'COMMAND': command, 'PARSED': parsed})
+
+    def write_spans(self, host, spans):
+        '''
+        Function to write record of timing spans of host.
+        '''
+        self._write({'HOST': host, 'SPANS': spans})
+
+    def _write(self, record):
+        line = (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8')
+
+        with self.lock:
+            self.output.write(line)
+            self._pending += 1
+
+            if self._pending >= self.flush_every:
+                self._flush()
+
+    def _flush(self):
+        # Caller holds lock. BZ2File of Python 2 cannot flush, bzip2 blocks are written when full.
+        if self._pending and hasattr(self.output, 'flush'):
+            self.output.flush()
+        self._pending = 0
+
+    def _flush_periodically(self):
+        while not self._closed.wait(self.flush_interval):
+            with self.lock:
+                if not self._closed.is_set():
+                    self._flush()
+
+    def close(self):
+        '''
+        Function to flush and close file. Closing again does nothing.
+        '''
+        with self.lock:
+            if self._closed.is_set():
+                return
+            self._closed.set()
+            self._flush()
+            self.output.close()
+
+
 class HostManagment(Device):
     '''
     Host Manager to keep data for hosts. Export, and import data.
     '''
 
-    def __init__(self, prefix=None, postfix='.log'):
+    def __init__(self, prefix=None, postfix='.log', storage=None, journal=None, exporter=None):
         super(Device, self).__init__()
 
         self.hm = {}
         self.prefix = prefix
         self.postfix = postfix
+        self.lock = threading.RLock()  # Lock for adding data from multiple workers (obj)
+        self.storage = storage if storage is not None else MemoryStorage()  # Output storage backend (obj)
+        self.journal = journal  # Run journal to record and resume collected commands (obj)
+        self.exporter = exporter  # Exporter writing records as output arrives (obj)
+        self.spans = {}  # Timing spans of collection phases per host (dict)
 
-    def add_host(self, host, **kwargs):
-        self.hm[host] = {}
+        # Output of resumed run is exported together with new output.
+        if self.journal is not None:
+            for host, command, entry in self.journal.entries:
+                self.hm.setdefault(host, {'SETTINGS': Device(host)})[command] = entry
+                if self.exporter is not None:
+                    self.exporter.write(host, command, entry, self.storage.load(entry))
 
-        d = Device(host)
+    def add_host(self, host, device=None, **kwargs):
+        '''
+        Function to add host, with Device of inventory when known.
+        '''
+        d = device if device is not None else Device(host)
 
         if kwargs:
             if 'ipv4' in kwargs:
@@ -70,30 +525,161 @@ class HostManagment(Device):
             if 'timeout' in kwargs:
                 d.connection_settings['TIMEOUT'] = kwargs['timeout']
 
-        self.hm[host]['SETTINGS'] = d
+        with self.lock:
+            # Commands of resumed run are kept.
+            self.hm.setdefault(host, {})['SETTINGS'] = d
 
     def add_command(self, host, command, output=None):
         '''
         Function to add command to host and timestamp of output retrieval.
         '''
-        if host not in self.hm:
-            self.add_host(host)
+        entry = self.storage.store(host, command, output)
+        entry['TIMESTAMP'] = str(datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S'))
+
+        with self.lock:
+            if host not in self.hm:
+                self.add_host(host)
+
+            self.hm[host][command] = entry
+
+        if self.journal is not None:
+            self.journal.record(host, command, entry)
+        if self.exporter is not None:
+            self.exporter.write(host, command, entry, output)
+
+    def add_parsed(self, host, command, parsed):
+        '''
+        Function to add structured data parsed from output of command. Stored as JSON
+        in the storage backend, only the entry is kept.
+        '''
+        entry = self.storage.store(host, '{} (parsed)'.format(command), json.dumps(parsed))
+
+        with self.lock:
+            self.hm[host][command]['PARSED'] = entry
+
+        if self.exporter is not None:
+            self.exporter.write_parsed(host, command, parsed)
+
+    def add_spans(self, host, spans):
+        '''
+        Function to add timing spans of collection phases to host.
+        '''
+        if not spans:
+            return
+
+        with self.lock:
+            self.spans.setdefault(host, []).extend(spans)
+
+        if self.exporter is not None:
+            self.exporter.write_spans(host, spans)
+
+    def timing_summary(self):
+        '''
+        Function to summarise timing spans of all hosts per phase, and per jumpserver
+        or command within a phase.
+
+        Returns:
+            dict: Phase -> COUNT, TOTAL, P50, P95, P99 and NAMES (name -> same statistics).
+        '''
+        def statistics(values):
+            p = percentiles(values)
+            return {'COUNT': len(values), 'TOTAL': round(sum(values), 6),
+                    'P50': p[50], 'P95': p[95], 'P99': p[99]}
+
+        phases = {}
+        names = {}
+
+        with self.lock:
+            for spans in self.spans.values():
+                for span in spans:
+                    phases.setdefault(span['PHASE'], []).append(span['SECONDS'])
+                    if 'NAME' in span:
+                        names.setdefault(span['PHASE'], {}).setdefault(span['NAME'], []).append(span['SECONDS'])
+
+        summary = {}
+        for phase, values in phases.items():
+            summary[phase] = statistics(values)
+            if phase in names:
+                summary[phase]['NAMES'] = dict((name, statistics(v)) for name, v in names[phase].items())
+
+        return summary
+
+    def pending_commands(self, host, commands):
+        '''
+        Function to return commands not collected yet for host.
+        '''
+        with self.lock:
+            collected = self.hm.get(host, {})
+            return [c for c in commands if c not in collected]
 
-        self.hm[host][command] = {'OUTPUT': output,
-                                  'TIMESTAMP': str(datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S'))}
+    def get_commands(self, host):
+        '''
+        Function to return commands collected for host.
+        '''
+        return [c for c in self.hm[host] if c != 'SETTINGS']
+
+    def get_output(self, host, command):
+        '''
+        Function to return output of command, read from storage backend.
+        '''
+        return self.storage.load(self.hm[host][command])
+
+    def get_parsed(self, host, command):
+        '''
+        Function to return structured data parsed from output of command, read from storage backend.
+        '''
+        return json.loads(to_text(self.storage.load(self.hm[host][command]['PARSED'])))
+
+    def export_host(self, host):
+        '''
+        Function to return dict with settings and output for host. Output is loaded from storage.
+        '''
+        d = self.hm[host]['SETTINGS']
+
+        settings = dict((k, v) for k, v in d.connection_settings.items() if k != 'PASSWORD')
+        settings['NAME'] = d.name
+        settings['IPV4'] = d.ipv4
+
+        host_export = {'SETTINGS': settings}
+        if host in self.spans:
+            host_export['SPANS'] = self.spans[host]
+
+        for command in self.get_commands(host):
+            host_export[command] = {'OUTPUT': to_text(self.get_output(host, command)),
+                                    'TIMESTAMP': self.hm[host][command]['TIMESTAMP']}
+            if 'HASH' in self.hm[host][command]:
+                host_export[command]['HASH'] = self.hm[host][command]['HASH']
+            if 'PARSED' in self.hm[host][command]:
+                host_export[command]['PARSED'] = self.get_parsed(host, command)
+
+        return host_export
 
     def write_to_json(self, filename):
         logging.debug("Writing JSON output to {}...".format(filename))
-        write_dict_to_json_file(filename, self.hm, indent=2)
+        if os.path.exists(filename):
+            logging.warn("File {} already exists. Will be overwritten!".format(filename))
+
+        # Written per host, only output of one host is loaded at a time.
+        with open(filename, 'w') as outfile:
+            outfile.write('{')
+            for n, host in enumerate(self.hm):
+                if n > 0:
+                    outfile.write(',')
+                outfile.write('\n{}: '.format(json.dumps(host)))
+                json.dump(self.export_host(host), outfile, indent=2)
+            outfile.write('\n}\n')
 
     def write_to_txt_files(self, output_dir):
         logging.debug("Writing files to {}...".format(output_dir))
         for host in self.hm:
             logging.debug("Writing files for {}...".format(host))
-            for command in self.hm[host]:
+            for command in self.get_commands(host):
                 logging.debug("Command: {}".format(command))
+                output = self.get_output(host, command)
+                if output is None:
+                    continue
                 self.create_file(host=host, command=command,
-                                 output=self.hm[host][command]['OUTPUT'],
+                                 output=output,
                                  output_dir=output_dir)
 
     def create_file(self, host, output, output_dir, sep='_', command=None, timestamp=None):
@@ -0,0 +1,155 @@
+#!/usr/bin/env python -tt
+"""
+Inventory Manager library for reading device inventories.
+Inventories are read lazily, one Device at a time, so large inventories are never held in memory.
+
+Supported formats (by extension):
+    .csv            Header with columns name, ipv4, port, prompt, connection_type, timeout, profile, path, site.
+    .jsonl/.ndjson  One JSON object per line with the same keys.
+    other           One hostname per line (device list), '#' starts a comment.
+Only name is required. Settings not given fall back to the settings of the ConnectionAgent,
+path (jumpservers separated by spaces, commas or semicolons) falls back to SETTINGS.PATH.
+"""
+
+import csv
+import json
+import logging
+import os
+import re
+
+from HostManager import Device
+
+__author__ = "Thomas Jongerius"
+__copyright__ = "Copyright 2016, Thomas Jongerius"
+__credits__ = ["Thomas Jongerius", "Alan Holt"]
+__license__ = "GPL"
+__version__ = "0.1"
+__maintainer__ = "Thomas Jongerius"
+__email__ = "thomasjongerius@yaworks.nl"
+__status__ = "Development"
+
+# Inventory columns and conversion of their values.
+COLUMNS = {'name': str,
+           'ipv4': str,
+           'port': int,
+           'prompt': str,
+           'connection_type': lambda v: v.upper(),
+           'timeout': int,
+           'profile': lambda v: v.upper(),
+           'path': lambda v: tuple(v) if isinstance(v, list) else tuple(re.split(r'[\s,;]+', v)),
+           'site': str}
+
+
+def make_device(record, line=None):
+    """
+    Function to create Device from inventory record. Unknown columns are ignored.
+
+    Args:
+        record: Column -> value, empty values are not set (dict)
+        line: Line in inventory, for logging (int)
+
+    Returns:
+        object: Device, None when record has no name.
+    """
+
+    settings = dict((k, None) for k in COLUMNS)
+
+    for key, value in record.items():
+        key = key.strip().lower()
+        if key not in COLUMNS or value is None or value == '':
+            continue
+        try:
+            settings[key] = COLUMNS[key](value.strip() if hasattr(value, 'strip') else value)
+        except ValueError:
+            logging.error("Invalid {} '{}' in inventory line {}, ignored!".format(key, value, line))
+
+    if not settings['name']:
+        logging.error("No name in inventory line {}, skipping!".format(line))
+        return None
+
+    return Device(settings['name'],
+                  ipv4=settings['ipv4'],
+                  port=settings['port'],
+                  prompt=settings['prompt'],
+                  connection_type=settings['connection_type'],
+                  timeout=settings['timeout'],
+                  profile=settings['profile'],
+                  path=settings['path'],
+                  site=settings['site'])
+
+
+def _records(inventory, fmt):
+    # Yields (line, record) of inventory file.
+    if fmt == 'CSV':
+        reader = csv.DictReader(inventory)
+        for record in reader:
+            yield reader.line_num, record
+    elif fmt == 'JSONL':
+        for line, data in enumerate(inventory, 1):
+            if not data.strip():
+                continue
+            try:
+                yield line, json.loads(data)
+            except ValueError:
+                logging.error("Invalid JSON in inventory line {}, skipping!".format(line))
+    else:
+        for line, data in enumerate(inventory, 1):
+            data = data.split('#', 1)[0].strip()
+            if data:
+                yield line, {'name': data}
+
+
+def read_inventory(filename, fmt=None):
+    """
+    Function to read inventory lazily. File is opened right away, so I/O errors are raised
+    by this call and not halfway through a run.
+
+    Args:
+        filename: Inventory file (str)
+        fmt: Format [CSV || JSONL || TEXT], detected by extension when not set (str)
+
+    Returns:
+        generator: Device objects.
+    """
+
+    if fmt is None:
+        extension = os.path.splitext(filename)[1].lower()
+        fmt = {'.csv': 'CSV', '.jsonl': 'JSONL', '.ndjson': 'JSONL'}.get(extension, 'TEXT')
+
+    inventory = open(filename)
+
+    def devices():
+        with inventory:
+            for line, record in _records(inventory, fmt):
+                device = make_device(record, line)
+                if device is not None:
+                    yield device
+
+    return devices()
+
+
+def address(device):
+    """
+    Function to return address to connect to, IP if known, otherwise name.
+    """
+
+    return device.ipv4 or device.name
+
+
+def port(device, connection_type='SSH'):
+    """
+    Function to return port to connect to, port of device or default port of its connection type.
+
+    Args:
+        device: Device of inventory (obj)
+        connection_type: Connection type of devices without one [SSH || TELNET] (str)
+
+    Returns:
+        int: TCP port.
+    """
+
+    settings = device.connection_settings
+    if settings['CONNECTION_PORT']:
+        return int(settings['CONNECTION_PORT'])
+
+    return 23 if (settings['CONNECTION_TYPE'] or connection_type).upper() == 'TELNET' else 22
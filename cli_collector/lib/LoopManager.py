@@ -0,0 +1,725 @@
+#!/usr/bin/env python -tt
+"""
+Loop Manager library for collecting data from many hosts in a single thread.
+
+Sessions are generators yielding what they wait for: Expect (patterns on a spawn) or Sleep.
+SessionLoop polls the spawns of all sessions and resumes a session as soon as one of its
+patterns matched or its timeout passed, so one OS thread drives all device sessions instead
+of a worker thread per jump chain. Sessions yield generators to run sub-steps and Return to
+hand back a value (generators of Python 2 cannot return values).
+Only the PEXPECT transport is supported, its spawns are ptys that can be polled.
+"""
+
+import logging
+import re
+import select
+import sys
+import time
+import types
+
+import pexpect
+from pexpect.expect import Expecter, searcher_re, searcher_string
+
+import TransportManager
+from ConnectionManager import ConnectionHandler, LoginStateMachine
+from HostManager import Device
+
+__author__ = "Thomas Jongerius"
+__copyright__ = "Copyright 2016, Thomas Jongerius"
+__credits__ = ["Thomas Jongerius", "Alan Holt"]
+__license__ = "GPL"
+__version__ = "0.1"
+__maintainer__ = "Thomas Jongerius"
+__email__ = "thomasjongerius@yaworks.nl"
+__status__ = "Development"
+
+
+class SessionError(Exception):
+    """
+    Session lost its prompt, state of the jump chain is unknown.
+    """
+
+
+class Return(object):
+    """
+    Value of a sub-step, yielded as last value of its generator.
+    """
+
+    def __init__(self, value=None):
+        self.value = value
+
+
+class Sleep(object):
+    """
+    Request of a session to be resumed after seconds.
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.deadline = time.time() + seconds
+
+
+class Expect(object):
+    """
+    Request of a session to wait for one of patterns on spawn. The session is resumed with the
+    index of the matched pattern, spawn before and after are set as by expect_list() and expect_exact().
+    """
+
+    def __init__(self, spawn, patterns, timeout, exact=False, searchwindowsize=None):
+        """
+        Expect request.
+
+        Args:
+            spawn: pexpect spawn (obj)
+            patterns: Compiled patterns, or strings when exact, with pexpect.TIMEOUT or pexpect.EOF (lst)
+            timeout: Seconds to wait, None waits forever (float)
+            exact: Patterns are plain strings, as expect_exact() (bool)
+            searchwindowsize: Only search this many characters at the end of the buffer (int)
+        """
+
+        self.spawn = spawn
+        self.deadline = None if timeout is None else time.time() + timeout
+
+        searcher = searcher_string(patterns) if exact else searcher_re(patterns)
+        self.expecter = Expecter(spawn, searcher, searchwindowsize)
+
+
+class SessionLoop(object):
+    """
+    Poll loop running sessions in the calling thread.
+    """
+
+    def __init__(self):
+        self.poller = select.poll()
+        self.reading = {}  # fd -> session waiting for data (dict)
+        self.sleeping = []  # Sessions waiting for Sleep or timeout without spawn data (lst)
+
+    def run(self, sessions):
+        """
+        Function to run sessions until all have finished.
+
+        Args:
+            sessions: Generators of sessions (lst)
+        """
+
+        for session in sessions:
+            self._resume([session], None)
+
+        while self.reading or self.sleeping:
+            self._poll()
+
+    def _poll(self):
+        waiting = list(self.reading.values()) + self.sleeping
+        deadlines = [request.deadline for stack, request in waiting if request.deadline is not None]
+
+        timeout = None
+        if deadlines:
+            timeout = max(0, min(deadlines) - time.time()) * 1000
+
+        for fd, event in self.poller.poll(timeout):
+            if fd in self.reading:
+                self._read(fd)
+
+        # Timeouts, sessions resumed meanwhile wait for another request or not at all.
+        now = time.time()
+        for stack, request in waiting:
+            if request.deadline is None or request.deadline > now:
+                continue
+            if isinstance(request, Sleep):
+                self.sleeping = [s for s in self.sleeping if s[1] is not request]
+                self._resume(stack, None)
+            elif self.reading.get(request.spawn.child_fd, (None, None))[1] is request:
+                self._unwait(request.spawn.child_fd)
+                self._call(stack, request.expecter.timeout)
+
+    def _read(self, fd):
+        stack, request = self.reading[fd]
+        spawn = request.spawn
+
+        try:
+            data = spawn.read_nonblocking(spawn.maxread, timeout=0)
+        except pexpect.TIMEOUT:
+            return
+        except pexpect.EOF as e:
+            self._unwait(fd)
+            self._call(stack, request.expecter.eof, e)
+            return
+        except Exception:
+            self._unwait(fd)
+            self._resume(stack, None, sys.exc_info())
+            return
+
+        index = request.expecter.new_data(data)
+        if index is not None:
+            self._unwait(fd)
+            self._resume(stack, index)
+
+    def _unwait(self, fd):
+        del self.reading[fd]
+        self.poller.unregister(fd)
+
+    def _call(self, stack, func, *args):
+        # Resumes session with result of func, or its exception (pexpect.TIMEOUT, pexpect.EOF).
+        try:
+            index = func(*args)
+        except Exception:
+            self._resume(stack, None, sys.exc_info())
+        else:
+            self._resume(stack, index)
+
+    def _resume(self, stack, value, error=None):
+        """
+        Function to resume top generator of session stack until it waits or finishes.
+        """
+
+        while stack:
+            generator = stack[-1]
+            try:
+                if error is not None:
+                    request = generator.throw(*error)
+                else:
+                    request = generator.send(value)
+            except StopIteration:
+                request = Return()
+            except Exception:
+                # Exception is passed to the calling step.
+                stack.pop()
+                value, error = None, sys.exc_info()
+                continue
+
+            value, error = None, None
+
+            if isinstance(request, types.GeneratorType):
+                stack.append(request)
+            elif isinstance(request, Return):
+                generator.close()
+                stack.pop()
+                value = request.value
+            elif isinstance(request, Sleep):
+                self.sleeping.append((stack, request))
+                return
+            elif isinstance(request, Expect):
+                # Output already received may match right away.
+                index = request.expecter.existing_data()
+                if index is not None:
+                    value = index
+                    continue
+                fd = request.spawn.child_fd
+                self.reading[fd] = (stack, request)
+                self.poller.register(fd, select.POLLIN)
+                return
+            else:
+                value, error = None, (TypeError, TypeError("Session yielded {}".format(repr(request))), None)
+
+        if error is not None:
+            logging.error("Session stopped by error: {}".format(repr(error[1])))
+
+
+class LoopAgent(object):
+    """
+    Connection agent of a session on a SessionLoop. Builds the jump chain and collects hosts
+    like ConnectionAgent, but every method that waits is a generator to be run on the loop.
+    Login and logout use the state machine (LoginStateMachine) of ConnectionAgent.
+    """
+
+    def __init__(self, am,
+                 client_connection_type='SSH',
+                 ssh_command='ssh USER@HOST -p PORT',
+                 telnet_command='telnet HOST:PORT',
+                 timeout=10,
+                 jumpservers=None,
+                 max_retry=5,
+                 profile='IOS',
+                 large_output=None,
+                 large_maxread=65536,
+                 timeouts=None):
+        """
+        Loop agent, not connected until connect_jumpserver() ran. Arguments as ConnectionAgent.
+        """
+
+        self.prompt = None  # Spawn of jump chain (obj)
+        self.ch = ConnectionHandler(profile=profile)
+        self.current_profile = self.ch.profile
+        self.am = am
+        self.transport = TransportManager.PexpectTransport(timeout=timeout)
+
+        self.ssh_command = ssh_command
+        self.telnet_command = telnet_command
+        self.timeout = timeout
+        self.max_retry = max_retry
+        self.jumpservers = jumpservers or []
+        self.conn_type = client_connection_type
+        self.large_output = [' '.join(c.split()) for c in large_output or []]
+        self.large_maxread = large_maxread
+        self.timeouts = timeouts
+
+        self.current_prompt = None
+        self.fallback_prompt = None
+        self.fallback_jumpserver_name = 'localhost'
+        self.current_connected_host = 'localhost'
+        self.last_timings = []
+        self.spans = []
+
+    def _add_span(self, phase, seconds, name=None):
+        span = {'PHASE': phase, 'SECONDS': round(seconds, 6)}
+        if name is not None:
+            span['NAME'] = name
+        self.spans.append(span)
+
+    def pop_spans(self):
+        spans, self.spans = self.spans, []
+        return spans
+
+    def _timeout(self, key, host=None, default=None):
+        if default is None:
+            default = self.timeout
+        if self.timeouts is None:
+            return default
+        return self.timeouts.timeout(host or self.current_connected_host, ' '.join(key.split()), default)
+
+    def _observe(self, key, seconds, host=None):
+        if self.timeouts is not None:
+            self.timeouts.observe(host or self.current_connected_host, ' '.join(key.split()), seconds)
+
+    def is_large_output(self, command):
+        command = ' '.join(command.split())
+        return any(command.startswith(prefix) for prefix in self.large_output)
+
+    def _steps(self, steps):
+        # Runs (patterns, timeout) steps of LoginStateMachine on the loop.
+        try:
+            patterns, timeout = next(steps)
+            while True:
+                patterns, timeout = steps.send((yield Expect(self.prompt, patterns, timeout)))
+        except StopIteration:
+            pass
+
+    def connect_jumpserver(self):
+        """
+        Step connecting to all jumpservers of agent.
+
+        Returns:
+            int: Status (100 connected, 103 jumpserver connection failed).
+        """
+
+        for jumpserver in self.jumpservers:
+            settings = jumpserver.connection_settings
+            start = time.time()
+            status = yield self.host_connect(jumpserver.name,
+                                             connection_type=settings['CONNECTION_TYPE'],
+                                             timeout=settings['TIMEOUT'],
+                                             port=settings['CONNECTION_PORT'],
+                                             expected_prompt=settings['PROMPT'],
+                                             profile=settings['PROFILE'],
+                                             jump=True)
+            self._add_span('JUMP', time.time() - start, jumpserver.name)
+
+            if status != 100:
+                logging.critical('Jumpserver {} connection unsuccessful!'.format(jumpserver.name))
+                yield Return(103)
+
+            self.ssh_command = settings['SSH_COMMAND']
+            self.telnet_command = settings['TELNET_COMMAND']
+            self.fallback_jumpserver_name = jumpserver.name
+            self.fallback_prompt = settings['PROMPT']
+
+        yield Return(100)
+
+    def host_connect(self, host, connection_type=None, timeout=None, expected_prompt=None,
+                     port=None, profile=None, jump=False):
+        """
+        Step connecting to host, login and prompt detection. See ConnectionAgent.host_connect().
+
+        Returns:
+            int: Status (100 connected, 101 priv mode, 200 failed, 300 unknown, jump chain lost).
+        """
+
+        connection_type = connection_type or self.conn_type
+        self.current_profile = profile or self.ch.profile
+        timeout = self._timeout('LOGIN', host, default=timeout or self.timeout)
+
+        if connection_type not in ('SSH', 'TELNET'):
+            logging.error("Other connection types not yet supported ({})!".format(connection_type))
+            yield Return(200)
+        if port is None:
+            port = 22 if connection_type == 'SSH' else 23
+
+        user = self.am.get_username(host)
+        password = self.am.get_password(host, user)
+
+        # Login rate limit is waited for on the loop, other sessions continue.
+        waited = self.am.acquire_login(host, site=self.fallback_jumpserver_name, block=False)
+        if waited > 0:
+            self._add_span('LOGIN_WAIT', waited, host)
+            yield Sleep(waited)
+
+        cmd = self.ssh_command.replace('USER', user) if connection_type == 'SSH' else self.telnet_command
+        cmd = cmd.replace('HOST', host).replace('PORT', str(port))
+        logging.debug("Connecting using '{}' command...".format(cmd))
+
+        start = time.time()
+        self.prompt = self.transport.open(host, cmd, timeout=timeout)
+        sm = LoginStateMachine(self, host, user=user, password=password, expected_prompt=expected_prompt,
+                               timeout=timeout, max_retry=self.max_retry)
+        yield self._steps(sm.login_steps())
+        status = sm.status
+        self.last_timings = sm.timings
+        if status == 100:
+            self._observe('LOGIN', time.time() - start, host)
+        if not jump:
+            self._add_span('LOGIN', time.time() - start)
+
+        if status == 100:
+            start = time.time()
+            status = yield self.prompt_detect(host, expected_prompt=expected_prompt)
+            if not jump:
+                self._add_span('PROMPT_DETECT', time.time() - start)
+
+        if status in (100, 101):
+            self.current_connected_host = host
+            yield Return(status)
+
+        logging.error('Could not connect to {} (status: {}).'.format(host, status))
+        if self.fallback_prompt is None:
+            yield Return(200)
+
+        # Host closed session itself (login denied) when jumpserver prompt returns.
+        self.prompt.sendline()
+        response = yield Expect(self.prompt, self.ch.get_patterns(self.fallback_prompt, eof=True), self.timeout)
+        if response == 0:
+            yield Return(200)
+
+        self.current_connected_host = host
+        status = yield self.disconnect_host()
+        yield Return(200 if status == 100 else 300)
+
+    def prompt_detect(self, host, expected_prompt=None):
+        """
+        Step detecting prompt of host. See ConnectionAgent.prompt_detect().
+
+        Returns:
+            int: Status (100 prompt, 101 priv mode prompt, 200 no prompt).
+        """
+
+        handlers = self.ch.get_handlers(expected_prompt, profile=self.current_profile)
+        timeout = self._timeout('PROMPT_DETECT', host)
+        start = time.time()
+        status = 200
+
+        self.prompt.sendline()
+        for attempt in range(2):
+            response = yield Expect(self.prompt, handlers, timeout)
+
+            if response == 0 or (response == 5 and expected_prompt is not None):
+                status = 100
+            elif response == 6:
+                logging.warn("Privilege mode prompt received!")
+                status = 101
+            elif response == 1:
+                logging.debug("Action timed out, retry ({} out of 2).".format(attempt + 1))
+                self.prompt.sendline()
+                continue
+            else:
+                logging.error("Unexpected response while detecting prompt of {} ({})!".format(
+                    host, self.ch.events[response]))
+            break
+
+        if status in (100, 101):
+            self._observe('PROMPT_DETECT', time.time() - start, host)
+            self.current_prompt = self.prompt.after.splitlines()[-1].strip()
+            logging.debug("Detected prompt '{}'!".format(self.current_prompt))
+
+        yield Return(status)
+
+    def _expect_output(self, markers, key, searchwindowsize=None):
+        # Same as ConnectionAgent._expect_output(), returns index of marker, len(markers) on timeout.
+        timeout = self._timeout(key)
+        start = time.time()
+        received = 0
+
+        while True:
+            response = yield Expect(self.prompt, markers + [pexpect.TIMEOUT], timeout, exact=True,
+                                    searchwindowsize=searchwindowsize)
+
+            if response < len(markers):
+                self._observe(key, time.time() - start)
+                yield Return(response)
+
+            if self.timeouts is None or len(self.prompt.before) == received \
+                    or time.time() - start >= self.timeouts.ceiling:
+                yield Return(response)
+
+            received = len(self.prompt.before)
+            logging.debug("Command {} is still returning output after {:.1f}s, waiting.".format(
+                key, time.time() - start))
+
+    def cisco_term_len(self):
+        """
+        Step setting terminal length for Cisco devices.
+        """
+
+        start = time.time()
+        self.prompt.sendline('terminal length 0')
+        response = yield self._expect_output([self.current_prompt], 'TERM_LEN')
+        self._add_span('TERM_LEN', time.time() - start)
+
+        if response != 0:
+            raise SessionError("No prompt after terminal length on {}!".format(self.current_connected_host))
+
+    def send_commands(self, commands, batch_size=0):
+        """
+        Step sending commands, batch_size at once (pipelined, see ConnectionAgent.send_commands())
+        or one by one. Commands have been validated by the caller.
+
+        Returns:
+            list: (command, output) in order of commands.
+        """
+
+        outputs = []
+        batch_size = max(1, batch_size)
+
+        pending = []
+        for command in list(commands) + [None]:
+            if command is not None and batch_size > 1 and not self.is_large_output(command):
+                pending.append(command)
+                continue
+
+            for n in range(0, len(pending), batch_size):
+                outputs.extend((yield self._send_batch(pending[n:n + batch_size])))
+            pending = []
+
+            if command is not None:
+                outputs.extend((yield self._send_batch([command])))
+
+        yield Return(outputs)
+
+    def _send_batch(self, batch):
+        start = time.time()
+        for command in batch:
+            self.prompt.sendline(command)
+
+        outputs = []
+        for n, command in enumerate(batch):
+            # Device echoes next command after prompt when it reads it from typeahead.
+            marker = self.current_prompt + batch[n + 1] if n + 1 < len(batch) else self.current_prompt
+
+            maxread = self.prompt.maxread
+            window = None
+            if self.is_large_output(command):
+                # Big reads, only the tail is scanned for the prompt.
+                self.prompt.maxread = self.large_maxread
+                window = self.large_maxread + len(marker)
+            try:
+                response = yield self._expect_output([marker], command, searchwindowsize=window)
+            finally:
+                self.prompt.maxread = maxread
+
+            self._add_span('COMMAND', time.time() - start, command)
+            start = time.time()
+
+            if response != 0:
+                raise SessionError("No prompt after {} on {}!".format(command, self.current_connected_host))
+
+            logging.info("Command {} executed!".format(command))
+            # Echo of command is consumed by previous marker, add for same output as one by one.
+            outputs.append((command, self.prompt.before if n == 0 else command + self.prompt.before))
+
+        yield Return(outputs)
+
+    def disconnect_host(self):
+        """
+        Step falling back to prompt of last jumpserver.
+
+        Returns:
+            int: Status (100 fallen back, 200 failed).
+        """
+
+        start = time.time()
+        sm = LoginStateMachine(self, self.current_connected_host)
+        yield self._steps(sm.logout_steps(self.fallback_prompt))
+        self.last_timings = sm.timings
+        self._add_span('DISCONNECT', time.time() - start)
+
+        if sm.status == 100:
+            self.current_connected_host = None
+
+        yield Return(sm.status)
+
+    def close(self):
+        self.transport.close()
+        self.prompt = None
+
+
+class LoopPool(object):
+    """
+    Sessions collecting hosts on one SessionLoop. Every session builds a jump chain and collects
+    hosts one after another over it, like a worker of WorkerPool without a thread of its own.
+    Sessions take turns on the inventory, a session rebuilds its chain when the jump path changes.
+    """
+
+    def __init__(self, agent_factory, hm, jumpservers, default_path=(), sessions=16, pipeline=0,
+                 max_sessions=None, max_startups=None):
+        """
+        Loop pool.
+
+        Args:
+            agent_factory: Callable returning a LoopAgent, takes jumpservers (func)
+            hm: HostManagment object to store output (obj)
+            jumpservers: Jumpserver name -> Device (dict)
+            default_path: Names of jumpservers for hosts without path (lst)
+            sessions: Number of sessions, each with own jump chain (int)
+            pipeline: Commands sent at once per batch, 0 sends one by one (int)
+            max_sessions: Jumpserver -> maximum concurrent sessions (dict)
+            max_startups: Jumpserver -> maximum concurrent logins (dict)
+        """
+
+        self.agent_factory = agent_factory
+        self.hm = hm
+        self.jumpservers = jumpservers
+        self.default_path = tuple(default_path)
+        self.sessions = max(1, sessions)
+        self.pipeline = pipeline
+        self.max_sessions = max_sessions or {}
+        self.max_startups = max_startups or {}
+
+        self.open = {}  # Jumpserver -> open chains (dict)
+        self.starting = {}  # Jumpserver -> chains logging in (dict)
+        self.failed = []  # Hosts that could not be collected (lst)
+
+    def run(self, hosts, commands):
+        """
+        Function to collect commands for all hosts. Blocks until finished.
+
+        Args:
+            hosts: Hosts or Device objects, list or generator (inventory) (iter)
+            commands: List of commands (lst)
+
+        Returns:
+            list: Hosts that could not be collected.
+        """
+
+        self.failed = []
+        hosts = iter(hosts)
+
+        show = [c for c in commands if re.search(r'show\s\w*', c)]
+        for command in commands:
+            if command not in show:
+                logging.warn("Command \"{}\" has not been executed! "
+                             "This is no \"show\"-command. "
+                             "Make sure you execute fully typed show commands.".format(command))
+
+        SessionLoop().run([self._session(hosts, show) for n in range(self.sessions)])
+        logging.info("Finished {} sessions.".format(self.sessions))
+
+        if self.failed:
+            logging.error("Could not collect {} hosts: {}".format(len(self.failed), ', '.join(self.failed)))
+
+        return self.failed
+
+    def _full(self, path):
+        # Jumpservers of path without free session or login slot.
+        return [j for j in path if self.open.get(j, 0) >= self.max_sessions.get(j, sys.maxsize)
+                or self.starting.get(j, 0) >= self.max_startups.get(j, sys.maxsize)]
+
+    def _count(self, counter, path, n):
+        for jumpserver in path:
+            counter[jumpserver] = counter.get(jumpserver, 0) + n
+
+    def _connect(self, path):
+        # Step building jump chain over path within session limits, returns agent or None.
+        while self._full(path):
+            yield Sleep(0.05)
+
+        self._count(self.open, path, 1)
+        self._count(self.starting, path, 1)
+        agent = self.agent_factory(jumpservers=[self.jumpservers[j] for j in path])
+        try:
+            status = yield agent.connect_jumpserver()
+        except Exception as e:
+            logging.error("Could not build jump chain over {} ({})!".format(', '.join(path), repr(e)))
+            status = 103
+        finally:
+            self._count(self.starting, path, -1)
+
+        if status != 100:
+            self._close(agent, path)
+            yield Return(None)
+        yield Return(agent)
+
+    def _close(self, agent, path):
+        agent.close()
+        self._count(self.open, path, -1)
+
+    def _session(self, hosts, commands):
+        agent = None
+        path = None
+
+        for host in hosts:
+            device = host if isinstance(host, Device) else Device(host)
+            host_path = tuple(device.path or self.default_path)
+
+            unknown = [j for j in host_path if j not in self.jumpservers]
+            if unknown:
+                logging.error("Jumpserver {} of {} could not be found in settings, skipping!".format(
+                    ', '.join(unknown), device.name))
+                self.failed.append(device.name)
+                continue
+
+            if agent is not None and host_path != path:
+                self._close(agent, path)
+                agent = None
+            if agent is None:
+                path = host_path
+                agent = yield self._connect(path)
+                if agent is None:
+                    self.failed.append(device.name)
+                    continue
+
+            try:
+                status = yield self._collect(agent, device, commands)
+            except Exception as e:
+                logging.error("Could not collect {} ({}), jump chain will be dropped!".format(device.name, repr(e)))
+                status = 300
+            finally:
+                self.hm.add_spans(device.name, agent.pop_spans())
+
+            if status not in (100, 101, 201):
+                self.failed.append(device.name)
+            if status not in (100, 101):
+                # Unknown where agent is in the jump chain, drop chain.
+                self._close(agent, path)
+                agent = None
+
+        if agent is not None:
+            self._close(agent, path)
+
+    def _collect(self, agent, device, commands):
+        # Step collecting device, statuses as WorkerManager.collect_host().
+        host = device.name
+        commands = self.hm.pending_commands(host, commands)
+        if not commands:
+            logging.info("Skipping {}, all commands collected in resumed run.".format(host))
+            yield Return(100)
+
+        self.hm.add_host(host, device=device)
+
+        settings = device.connection_settings
+        status = yield agent.host_connect(device.ipv4 or host,
+                                          connection_type=settings['CONNECTION_TYPE'],
+                                          timeout=settings['TIMEOUT'],
+                                          expected_prompt=settings['PROMPT'],
+                                          port=settings['CONNECTION_PORT'],
+                                          profile=settings['PROFILE'])
+        if status not in (100, 101):
+            logging.error("Skipping commands for {}, not connected (status: {}).".format(host, status))
+            yield Return(status)
+
+        yield agent.cisco_term_len()
+        for command, output in (yield agent.send_commands(commands, batch_size=self.pipeline)):
+            self.hm.add_command(host, command, output)
+
+        if (yield agent.disconnect_host()) != 100:
+            logging.error("Could not fall back from {} to jumpserver.".format(host))
+            yield Return(201)
+
+        yield Return(status)
@@ -0,0 +1,201 @@
+#!/usr/bin/env python -tt
+"""
+Parse Manager library for turning collected show output into structured data.
+Parsers are registered per command and run after collection in a process pool,
+results are stored next to the raw output in the storage backend of the Host Manager.
+"""
+
+import logging
+import multiprocessing
+import os
+import re
+import sys
+import threading
+
+try:
+    import textfsm
+except ImportError:
+    textfsm = None
+
+__author__ = "Thomas Jongerius"
+__copyright__ = "Copyright 2016, Thomas Jongerius"
+__credits__ = ["Thomas Jongerius", "Alan Holt"]
+__license__ = "GPL"
+__version__ = "0.1"
+__maintainer__ = "Thomas Jongerius"
+__email__ = "thomasjongerius@yaworks.nl"
+__status__ = "Development"
+
+
+class RegexParser(object):
+    """
+    Parser returning named groups of every match as dict.
+    """
+
+    def __init__(self, pattern, flags=re.MULTILINE):
+        self.regex = re.compile(pattern, flags)  # Regular expression with named groups (obj)
+
+    def __call__(self, output):
+        return [m.groupdict() for m in self.regex.finditer(output)]
+
+
+class TextFSMParser(object):
+    """
+    Parser using a TextFSM template. Returns every record as dict.
+    """
+
+    def __init__(self, template):
+        if textfsm is None:
+            logging.critical("No textfsm library installed. Template parsers not available.")
+            sys.exit(101)
+
+        self.template = template  # Path of TextFSM template (str)
+
+    def __call__(self, output):
+        with open(self.template) as template:
+            fsm = textfsm.TextFSM(template)
+        return [dict(zip(fsm.header, record)) for record in fsm.ParseText(output)]
+
+
+# Parsers per command, IOS output unless registered otherwise.
+PARSERS = {
+    'show version': RegexParser(r'^(?P<hostname>\S+) uptime is (?P<uptime>.+)$|'
+                                r'^Cisco IOS.*Version (?P<version>[^,\s]+)|'
+                                r'^System image file is "(?P<image>[^"]+)"'),
+    'show ip route': RegexParser(r'^(?P<protocol>[A-Za-z]\*?(?: [A-Z0-9]{1,2})?)\*?\s+'
+                                 r'(?P<network>\d+\.\d+\.\d+\.\d+(?:/\d+)?)'
+                                 r'(?:\s+\[(?P<distance>\d+)/(?P<metric>\d+)\])?'
+                                 r'(?:\s+via (?P<nexthop>\d+\.\d+\.\d+\.\d+))?'
+                                 r'(?:.*?,\s+(?P<interface>[A-Za-z][\w/.:-]*)\s*$)?'),
+}
+
+
+def register_parser(command, parser):
+    """
+    Function to register parser for command.
+
+    Args:
+        command: Fully typed command (str)
+        parser: Callable taking output and returning structured data (obj)
+    """
+
+    PARSERS[' '.join(command.split())] = parser
+
+
+def register_templates(directory):
+    """
+    Function to register TextFSM templates of directory. File name is command
+    with underscores, e.g. show_ip_route.textfsm.
+
+    Args:
+        directory: Directory with templates (str)
+    """
+
+    for filename in sorted(os.listdir(directory)):
+        command, extension = os.path.splitext(filename)
+        if extension in ('.textfsm', '.template'):
+            register_parser(command.replace('_', ' '), TextFSMParser(os.path.join(directory, filename)))
+            logging.debug("Registered template {} for '{}'.".format(filename, command.replace('_', ' ')))
+
+
+def get_parser(command):
+    return PARSERS.get(' '.join(command.split()))
+
+
+def parse_output(job):
+    """
+    Function running parser in worker process. Workers are forked after
+    registration, parser is looked up in their copy of PARSERS.
+
+    Args:
+        job: Tuple of (host, command, output) (tuple)
+
+    Returns:
+        tuple: (host, command, structured data, error)
+    """
+
+    host, command, output = job
+    parser = get_parser(command)
+
+    if isinstance(output, bytes) and not isinstance(output, str):
+        output = output.decode('utf-8', 'replace')
+
+    try:
+        return host, command, parser(output), None
+    except Exception as e:
+        return host, command, None, repr(e)
+
+
+class ParsePool(object):
+    """
+    Pool of worker processes parsing collected output of a Host Manager.
+    """
+
+    def __init__(self, workers=None, window=4):
+        """
+        Parse pool.
+
+        Args:
+            workers: Number of worker processes, defaults to number of CPUs (int)
+            window: Outputs loaded per worker at a time (int)
+        """
+
+        self.workers = workers or multiprocessing.cpu_count()
+        self.window = window
+
+    def _jobs(self, hm, slots, stopped):
+        # Pool reads all jobs at once, slots keep loaded outputs within the window.
+        for host in list(hm.hm):
+            for command in hm.get_commands(host):
+                if get_parser(command) is None:
+                    continue
+
+                slots.acquire()
+                if stopped.is_set():
+                    return
+                output = hm.get_output(host, command)
+                if output is None:
+                    slots.release()
+                    continue
+                yield host, command, output
+
+    def run(self, hm):
+        """
+        Function to parse all outputs of Host Manager with a registered parser.
+        Parsers must be registered before. Output is loaded from storage while workers
+        parse, every finished output makes room for the next.
+
+        Args:
+            hm: HostManagment object with collected output (obj)
+
+        Returns:
+            int: Number of parsed outputs.
+        """
+
+        slots = threading.Semaphore(self.workers * self.window)
+        stopped = threading.Event()
+        pool = multiprocessing.Pool(self.workers)
+        parsed = 0
+
+        try:
+            for host, command, result, error in pool.imap_unordered(parse_output, self._jobs(hm, slots, stopped)):
+                slots.release()
+                if error is not None:
+                    logging.warn("Could not parse '{}' of {} ({}).".format(command, host, error))
+                    continue
+
+                hm.add_parsed(host, command, result)
+                parsed += 1
+        except BaseException:
+            # Task thread of pool may wait for a slot, stop loading jobs.
+            stopped.set()
+            slots.release()
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+
+        logging.info("Parsed {} outputs with {} workers.".format(parsed, self.workers))
+        return parsed
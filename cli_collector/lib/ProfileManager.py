@@ -0,0 +1,213 @@
+#!/usr/bin/env python -tt
+"""
+Profile Manager library for CPU profiling a collection run (not vendor profiles).
+Writes cProfile data for the whole run and per host, readable with pstats, snakeviz
+or other profile viewers, and counters of the pexpect hot path:
+expect calls, bytes read, pattern scan time and sleep time.
+"""
+
+import cProfile
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+
+import pexpect
+import pexpect.expect
+import pexpect.pty_spawn
+import pexpect.spawnbase
+
+import TransportManager
+from utils import dir_check
+
+__author__ = "Thomas Jongerius"
+__copyright__ = "Copyright 2016, Thomas Jongerius"
+__credits__ = ["Thomas Jongerius", "Alan Holt"]
+__license__ = "GPL"
+__version__ = "0.1"
+__maintainer__ = "Thomas Jongerius"
+__email__ = "thomasjongerius@yaworks.nl"
+__status__ = "Development"
+
+COUNTERS = ('EXPECT_CALLS', 'EXPECT_SECONDS', 'READS', 'BYTES_READ',
+            'SCANS', 'SCAN_SECONDS', 'SLEEPS', 'SLEEP_SECONDS')
+
+
+class Counters(object):
+    """
+    Counters of the pexpect hot path, kept per thread so every worker counts its own host.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.threads = []  # Counters of all threads (lst: -> dict)
+
+    def get(self):
+        """
+        Returns:
+            dict: Counters of current thread.
+        """
+        counters = getattr(self.local, 'counters', None)
+        if counters is None:
+            counters = self.local.counters = dict((c, 0) for c in COUNTERS)
+            with self.lock:
+                self.threads.append(counters)
+        return counters
+
+    def add(self, name, value=1):
+        self.get()[name] += value
+
+    def totals(self):
+        with self.lock:
+            return dict((c, sum(t[c] for t in self.threads)) for c in COUNTERS)
+
+
+class _TimeProxy(object):
+    """
+    Stand-in for time module of pexpect modules, counting sleeps.
+    """
+
+    def __init__(self, counters):
+        self.counters = counters
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+    def sleep(self, seconds):
+        self.counters.add('SLEEPS')
+        self.counters.add('SLEEP_SECONDS', seconds)
+        time.sleep(seconds)
+
+
+class Profiler(object):
+    """
+    Profiler of a collection run. cProfile only profiles the thread it is enabled in,
+    every host gets a profiler of its own in the thread collecting it. The run profile
+    of the main thread is merged with all host profiles when stopped.
+    """
+
+    def __init__(self, directory):
+        """
+        Profiler.
+
+        Args:
+            directory: Directory to write profiles and counters to (str)
+        """
+
+        dir_check(directory)
+        dir_check(os.path.join(directory, 'hosts'))
+
+        self.directory = directory
+        self.counters = Counters()
+        self.host_counters = {}  # Counters per host (dict)
+        self.host_files = []  # Written host profiles (lst)
+        self.lock = threading.Lock()
+
+        self._run = cProfile.Profile()
+        self._run_thread = None
+        self._originals = []  # Replaced attributes as (object, name, original) (lst)
+
+    def _wrap(self, owner, name, wrapper):
+        # Class attribute is restored as it was, not as (unbound) method.
+        self._originals.append((owner, name, vars(owner)[name]))
+        setattr(owner, name, wrapper(getattr(owner, name)))
+
+    def _instrument(self):
+        counters = self.counters
+
+        def timed(calls, seconds):
+            def wrapper(original):
+                def wrapped(*args, **kwargs):
+                    start = time.time()
+                    try:
+                        return original(*args, **kwargs)
+                    finally:
+                        counters.add(calls)
+                        counters.add(seconds, time.time() - start)
+                return wrapped
+            return wrapper
+
+        def reads(original):
+            def wrapped(*args, **kwargs):
+                data = original(*args, **kwargs)
+                counters.add('READS')
+                counters.add('BYTES_READ', len(data))
+                return data
+            return wrapped
+
+        self._wrap(pexpect.spawnbase.SpawnBase, 'expect_list', timed('EXPECT_CALLS', 'EXPECT_SECONDS'))
+        self._wrap(pexpect.spawnbase.SpawnBase, 'expect_exact', timed('EXPECT_CALLS', 'EXPECT_SECONDS'))
+        self._wrap(pexpect.expect.searcher_re, 'search', timed('SCANS', 'SCAN_SECONDS'))
+        self._wrap(pexpect.expect.searcher_string, 'search', timed('SCANS', 'SCAN_SECONDS'))
+        self._wrap(pexpect.pty_spawn.spawn, 'read_nonblocking', reads)
+        self._wrap(TransportManager.ChannelSpawn, 'read_nonblocking', reads)
+
+        # Sleeps of delaybeforesend, delayafterread and closing.
+        for module in (pexpect.pty_spawn, pexpect.expect):
+            self._originals.append((module, 'time', module.time))
+            module.time = _TimeProxy(counters)
+
+    def start(self):
+        """
+        Function to start profiling run in current thread.
+        """
+
+        self._instrument()
+        self._run_thread = threading.current_thread()
+        self._run.enable()
+
+    def call(self, host, func, *args, **kwargs):
+        """
+        Function to call func for host with a profiler of its own.
+
+        Returns:
+            object: Return value of func.
+        """
+
+        # Only one profiler can be enabled per thread, run profile pauses meanwhile.
+        in_run_thread = threading.current_thread() is self._run_thread
+        if in_run_thread:
+            self._run.disable()
+
+        before = dict(self.counters.get())
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.disable()
+
+            counters = self.counters.get()
+            filename = os.path.join(self.directory, 'hosts', '{}.prof'.format(host.replace(os.sep, '_')))
+            profile.dump_stats(filename)
+
+            with self.lock:
+                self.host_counters[host] = dict((c, counters[c] - before[c]) for c in COUNTERS)
+                self.host_files.append(filename)
+
+            if in_run_thread:
+                self._run.enable()
+
+    def stop(self):
+        """
+        Function to stop profiling and write run.prof (run merged with hosts) and counters.json.
+        """
+
+        self._run.disable()
+
+        for owner, name, original in reversed(self._originals):
+            setattr(owner, name, original)
+        self._originals = []
+
+        stats = pstats.Stats(self._run)
+        for filename in self.host_files:
+            stats.add(filename)
+        stats.dump_stats(os.path.join(self.directory, 'run.prof'))
+
+        with open(os.path.join(self.directory, 'counters.json'), 'w') as outfile:
+            json.dump({'TOTAL': self.counters.totals(), 'HOSTS': self.host_counters}, outfile, indent=2)
+
+        logging.info("Profile written to {} ({} hosts).".format(self.directory, len(self.host_files)))
@@ -0,0 +1,240 @@
+#!/usr/bin/env python -tt
+"""
+Simulator library for fake jumpservers and Cisco-like devices on a pty.
+Used as connection command of ConnectionAgent, so collection can be measured
+without network or real routers (see benchmark.py).
+
+The jumpserver shell answers 'ssh USER@HOST -p PORT' and 'telnet HOST PORT' with a
+nested device session in the same process, 'exit' returns to the jumpserver prompt.
+
+Usage as first hop:
+    python Simulator.py simjump --jump --latency 0.01 --output_lines 200
+"""
+
+import argparse
+import hashlib
+import random
+import shlex
+import sys
+import time
+
+try:
+    import termios
+except ImportError:
+    termios = None
+
+__author__ = "Thomas Jongerius"
+__copyright__ = "Copyright 2016, Thomas Jongerius"
+__credits__ = ["Thomas Jongerius", "Alan Holt"]
+__license__ = "GPL"
+__version__ = "0.1"
+__maintainer__ = "Thomas Jongerius"
+__email__ = "thomasjongerius@yaworks.nl"
+__status__ = "Development"
+
+JUMP_PROMPT = 'simjump$ '  # Prompt of simulated jumpserver, pattern 'simjump\$' (str)
+
+
+class StaticAccounts(object):
+    """
+    AccountManager replacement returning the same credentials for every host.
+    """
+
+    def __init__(self, username='sim', password='sim'):
+        self.username = username
+        self.password = password
+
+    def get_username(self, realm):
+        return self.username
+
+    def get_password_type(self, realm):
+        return 'Fixed'
+
+    def get_password(self, realm, username=None, interact=True, reset=False):
+        return self.password
+
+    def get_login(self, realm):
+        return self.username, self.password
+
+    def acquire_login(self, realm, site=None, block=True):
+        return 0.0
+
+
+class FakeDevice(object):
+    """
+    Cisco-like device session on a line based terminal with echo disabled.
+    Commands are echoed when read, like a device reading from its typeahead buffer.
+    """
+
+    def __init__(self, name, stdin, stdout, prompt=None, login=True,
+                 latency=0.0, connect_latency=0.0, output_lines=20,
+                 fail_rate=0.0, hang_rate=0.0, seed=0):
+        """
+        Fake device.
+
+        Args:
+            name: Hostname of device (str)
+            stdin: File to read lines from (obj)
+            stdout: File to write to (obj)
+            prompt: Prompt, defaults to name followed by '#' (str)
+            login: Ask for username and password (bool)
+            latency: Seconds before output of every command (float)
+            connect_latency: Seconds before login prompt (float)
+            output_lines: Lines of output for every show command (int)
+            fail_rate: Chance of login being denied (float)
+            hang_rate: Chance of device not returning prompt after a command (float)
+            seed: Seed of failure injection, same seed and name fail the same way (int)
+        """
+
+        self.name = name
+        self.stdin = stdin
+        self.stdout = stdout
+        self.prompt = prompt or name + '#'
+        self.login = login
+        self.latency = latency
+        self.connect_latency = connect_latency
+        self.output_lines = output_lines
+        self.fail_rate = fail_rate
+        self.hang_rate = hang_rate
+
+        # Failure injection per device, independent of order of connections.
+        self.random = random.Random(int(hashlib.md5('{}{}'.format(seed, name).encode('utf-8')).hexdigest(), 16))
+
+    def write(self, data):
+        self.stdout.write(data)
+        self.stdout.flush()
+
+    def readline(self):
+        line = self.stdin.readline()
+        if not line:
+            raise EOFError()
+        return line.rstrip('\r\n')
+
+    def output(self, command):
+        if not command.startswith('show'):
+            return ''
+        return ''.join('{} line {} of {}\r\n'.format(self.name, n, command) for n in range(self.output_lines))
+
+    def handle(self, command):
+        """
+        Function to answer command. Returns False when session ends.
+        """
+        if command == 'exit':
+            return False
+
+        if command:
+            time.sleep(self.latency)
+            self.write(self.output(command))
+
+            if self.random.random() < self.hang_rate:
+                # Device stops answering, session is only left by closing it.
+                while True:
+                    self.readline()
+
+        return True
+
+    def run(self):
+        """
+        Function to run session until 'exit' or end of input.
+        """
+        time.sleep(self.connect_latency)
+
+        try:
+            if self.login:
+                self.write('Username: ')
+                self.write(self.readline() + '\r\n')
+                self.write('Password: ')
+                self.readline()
+                self.write('\r\n')
+
+                if self.random.random() < self.fail_rate:
+                    self.write('% Access denied\r\n')
+                    return
+
+            while True:
+                self.write(self.prompt)
+                command = self.readline()
+                self.write(command + '\r\n')
+
+                if not self.handle(command):
+                    return
+        except EOFError:
+            return
+
+
+class FakeJumpserver(FakeDevice):
+    """
+    Jumpserver shell opening nested FakeDevice sessions for ssh and telnet commands.
+    """
+
+    def __init__(self, name, stdin, stdout, prompt=JUMP_PROMPT, **device_settings):
+        super(FakeJumpserver, self).__init__(name, stdin, stdout, prompt=prompt, login=True,
+                                             seed=device_settings.get('seed', 0))
+
+        self.device_settings = device_settings  # Settings of nested devices (dict)
+
+    def handle(self, command):
+        args = shlex.split(command)
+
+        if args and args[0] in ('ssh', 'telnet') and len(args) > 1:
+            # ssh USER@HOST -p PORT or telnet HOST PORT, host is name of device.
+            host = args[1].split('@')[-1].split(':')[0]
+            FakeDevice(host, self.stdin, self.stdout, **self.device_settings).run()
+            return True
+        elif args and args[0] not in ('exit', 'terminal'):
+            self.write('{}: command not found\r\n'.format(args[0]))
+
+        return command != 'exit'
+
+
+def option_parser():
+    parser = argparse.ArgumentParser(description='Fake jumpserver or Cisco-like device on a pty.')
+    parser.add_argument('name', help="Hostname of jumpserver or device", type=str)
+    parser.add_argument('--jump', help="Run as jumpserver with nested devices", dest='jump', action='store_true')
+    parser.add_argument('--latency', help="Seconds before output of every command (Default: 0)",
+                        type=float, default=0.0, dest='latency')
+    parser.add_argument('--connect_latency', help="Seconds before login prompt of device (Default: 0)",
+                        type=float, default=0.0, dest='connect_latency')
+    parser.add_argument('--output_lines', help="Lines of output for show commands (Default: 20)",
+                        type=int, default=20, dest='output_lines')
+    parser.add_argument('--fail_rate', help="Chance of login being denied (Default: 0)",
+                        type=float, default=0.0, dest='fail_rate')
+    parser.add_argument('--hang_rate', help="Chance of device hanging after a command (Default: 0)",
+                        type=float, default=0.0, dest='hang_rate')
+    parser.add_argument('--seed', help="Seed of failure injection (Default: 0)",
+                        type=int, default=0, dest='seed')
+
+    return parser.parse_args()
+
+
+def main():
+    args = option_parser()
+
+    settings = {'latency': args.latency,
+                'connect_latency': args.connect_latency,
+                'output_lines': args.output_lines,
+                'fail_rate': args.fail_rate,
+                'hang_rate': args.hang_rate,
+                'seed': args.seed}
+
+    # Terminal echo off, commands are echoed when read.
+    fd = sys.stdin.fileno()
+    old = None
+    if termios is not None and sys.stdin.isatty():
+        old = termios.tcgetattr(fd)
+        new = termios.tcgetattr(fd)
+        new[3] &= ~termios.ECHO
+        termios.tcsetattr(fd, termios.TCSANOW, new)
+
+    try:
+        if args.jump:
+            FakeJumpserver(args.name, sys.stdin, sys.stdout, **settings).run()
+        else:
+            FakeDevice(args.name, sys.stdin, sys.stdout, **settings).run()
+    finally:
+        if old is not None:
+            termios.tcsetattr(fd, termios.TCSANOW, old)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python -tt
+"""
+Timeout Manager library for expect timeouts derived from observed latencies.
+Latencies of login, prompt detection and every command are kept per host and persisted,
+so following runs fail fast on dead hosts and wait long enough for slow commands.
+"""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from utils import percentiles
+
+__author__ = "Thomas Jongerius"
+__copyright__ = "Copyright 2016, Thomas Jongerius"
+__credits__ = ["Thomas Jongerius", "Alan Holt"]
+__license__ = "GPL"
+__version__ = "0.1"
+__maintainer__ = "Thomas Jongerius"
+__email__ = "thomasjongerius@yaworks.nl"
+__status__ = "Development"
+
+ALL_HOSTS = '*'  # History of a key over all hosts (str)
+
+
+class AdaptiveTimeouts(object):
+    """
+    Expect timeouts per host and key (phase or command): p99 of recent latencies times margin,
+    within floor and ceiling. Hosts without enough history use the history of the key over
+    all hosts, keys without any history use the default timeout of the agent.
+    """
+
+    def __init__(self, filename=None, margin=3.0, floor=2.0, ceiling=300.0, window=16, min_samples=3):
+        """
+        Adaptive timeouts.
+
+        Args:
+            filename: JSON file to load history from and save it to, not persisted when not set (str)
+            margin: Timeout is p99 of latencies times margin (float)
+            floor: Minimum timeout in seconds (float)
+            ceiling: Maximum timeout in seconds, also limit for commands still returning output (float)
+            window: Latencies kept per host and key, over all hosts window * 8 (int)
+            min_samples: Latencies needed before history is used (int)
+        """
+
+        self.filename = filename
+        self.margin = margin
+        self.floor = floor
+        self.ceiling = ceiling
+        self.window = window
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+
+        # Host -> key -> recent latencies in seconds, ALL_HOSTS for all hosts (dict)
+        self.history = {}
+        if filename and os.path.exists(filename):
+            with open(filename) as history:
+                self.history = json.load(history)
+            logging.info("Loaded latency history of {} hosts from {}.".format(len(self.history), filename))
+
+    def observe(self, host, key, seconds):
+        """
+        Function to add latency of successful expect.
+
+        Args:
+            host: Hostname or IP (str)
+            key: Phase (LOGIN, PROMPT_DETECT, TERM_LEN) or command (str)
+            seconds: Observed latency (float)
+        """
+
+        seconds = round(seconds, 4)
+
+        with self.lock:
+            for name, window in ((host, self.window), (ALL_HOSTS, self.window * 8)):
+                samples = self.history.setdefault(name, {}).setdefault(key, [])
+                samples.append(seconds)
+                del samples[:-window]
+
+    def timeout(self, host, key, default):
+        """
+        Function to return timeout for expect of key on host.
+
+        Args:
+            host: Hostname or IP (str)
+            key: Phase (LOGIN, PROMPT_DETECT, TERM_LEN) or command (str)
+            default: Timeout without history (int)
+
+        Returns:
+            float: Timeout in seconds.
+        """
+
+        with self.lock:
+            samples = self.history.get(host, {}).get(key, [])
+            if len(samples) < self.min_samples:
+                samples = self.history.get(ALL_HOSTS, {}).get(key, [])
+            if len(samples) < self.min_samples:
+                return default
+            p99 = percentiles(samples, points=(99,))[99]
+
+        return min(self.ceiling, max(self.floor, p99 * self.margin))
+
+    def save(self):
+        """
+        Function to write history to file. File is replaced at once, previous history stays valid when interrupted.
+        """
+
+        if not self.filename:
+            return
+
+        with self.lock:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.filename)))
+            with os.fdopen(fd, 'w') as history:
+                json.dump(self.history, history)
+            os.rename(tmp, self.filename)
+
+        logging.info("Latency history saved to {}.".format(self.filename))
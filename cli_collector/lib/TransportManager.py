@@ -0,0 +1,440 @@
+#!/usr/bin/env python -tt
+"""
+Transport Manager library for the way ConnectionAgent reaches hosts.
+
+PexpectTransport spawns the local ssh/telnet binary and hops by sending commands
+into the shell of the previous hop (default).
+ParamikoTransport connects in-process, chaining jump hosts with direct-tcpip channels.
+SocketTransport connects Telnet hosts directly over raw sockets.
+"""
+
+import logging
+import select
+import socket
+import sys
+import pexpect
+from pexpect.spawnbase import SpawnBase
+
+try:
+    import paramiko
+except ImportError:
+    paramiko = None
+
+__author__ = "Thomas Jongerius"
+__copyright__ = "Copyright 2016, Thomas Jongerius"
+__credits__ = ["Thomas Jongerius", "Alan Holt"]
+__license__ = "GPL"
+__version__ = "0.1"
+__maintainer__ = "Thomas Jongerius"
+__email__ = "thomasjongerius@yaworks.nl"
+__status__ = "Development"
+
+
+def get_transport(name, timeout=10, known_hosts=None, accept_unknown_hostkeys=False):
+    """
+    Function to return transport object by name.
+
+    Args:
+        name: Transport name [PEXPECT || PARAMIKO || SOCKET] (str)
+        timeout: Default timeout (int)
+        known_hosts: Known hosts file loaded next to system host keys, PARAMIKO only (str)
+        accept_unknown_hostkeys: Accept host keys not in known hosts, PARAMIKO only (bool)
+
+    Returns:
+        object: Transport object.
+    """
+
+    transports = {'PEXPECT': PexpectTransport,
+                  'PARAMIKO': ParamikoTransport,
+                  'SOCKET': SocketTransport}
+
+    if name not in transports:
+        logging.error("Transport {} not supported!".format(name))
+        sys.exit(101)
+
+    if name == 'PARAMIKO':
+        return ParamikoTransport(timeout=timeout, known_hosts=known_hosts,
+                                 accept_unknown_hostkeys=accept_unknown_hostkeys)
+
+    return transports[name](timeout=timeout)
+
+
+class ChannelSpawn(SpawnBase):
+    """
+    Pexpect spawn on top of a socket-like channel (paramiko Channel).
+    ConnectionAgent can use expect_list(), expect_exact(), before and after as on pexpect.spawn.
+    """
+
+    def __init__(self, channel, client=None, timeout=30, maxread=2000,
+                 searchwindowsize=None, encoding=None):
+        super(ChannelSpawn, self).__init__(timeout=timeout, maxread=maxread,
+                                           searchwindowsize=searchwindowsize,
+                                           encoding=encoding)
+
+        self.channel = channel  # Channel with recv(), send() and fileno() (obj)
+        self.client = client  # Owner of channel, closed with channel (obj)
+        self.delaybeforesend = None
+        self.closed = False
+        self.name = '<ChannelSpawn {}>'.format(channel)
+
+    def read_nonblocking(self, size=1, timeout=-1):
+        if timeout == -1:
+            timeout = self.timeout
+
+        r, w, e = select.select([self.channel], [], [], timeout)
+        if not r:
+            raise pexpect.TIMEOUT('Timeout exceeded.')
+
+        data = self.channel.recv(size)
+        if data is None:
+            # Only protocol data received (Telnet negotiation), nothing for the buffer.
+            return self.string_type()
+        if not data:
+            self.flag_eof = True
+            raise pexpect.EOF('End Of File (EOF).')
+
+        s = self._decoder.decode(data, final=False)
+        self._log(s, 'read')
+        return s
+
+    def send(self, s):
+        s = self._coerce_send_string(s)
+        self._log(s, 'send')
+
+        b = self._encoder.encode(s, final=False)
+        self.channel.sendall(b)
+        return len(b)
+
+    def sendline(self, s=''):
+        s = self._coerce_send_string(s)
+        return self.send(s + self.linesep)
+
+    def isalive(self):
+        return not self.closed and not self.channel.closed
+
+    def close(self, force=True):
+        self.channel.close()
+        if self.client is not None:
+            self.client.close()
+        self.closed = True
+
+
+# Telnet commands and options (RFC 854, RFC 857, RFC 858)
+IAC, DONT, DO, WONT, WILL, SB, SE = 255, 254, 253, 252, 251, 250, 240
+ECHO, SGA = 1, 3
+
+
+class TelnetChannel(object):
+    """
+    Telnet protocol on top of a socket or paramiko channel.
+    Strips IAC sequences from received data and answers option negotiation:
+    server ECHO and SGA are accepted, all other options are refused.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock  # Socket or channel with recv(), sendall() and fileno() (obj)
+        self.closed = False
+
+        self._state = 'DATA'  # Parser state, IAC sequences may be split over reads (str)
+        self._command = None  # Negotiation command waiting for option (int)
+        self._remote = set()  # Options enabled on server side (set)
+        self._local = set()  # Options enabled on our side (set)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def recv(self, size):
+        """
+        Function to receive data without Telnet commands.
+
+        Returns:
+            bytes: Data, empty on EOF, None when only Telnet commands were received.
+        """
+
+        raw = self.sock.recv(size)
+        if not raw:
+            return raw
+
+        data, replies = self._parse(bytearray(raw))
+
+        if replies:
+            self.sock.sendall(bytes(replies))
+
+        return bytes(data) if data else None
+
+    def sendall(self, data):
+        # Escape IAC in data and send NVT newline.
+        data = data.replace(b'\xff', b'\xff\xff').replace(b'\n', b'\r\n')
+        self.sock.sendall(data)
+
+    def close(self):
+        self.sock.close()
+        self.closed = True
+
+    def _parse(self, raw):
+        data = bytearray()
+        replies = bytearray()
+
+        for byte in raw:
+            if self._state == 'DATA':
+                if byte == IAC:
+                    self._state = 'IAC'
+                else:
+                    data.append(byte)
+            elif self._state == 'IAC':
+                if byte == IAC:
+                    data.append(IAC)
+                    self._state = 'DATA'
+                elif byte in (DO, DONT, WILL, WONT):
+                    self._command = byte
+                    self._state = 'OPTION'
+                elif byte == SB:
+                    self._state = 'SB'
+                else:
+                    # NOP, GA and other commands without option.
+                    self._state = 'DATA'
+            elif self._state == 'OPTION':
+                replies.extend(self._negotiate(self._command, byte))
+                self._state = 'DATA'
+            elif self._state == 'SB':
+                # Subnegotiation is ignored, all options it belongs to are refused.
+                if byte == IAC:
+                    self._state = 'SB_IAC'
+            elif self._state == 'SB_IAC':
+                self._state = 'DATA' if byte == SE else 'SB'
+
+        return data, replies
+
+    def _negotiate(self, command, option):
+        # Only answer on changes, so negotiation cannot loop (RFC 854).
+        if command == WILL:
+            if option in (ECHO, SGA):
+                if option not in self._remote:
+                    self._remote.add(option)
+                    return bytearray([IAC, DO, option])
+                return bytearray()
+            return bytearray([IAC, DONT, option])
+        elif command == WONT:
+            if option in self._remote:
+                self._remote.discard(option)
+                return bytearray([IAC, DONT, option])
+            return bytearray()
+        elif command == DO:
+            if option == SGA:
+                if option not in self._local:
+                    self._local.add(option)
+                    return bytearray([IAC, WILL, option])
+                return bytearray()
+            return bytearray([IAC, WONT, option])
+        else:
+            if option in self._local:
+                self._local.discard(option)
+                return bytearray([IAC, WONT, option])
+            return bytearray()
+
+
+class PexpectTransport(object):
+    """
+    Transport spawning the local ssh/telnet binary. Jump hosts are chained by
+    sending the connection command into the shell of the previous hop.
+    """
+
+    native = False  # Login prompts are handled by LoginStateMachine.
+
+    def __init__(self, timeout=10):
+        self.timeout = timeout
+        self.spawn = None  # Single spawn for complete chain (obj)
+
+    def open(self, host, cmd, timeout=None, **kwargs):
+        """
+        Function to start connection to host.
+
+        Args:
+            host: Hostname or IP (str)
+            cmd: Connection command (str)
+            timeout: Timeout (int)
+
+        Returns:
+            object: pexpect spawn to handle login on.
+        """
+
+        if timeout is None:
+            timeout = self.timeout
+
+        # If no spawn instance exists. Create one.
+        if self.spawn is None:
+            self.spawn = pexpect.spawn(cmd, timeout=timeout)
+            # No sleep before every sendline(), logins react on prompts (LoginStateMachine).
+            self.spawn.delaybeforesend = None
+        else:
+            self.spawn.sendline(cmd)
+
+        return self.spawn
+
+    def close_session(self, session):
+        # Session is left with 'exit' by LoginStateMachine, spawn stays for the chain.
+        pass
+
+    def alive(self):
+        return self.spawn is not None and self.spawn.isalive()
+
+    def close(self):
+        if self.spawn is not None:
+            self.spawn.close(force=True)
+            self.spawn = None
+
+
+class NativeTransport(object):
+    """
+    Base for in-process transports. Every device session is a ChannelSpawn of its own,
+    disconnecting closes the session instead of falling back to a jumpserver prompt.
+    """
+
+    native = True
+
+    def __init__(self, timeout=10):
+        self.timeout = timeout
+        self.sessions = []  # Open device sessions (lst)
+
+    def _channel(self, host, port, timeout):
+        return None
+
+    def _telnet_session(self, host, port, timeout):
+        sock = self._channel(host, port, timeout)
+        if sock is None:
+            sock = socket.create_connection((host, int(port)), timeout)
+
+        logging.debug("Opening Telnet session to {}:{} ({})...".format(host, port, self.__class__.__name__))
+        return ChannelSpawn(TelnetChannel(sock), timeout=timeout)
+
+    def _ssh_session(self, host, port, user, password, timeout):
+        raise ValueError("SSH is not supported by {}!".format(self.__class__.__name__))
+
+    def add_jump(self, host, port=22, user=None, password=None, timeout=None):
+        raise ValueError("Jumpservers are not supported by {}!".format(self.__class__.__name__))
+
+    def open(self, host, cmd=None, timeout=None, port=22, user=None, password=None,
+             connection_type='SSH', **kwargs):
+        """
+        Function to open session on host (over jump chain).
+
+        Returns:
+            object: ChannelSpawn with interactive session.
+        """
+
+        if timeout is None:
+            timeout = self.timeout
+
+        if connection_type == 'TELNET':
+            session = self._telnet_session(host, port, timeout)
+        else:
+            session = self._ssh_session(host, port, user, password, timeout)
+
+        self.sessions.append(session)
+
+        return session
+
+    def close_session(self, session):
+        """
+        Function to close device session, jump chain stays connected.
+        """
+
+        if session in self.sessions:
+            self.sessions.remove(session)
+        session.close()
+
+    def alive(self):
+        return True
+
+    def close(self):
+        for session in self.sessions:
+            session.close()
+        self.sessions = []
+
+
+class SocketTransport(NativeTransport):
+    """
+    Transport connecting Telnet hosts directly over raw sockets, without telnet processes.
+    Hosts must be reachable from this machine, jumpservers are not supported.
+    """
+
+
+class ParamikoTransport(NativeTransport):
+    """
+    Transport connecting in-process with paramiko. No local ssh processes or ptys.
+    Every jump host is reached through a direct-tcpip channel of the previous hop,
+    every device session is a new channel over the same jump chain.
+    Telnet devices are reached with native Telnet over a direct-tcpip channel.
+    Hosts with unknown host keys are rejected, unless accepting them is enabled.
+    """
+
+    def __init__(self, timeout=10, known_hosts=None, accept_unknown_hostkeys=False):
+        if paramiko is None:
+            logging.critical("No paramiko library installed. Transport PARAMIKO not available.")
+            sys.exit(101)
+
+        super(ParamikoTransport, self).__init__(timeout=timeout)
+        self.known_hosts = known_hosts  # Known hosts file next to system host keys (str)
+        self.accept_unknown_hostkeys = accept_unknown_hostkeys  # Accept keys not in known hosts (bool)
+        self.jump_clients = []  # Connected SSH clients of jump chain (lst)
+
+        if accept_unknown_hostkeys:
+            logging.warn("Unknown host keys are accepted, connections are not protected against MITM!")
+
+    def _channel(self, host, port, timeout):
+        # Direct connection when no jump hosts in chain.
+        if not self.jump_clients:
+            return None
+
+        return self.jump_clients[-1].get_transport().open_channel(
+            'direct-tcpip', (host, int(port)), ('127.0.0.1', 0), timeout=timeout)
+
+    def _connect(self, host, port, user, password, timeout):
+        client = paramiko.SSHClient()
+        client.load_system_host_keys()
+        if self.known_hosts:
+            try:
+                # Loaded as system keys, the file is never written.
+                client.load_system_host_keys(self.known_hosts)
+            except IOError as e:
+                logging.critical("Could not read known hosts file {} ({})!".format(self.known_hosts, e))
+                sys.exit(10)
+        if self.accept_unknown_hostkeys:
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        else:
+            client.set_missing_host_key_policy(paramiko.RejectPolicy())
+
+        client.connect(host, port=int(port), username=user, password=password,
+                       sock=self._channel(host, port, timeout),
+                       timeout=timeout, banner_timeout=timeout, auth_timeout=timeout)
+
+        return client
+
+    def add_jump(self, host, port=22, user=None, password=None, timeout=None):
+        """
+        Function to add jump host to chain.
+        """
+
+        if timeout is None:
+            timeout = self.timeout
+
+        logging.debug("Connecting to jump host {} (paramiko)...".format(host))
+        self.jump_clients.append(self._connect(host, port, user, password, timeout))
+
+    def _ssh_session(self, host, port, user, password, timeout):
+        logging.debug("Opening session to {} (paramiko)...".format(host))
+        client = self._connect(host, port, user, password, timeout)
+        channel = client.invoke_shell(width=511, height=0)
+
+        return ChannelSpawn(channel, client=client, timeout=timeout)
+
+    def alive(self):
+        return all(c.get_transport() is not None and c.get_transport().is_active()
+                   for c in self.jump_clients)
+
+    def close(self):
+        super(ParamikoTransport, self).close()
+
+        for client in reversed(self.jump_clients):
+            client.close()
+        self.jump_clients = []
@@ -0,0 +1,661 @@
+#!/usr/bin/env python -tt
+"""
+Worker Manager library for collecting data from multiple hosts in parallel.
+Workers check out ConnectionAgents (jump chain and pexpect spawn) from a JumpChainPool,
+hosts are handed out per jump path by a PathScheduler.
+"""
+
+import collections
+import functools
+import logging
+import threading
+import time
+
+from ConnectionManager import PathPools
+from HostManager import Device
+
+__author__ = "Thomas Jongerius"
+__copyright__ = "Copyright 2016, Thomas Jongerius"
+__credits__ = ["Thomas Jongerius", "Alan Holt"]
+__license__ = "GPL"
+__version__ = "0.1"
+__maintainer__ = "Thomas Jongerius"
+__email__ = "thomasjongerius@yaworks.nl"
+__status__ = "Development"
+
+
+class CircuitBreakers(object):
+    """
+    Circuit breakers of jumpservers and sites (inventory). A breaker opens after threshold consecutive
+    connection failures, hosts behind an open breaker are parked. After reset_timeout the breaker is
+    half-open: exactly one host probes while parked hosts wait. Success closes the breaker and releases
+    parked hosts, failure opens it again. Parked hosts are given up after probes failed probes.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=60, probes=3):
+        """
+        Circuit breakers.
+
+        Args:
+            threshold: Consecutive failures before breaker opens (int)
+            reset_timeout: Seconds before an open breaker lets a probe through (int)
+            probes: Failed probes in a row before hosts behind breaker are given up (int)
+        """
+
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.probes = probes
+        self.lock = threading.Lock()
+
+        # (level, name) -> {'FAILURES': consecutive failures, 'OPENED': time opened, 'PROBING': probe running,
+        #                   'PROBES': failed probes} (dict)
+        self.breakers = {}
+        self.parked = {}  # (level, name) -> hosts waiting for breaker (dict)
+        self.released = {}  # (level, name) -> OPENED of breaker when a parked host was released to probe (dict)
+        self.lost = []  # Hosts given up, not yet returned by release() (lst)
+
+    def _open(self, breaker):
+        return breaker['FAILURES'] >= self.threshold
+
+    def check(self, keys):
+        """
+        Function to check breakers of keys before connecting. Half-open breakers let exactly
+        one caller through, that caller reports success() or failure() of its connection.
+
+        Args:
+            keys: Breaker keys as (level, name), see breaker_keys() and jump_keys() (lst)
+
+        Returns:
+            tuple: Key of open breaker, None when connecting is allowed.
+        """
+
+        with self.lock:
+            half_open = []
+            for key in keys:
+                breaker = self.breakers.get(key)
+                if breaker is None or not self._open(breaker):
+                    continue
+                if breaker['PROBING'] or time.time() - breaker['OPENED'] < self.reset_timeout:
+                    return key
+                half_open.append(breaker)
+
+            # Caller claims the probe, following callers are blocked until it reports.
+            for breaker in half_open:
+                breaker['PROBING'] = True
+
+        return None
+
+    def success(self, keys):
+        """
+        Function to report successful connection, closes breakers of keys.
+        """
+
+        with self.lock:
+            for key in keys:
+                breaker = self.breakers.pop(key, None)
+                if breaker is not None and self._open(breaker):
+                    logging.warn("Circuit breaker of {} {} closed.".format(*key))
+
+    def failure(self, keys):
+        """
+        Function to report failed connection, opens breakers of keys at threshold.
+        """
+
+        with self.lock:
+            for key in keys:
+                breaker = self.breakers.setdefault(key, {'FAILURES': 0, 'OPENED': 0, 'PROBING': False, 'PROBES': 0})
+                breaker['FAILURES'] += 1
+                if not self._open(breaker):
+                    continue
+                if breaker['PROBING']:
+                    breaker['PROBES'] += 1
+                if breaker['PROBING'] or breaker['FAILURES'] == self.threshold:
+                    logging.error("Circuit breaker of {} {} open after {} failures, hosts behind it are "
+                                  "parked for {}s.".format(key[0], key[1], breaker['FAILURES'], self.reset_timeout))
+                # Failed probe (or connection started before breaker opened) opens breaker again.
+                breaker['OPENED'] = time.time()
+                breaker['PROBING'] = False
+
+    def park(self, key, host):
+        """
+        Function to park host blocked by open breaker of key, see release().
+
+        Args:
+            key: Key of open breaker, as returned by check() (tuple)
+            host: Hostname or IP (str), or Device (obj)
+        """
+
+        name = host.name if isinstance(host, Device) else host
+
+        with self.lock:
+            breaker = self.breakers.get(key)
+            if breaker is not None and breaker['PROBES'] >= self.probes:
+                logging.error("Skipping {}, circuit breaker of {} {} is open (status: 203).".format(name, *key))
+                self.lost.append(host)
+                return
+            logging.warn("Parking {}, circuit breaker of {} {} is open.".format(name, *key))
+            self.parked.setdefault(key, []).append(host)
+
+    def waiting(self):
+        """
+        Function to return number of hosts parked or given up, not yet returned by release().
+        """
+
+        with self.lock:
+            return sum(len(hosts) for hosts in self.parked.values()) + len(self.lost)
+
+    def release(self):
+        """
+        Function to release parked hosts: all hosts of closed breakers and one host (the probe)
+        of every half-open breaker. Hosts of breakers with too many failed probes are given up.
+
+        Returns:
+            tuple: (released hosts (lst), given up hosts (lst), seconds until next breaker half-opens or None (float))
+        """
+
+        with self.lock:
+            now = time.time()
+            ready = []
+            wait = None
+            for key in list(self.parked):
+                breaker = self.breakers.get(key)
+                if breaker is None or not self._open(breaker):
+                    ready.extend(self.parked.pop(key))
+                    self.released.pop(key, None)
+                    continue
+                if breaker['PROBES'] >= self.probes:
+                    hosts = self.parked.pop(key)
+                    logging.error("Giving up {} hosts, circuit breaker of {} {} is open after {} failed "
+                                  "probes (status: 203).".format(len(hosts), key[0], key[1], breaker['PROBES']))
+                    self.lost.extend(hosts)
+                    continue
+                if breaker['PROBING']:
+                    continue
+                left = breaker['OPENED'] + self.reset_timeout - now
+                if left > 0:
+                    wait = left if wait is None else min(wait, left)
+                elif self.released.get(key) != breaker['OPENED']:
+                    # One probe per time breaker opened, others wait for its outcome.
+                    self.released[key] = breaker['OPENED']
+                    ready.append(self.parked[key].pop(0))
+                    if not self.parked[key]:
+                        del self.parked[key]
+
+            lost, self.lost = self.lost, []
+
+        return ready, lost, wait
+
+
+def breaker_keys(host):
+    """
+    Function to return circuit breaker keys of host connections: site of host (inventory).
+    Jumpservers have breakers of their own, for building jump chains (jump_keys()).
+
+    Args:
+        host: Hostname or IP (str), or Device (obj)
+
+    Returns:
+        list: Keys as (level, name), empty without site.
+    """
+
+    if isinstance(host, Device) and host.site is not None:
+        return [('SITE', host.site)]
+
+    return []
+
+
+def jump_keys(path):
+    """
+    Function to return circuit breaker keys of jumpservers of path, for building jump chains.
+    """
+
+    return [('JUMPSERVER', j) for j in path]
+
+
+def release_parked(hosts, breakers=None):
+    """
+    Generator yielding hosts, and hosts parked on circuit breakers as soon as they are released.
+    After the last host it waits for parked hosts, for serial collection.
+
+    Args:
+        hosts: Hosts or Device objects, list or generator (inventory) (iter)
+        breakers: CircuitBreakers hosts are parked on (obj)
+
+    Returns:
+        generator: Hosts or Device objects.
+    """
+
+    for host in hosts:
+        if breakers is not None:
+            for parked in breakers.release()[0]:
+                yield parked
+        yield host
+
+    while breakers is not None and breakers.waiting():
+        ready, lost, wait = breakers.release()
+        for parked in ready:
+            yield parked
+        if not ready and not lost:
+            time.sleep(wait or 1)
+
+
+def connect_device(agent, device):
+    """
+    Function to connect agent to device with settings of device (inventory).
+    Settings not set on device are taken from agent.
+
+    Returns:
+        int: Connection status.
+    """
+
+    settings = device.connection_settings
+
+    return agent.host_connect(device.ipv4 or device.name,
+                              connection_type=settings['CONNECTION_TYPE'],
+                              timeout=settings['TIMEOUT'],
+                              expected_prompt=settings['PROMPT'],
+                              port=settings['CONNECTION_PORT'],
+                              profile=settings['PROFILE'])
+
+
+def collect_host(agent, hm, host, commands, pipeline=0, breakers=None, profiler=None):
+    """
+    Function to connect to host, execute commands and save output to Host Manager.
+
+    Args:
+        agent: Connected ConnectionAgent object (obj)
+        hm: HostManagment object to store output (obj)
+        host: Hostname or IP (str), or Device with connection settings (obj)
+        commands: List of commands to execute (lst)
+        pipeline: Commands sent at once per batch, 0 sends one by one (int)
+        breakers: CircuitBreakers of jumpservers and sites (obj)
+        profiler: Profiler to profile connecting and collecting host with (obj)
+
+    Returns:
+        int: Connection status of host. 201 when collected but not fallen back to jumpserver.
+             100 without connecting when all commands were collected before (resumed run).
+             203 without connecting when a circuit breaker of host is open, host is parked on breakers.
+    """
+
+    keys = breaker_keys(host)
+
+    device = None
+    if isinstance(host, Device):
+        device, host = host, host.name
+
+    commands = hm.pending_commands(host, commands)
+    if not commands:
+        logging.info("Skipping {}, all commands collected in resumed run.".format(host))
+        return 100
+
+    if breakers is not None:
+        blocked = breakers.check(keys)
+        if blocked is not None:
+            breakers.park(blocked, device or host)
+            return 203
+
+    hm.add_host(host, device=device)
+
+    # Only the attempt connecting the host is profiled, hosts parked or skipped above are not.
+    if profiler is not None:
+        return profiler.call(host, _collect, agent, hm, host, device, commands, pipeline, breakers)
+    return _collect(agent, hm, host, device, commands, pipeline, breakers)
+
+
+def _collect(agent, hm, host, device, commands, pipeline, breakers):
+    # Connects host, executes commands and falls back to jumpserver, as collect_host().
+    keys = breaker_keys(device or host)
+
+    # Timing spans are stored with host, also when agent exits halfway.
+    try:
+        try:
+            if device is not None:
+                status = connect_device(agent, device)
+            else:
+                status = agent.host_connect(host)
+        except (SystemExit, Exception):
+            if breakers is not None:
+                breakers.failure(keys)
+            raise
+
+        if breakers is not None:
+            if status in (100, 101):
+                breakers.success(keys)
+            else:
+                breakers.failure(keys)
+
+        if status not in (100, 101):
+            logging.error("Skipping commands for {}, not connected (status: {}).".format(host, status))
+            return status
+
+        agent.cisco_term_len()
+        if pipeline > 0:
+            for command, output in agent.send_commands(commands, batch_size=pipeline):
+                hm.add_command(host, command, output)
+        else:
+            for command in commands:
+                hm.add_command(host, command, agent.send_command(command))
+
+        if agent.disconnect_host() != 100:
+            logging.error("Could not fall back from {} to jumpserver.".format(host))
+            return 201
+
+        return status
+    finally:
+        hm.add_spans(host, agent.pop_spans())
+
+
+class PathScheduler(object):
+    """
+    Scheduler handing out hosts per jump path. Hosts wait in a queue per path, workers take
+    a host of the ready path with fewest hosts in progress, so a slow path never takes all workers.
+    A path is ready when its pool has an idle chain or a new chain stays within the session limits.
+    Hosts parked on circuit breakers are queued again when released.
+    """
+
+    def __init__(self, condition, backlog=64, breakers=None, pool_for=None):
+        """
+        Path scheduler.
+
+        Args:
+            condition: Condition of the jump chain pools (obj)
+            backlog: Maximum number of hosts waiting, put() blocks above (int)
+            breakers: CircuitBreakers hosts are parked on (obj)
+            pool_for: Function returning JumpChainPool of host, for released hosts (func)
+        """
+
+        self.condition = condition
+        self.backlog = backlog
+        self.breakers = breakers
+        self.pool_for = pool_for
+
+        self.queues = collections.OrderedDict()  # JumpChainPool -> waiting hosts, in order of turn (dict)
+        self.busy = {}  # JumpChainPool -> hosts in progress (dict)
+        self.pending = 0  # Number of waiting hosts (int)
+        self.closed = False  # No more hosts will be put (bool)
+        self.failed = []  # Hosts given up by circuit breakers (lst)
+
+    def put(self, pool, host):
+        """
+        Function to queue host on pool of its jump path. Blocks when backlog is full.
+        """
+
+        with self.condition:
+            while self.pending >= self.backlog:
+                self.condition.wait()
+
+            self.queues.setdefault(pool, collections.deque()).append(host)
+            self.busy.setdefault(pool, 0)
+            self.pending += 1
+            self.condition.notify_all()
+
+    def close(self):
+        """
+        Function to mark end of hosts, get() returns None when queues are empty.
+        """
+
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def get(self):
+        """
+        Function to take next host. Blocks until a path is ready.
+
+        Returns:
+            tuple: (pool, host, reservation of pool), None when no hosts left.
+        """
+
+        while True:
+            with self.condition:
+                victim = None
+                while victim is None:
+                    wait = self._release()
+                    waiting = [p for p, q in self.queues.items() if q]
+                    if not waiting and self.closed and not (self.breakers and self.breakers.waiting()):
+                        return None
+
+                    # Sort is stable, paths with equal load take turns.
+                    for pool in sorted(waiting, key=lambda p: self.busy[p]):
+                        reservation = pool.reserve()
+                        if reservation is not None:
+                            hosts = self.queues.pop(pool)
+                            host = hosts.popleft()
+                            self.queues[pool] = hosts
+                            self.busy[pool] += 1
+                            self.pending -= 1
+                            self.condition.notify_all()
+                            return pool, host, reservation
+
+                    victim = self._victim(waiting)
+                    if victim is None:
+                        self.condition.wait(wait)
+
+            # Idle chains of other paths hold sessions the waiting paths need.
+            victim.close_idle()
+
+    def done(self, pool):
+        """
+        Function to report host of pool as finished.
+        """
+
+        with self.condition:
+            self.busy[pool] -= 1
+            self.condition.notify_all()
+
+    def _release(self):
+        # Queues released parked hosts first, returns seconds until next breaker half-opens.
+        if self.breakers is None:
+            return None
+
+        ready, lost, wait = self.breakers.release()
+        for host in ready:
+            pool = self.pool_for(host)
+            self.queues.setdefault(pool, collections.deque()).appendleft(host)
+            self.busy.setdefault(pool, 0)
+            self.pending += 1
+        self.failed.extend(host.name if isinstance(host, Device) else host for host in lost)
+
+        return wait
+
+    def _victim(self, waiting):
+        # Pool without waiting hosts whose idle chains block a full jumpserver of a waiting path.
+        for pool in waiting:
+            if pool.idle or pool.created >= pool.size or pool.limiter is None:
+                continue
+            full = set(pool.limiter.full(pool.path))
+            for other in self.queues:
+                if not self.queues[other] and other.idle and full.intersection(other.path):
+                    return other
+        return None
+
+
+class CollectorWorker(threading.Thread):
+    """
+    Worker thread taking hosts from a shared scheduler.
+    """
+
+    def __init__(self, name, scheduler, hm, commands, pipeline=0, profiler=None, breakers=None):
+        """
+        Worker thread for collecting data from hosts.
+
+        Args:
+            name: Name of worker (str)
+            scheduler: Shared PathScheduler with hosts (obj)
+            hm: Shared HostManagment object (obj)
+            commands: List of commands to execute (lst)
+            pipeline: Commands sent at once per batch, 0 sends one by one (int)
+            profiler: Profiler to profile every host with (obj)
+            breakers: CircuitBreakers of jumpservers and sites (obj)
+        """
+
+        super(CollectorWorker, self).__init__(name=name)
+        self.daemon = True
+
+        self.scheduler = scheduler
+        self.hm = hm
+        self.commands = commands
+        self.pipeline = pipeline
+        self.profiler = profiler
+        self.breakers = breakers
+
+        self.failed = []  # Hosts that could not be collected (lst)
+
+    def _claim(self, chain_pool, reservation=None):
+        # Building jump chain reports to breakers of its jumpservers, also when it was the probe.
+        # Without reservation a chain is checked out, built when no idle chain is alive.
+        claim = chain_pool.checkout if reservation is None else functools.partial(chain_pool.claim, reservation)
+        if self.breakers is None:
+            return claim()
+
+        keys = jump_keys(chain_pool.path)
+        try:
+            agent = claim()
+        except (SystemExit, Exception):
+            self.breakers.failure(keys)
+            raise
+        if agent is not None:
+            # Dead idle chain (None) tells nothing about the jumpservers.
+            self.breakers.success(keys)
+        return agent
+
+    def run(self):
+        while True:
+            item = self.scheduler.get()
+            if item is None:
+                # No hosts left.
+                break
+
+            chain_pool, host, reservation = item
+            name = host.name if isinstance(host, Device) else host
+
+            agent = None
+            broken = False
+
+            try:
+                blocked = None
+                if self.breakers is not None:
+                    blocked = self.breakers.check(jump_keys(chain_pool.path))
+                if blocked is not None:
+                    # No jump chain is build towards an open breaker, reservation is returned unused.
+                    chain_pool.cancel(reservation)
+                    self.breakers.park(blocked, host)
+                    continue
+
+                agent = self._claim(chain_pool, reservation)
+                if agent is None:
+                    # Reserved idle chain was dead.
+                    agent = self._claim(chain_pool)
+                status = collect_host(agent, self.hm, host, self.commands, pipeline=self.pipeline,
+                                      breakers=self.breakers, profiler=self.profiler)
+                if status == 203:
+                    # Chain was not used, host is parked on breakers.
+                    continue
+                if status not in (100, 101):
+                    # Unknown where agent is in the jump chain, drop chain.
+                    broken = True
+                if status not in (100, 101, 201):
+                    self.failed.append(name)
+            except (SystemExit, Exception) as e:
+                # ConnectionAgent exits on failure. Do not let worker die, drop chain instead.
+                logging.error("{} could not collect {} ({})! "
+                              "Jump chain will be dropped.".format(self.name, name, repr(e)))
+                self.failed.append(name)
+                broken = True
+            finally:
+                if agent is not None:
+                    chain_pool.checkin(agent, broken=broken)
+                self.scheduler.done(chain_pool)
+
+        logging.debug("{} finished, no hosts left.".format(self.name))
+
+
+class WorkerPool(object):
+    """
+    Pool of collector workers sharing one scheduler and Host Manager.
+    """
+
+    def __init__(self, chain_pool, hm, workers=4, pipeline=0, profiler=None, breakers=None):
+        """
+        Worker pool for parallel collection.
+
+        Args:
+            chain_pool: JumpChainPool, or PathPools for hosts with own jump path (obj)
+            hm: Shared HostManagment object (obj)
+            workers: Number of workers (int)
+            pipeline: Commands sent at once per batch, 0 sends one by one (int)
+            profiler: Profiler to profile every host with (obj)
+            breakers: CircuitBreakers of jumpservers and sites (obj)
+        """
+
+        self.chain_pool = chain_pool
+        self.hm = hm
+        self.workers = max(1, workers)
+        self.pipeline = pipeline
+        self.profiler = profiler
+        self.breakers = breakers
+
+    def pool_for(self, host):
+        """
+        Function to return JumpChainPool of jump path of host.
+        """
+
+        if not isinstance(self.chain_pool, PathPools):
+            return self.chain_pool
+
+        path = host.path if isinstance(host, Device) else None
+        return self.chain_pool.get(path)
+
+    def run(self, hosts, commands):
+        """
+        Function to collect commands for all hosts. Blocks until finished.
+        Jump chains stay in the chain pool for following runs.
+
+        Args:
+            hosts: Hosts or Device objects, list or generator (inventory) (iter)
+            commands: List of commands (lst)
+
+        Returns:
+            list: Hosts that could not be collected.
+        """
+
+        # Bounded backlog, hosts are read from inventory while workers collect.
+        scheduler = PathScheduler(self.chain_pool.condition, backlog=self.workers * 16,
+                                  breakers=self.breakers, pool_for=self.pool_for)
+
+        pool = []
+        for n in range(self.workers):
+            w = CollectorWorker('Worker-{}'.format(n + 1), scheduler,
+                                self.hm, commands, pipeline=self.pipeline,
+                                profiler=self.profiler, breakers=self.breakers)
+            pool.append(w)
+            w.start()
+
+        logging.info("Started {} workers.".format(len(pool)))
+
+        count = 0
+        failed = []
+        for host in hosts:
+            try:
+                chain_pool = self.pool_for(host)
+            except KeyError as e:
+                name = host.name if isinstance(host, Device) else host
+                logging.error("No jump path for {}: {}".format(name, e.args[0]))
+                failed.append(name)
+                continue
+            scheduler.put(chain_pool, host)
+            count += 1
+
+        scheduler.close()
+
+        logging.info("Queued {} hosts.".format(count))
+
+        for w in pool:
+            w.join()
+            failed.extend(w.failed)
+        failed.extend(scheduler.failed)
+
+        if failed:
+            logging.error("Could not collect {} hosts: {}".format(len(failed), ', '.join(failed)))
+
+        return failed
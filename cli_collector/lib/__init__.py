@@ -1,4 +1,11 @@
 import accountmgr
 import ConnectionManager
 import HostManager
-import utils
\ No newline at end of file
+import InventoryManager
+import LoopManager
+import ParseManager
+import ProfileManager
+import TimeoutManager
+import TransportManager
+import utils
+import WorkerManager
\ No newline at end of file
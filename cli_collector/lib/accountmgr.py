@@ -28,7 +28,12 @@ import ConfigParser
 import getpass
 import fnmatch
 import logging
+import os
+import re
 import sys
+import threading
+import time
+from multiprocessing.managers import BaseManager
 
 try:
     import keyring
@@ -44,6 +49,35 @@ def make_realm(name):
     """
     return "Accelerated Upgrade@{}".format(name)
 
+class TokenBucket(object):
+    """
+    Token bucket for login rate limiting. Callers queue behind the limit instead of failing:
+    every acquire() takes a token, possibly in advance, and sleeps until it is due.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)  # Tokens added per second (float)
+        self.burst = float(burst or max(1.0, self.rate))  # Maximum tokens in bucket (float)
+        self.tokens = self.burst  # Tokens available, negative when callers are queued (float)
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self, block=True):
+        """
+        Take one token, blocks until it is available. Returns seconds waited.
+        Without block the token is taken without sleeping, caller waits the returned seconds.
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+        # Sleep outside of lock, later callers reserve the tokens after this one.
+        if wait > 0 and block:
+            time.sleep(wait)
+        return wait
+
 class AccountManager(object):
     """
     Account manager object.
@@ -52,18 +86,23 @@ class AccountManager(object):
                  config_file,
                  username_cb=None,
                  password_cb=None,
-                 reset=False):
+                 reset=False,
+                 cache_ttl=900):
         if config_file is None:
             logging.error("No account details set!")
             sys.exit(201)
 
         self.config_file = config_file
-        self.config = ConfigParser.SafeConfigParser({'username': '', 'password_type': ''})
-        self.config.read(self.config_file)
-        self.config.write(open(self.config_file, 'w'))
+        self.config = self._read_config()
+        self._build_section_index()
         self.allowed_password_types=['Fixed', 'PublicKey', 'NoPassword']
         self.reset = reset
         self.already_reset = []
+        self.lock = threading.RLock()  # Workers share this object, prompt one at a time.
+        self.cache_ttl = cache_ttl  # Seconds a resolved password is kept in memory (int)
+        self._secrets = {}  # Resolved passwords as (section, username) -> (password, expires) (dict)
+        self._buckets = {}  # Login rate limits as (section, site) -> TokenBucket (dict)
+        self._bucket_lock = threading.Lock()
 
         if self.reset:
             logging.warn('Password reset flag set, passwords will be prompted!')
@@ -80,12 +119,57 @@ class AccountManager(object):
     def _prompt_for_password(self, prompt):
         return getpass.getpass(prompt)
 
+    def _read_config(self):
+        config = ConfigParser.SafeConfigParser({'username': '', 'password_type': '',
+                                                'login_rate': '', 'login_burst': '', 'login_rate_scope': ''})
+        # Config file is only read. Collectors started together must not race on rewriting it.
+        if not config.read(self.config_file):
+            logging.warn('Credential file {} could not be read, using defaults!'.format(self.config_file))
+        return config
+
+    def reload(self):
+        """
+        Re-read config file into a new parser, so removed sections are gone. Only moment section index,
+        realm cache, cached passwords and login rate limits are invalidated.
+        """
+        config = self._read_config()
+        with self.lock:
+            self.config = config
+            self._build_section_index()
+            self._secrets = {}
+        with self._bucket_lock:
+            self._buckets = {}
+
+    def _build_section_index(self):
+        # Sections without wildcards are looked up directly, glob sections are compiled once.
+        # Order of sections in file is kept, first matching section wins.
+        self._exact_sections = {}
+        self._glob_sections = []
+        self._section_cache = {}
+
+        for order, section in enumerate(self.config.sections()):
+            name = os.path.normcase(section)
+            if any(c in name for c in '*?['):
+                self._glob_sections.append((order, re.compile(fnmatch.translate(name)), section))
+            elif name not in self._exact_sections:
+                self._exact_sections[name] = (order, section)
+
     def _find_section(self, realm):
-        for section in iter(self.config.sections()):
-            if fnmatch.fnmatch(realm, section):
+        if realm in self._section_cache:
+            return self._section_cache[realm]
+
+        name = os.path.normcase(realm)
+        order, section = self._exact_sections.get(name, (None, 'DEFAULT'))
+
+        # Glob section before exact section in file takes precedence.
+        for glob_order, pattern, glob_section in self._glob_sections:
+            if order is not None and glob_order > order:
+                break
+            if pattern.match(name):
+                section = glob_section
                 break
-        else:
-            section = 'DEFAULT'
+
+        self._section_cache[realm] = section
         return section
 
     def _get_username(self, section):
@@ -121,29 +205,45 @@ class AccountManager(object):
         section = self._find_section(realm)
         config_user_name = self._get_username(section)
         if not config_user_name or username != config_user_name:
-                return Noner
+                return None
         if not username:
             username = config_user_name
 
-        try:
-            if self.reset or reset:
-                if username not in self.already_reset or reset:
-                    keyring.delete_password(make_realm(section), username)
-                    self.already_reset.append(username)
-            password = keyring.get_password(make_realm(section), username)
-        except:
-            password = None
+        with self.lock:
+            # Keyring is only asked once per section and user while cached password is valid.
+            cached = self._secrets.get((section, username))
+            if cached is not None and cached[1] > time.time() and not reset:
+                return cached[0]
 
-        if password is None and interact:
-            prompt = "{}@{} Password: ".format(username, realm)
-            password = self.password_cb(prompt)
-            self.set_password(
-                make_realm(section),
-                username,
-                password)
+            try:
+                if self.reset or reset:
+                    if username not in self.already_reset or reset:
+                        keyring.delete_password(make_realm(section), username)
+                        self.already_reset.append(username)
+                password = keyring.get_password(make_realm(section), username)
+            except:
+                password = None
+
+            if password is None and interact:
+                prompt = "{}@{} Password: ".format(username, realm)
+                password = self.password_cb(prompt)
+                self.set_password(
+                    make_realm(section),
+                    username,
+                    password)
+
+            if password is not None:
+                self._secrets[(section, username)] = (password, time.time() + self.cache_ttl)
 
         return password
 
+    def clear_cache(self):
+        """
+        Forget all passwords kept in memory.
+        """
+        with self.lock:
+            self._secrets = {}
+
     def set_password(self, realm, username, password):
         try:
             keyring.set_password(
@@ -157,4 +257,185 @@ class AccountManager(object):
     def get_login(self, realm):
         username = self.get_username(realm)
         password = self.get_password(realm, username)
-        return (username, password)
\ No newline at end of file
+        return (username, password)
+
+    def _get_bucket(self, section, site):
+        # Buckets are per section, or per section and site with login_rate_scope = site.
+        rate = self.config.get(section, 'login_rate')
+        if rate == '':
+            return None
+        if self.config.get(section, 'login_rate_scope') != 'site':
+            site = None
+
+        with self._bucket_lock:
+            if (section, site) not in self._buckets:
+                burst = self.config.get(section, 'login_burst')
+                try:
+                    self._buckets[(section, site)] = TokenBucket(float(rate), float(burst) if burst else None)
+                except ValueError:
+                    logging.error('Invalid login rate for section {}, not limited!'.format(section))
+                    self._buckets[(section, site)] = None
+            return self._buckets[(section, site)]
+
+    def acquire_login(self, realm, site=None, block=True):
+        """
+        Wait for login rate limit of section of realm (login_rate logins per second,
+        bursts of login_burst). Returns seconds waited, without block the caller waits them.
+        """
+        section = self._find_section(realm)
+        bucket = self._get_bucket(section, site)
+        if bucket is None:
+            return 0.0
+
+        wait = bucket.acquire(block)
+        if wait > 0:
+            logging.debug('Login to {} waited {:.3f}s for rate limit of section {}.'.format(realm, wait, section))
+        return wait
+
+class _BrokerClientManager(BaseManager):
+    pass
+
+
+_BrokerClientManager.register('accounts')
+
+# Addresses a credential broker may listen on, besides unix sockets.
+LOOPBACK_HOSTS = ('127.0.0.1', 'localhost')
+
+
+def format_address(address):
+    """
+    Function to return broker address as HOST:PORT, or path of unix socket.
+    """
+    if isinstance(address, (list, tuple)):
+        return '{}:{}'.format(*address)
+    return address
+
+
+class _BrokerAccounts(object):
+    """
+    Credentials served by a CredentialBroker. Passwords cannot be reset by clients.
+    """
+
+    def __init__(self, am):
+        self.am = am
+
+    def get_username(self, realm):
+        return self.am.get_username(realm)
+
+    def get_password_type(self, realm):
+        return self.am.get_password_type(realm)
+
+    def get_password(self, realm, username=None, interact=True):
+        return self.am.get_password(realm, username, interact)
+
+    def get_login(self, realm):
+        return self.am.get_login(realm)
+
+    def acquire_login(self, realm, site=None, block=True):
+        return self.am.acquire_login(realm, site, block)
+
+
+class CredentialBroker(object):
+    """
+    Credential broker serving one AccountManager to other processes over a local socket.
+    Every realm and user is resolved once, by the process owning the keyring and terminal.
+    Only listens on loopback, or on a unix socket only the owner can access.
+    """
+
+    exposed = ('get_username', 'get_password_type', 'get_password', 'get_login', 'acquire_login')
+
+    def __init__(self, am, address=('127.0.0.1', 0), authkey=None):
+        """
+        Credential broker.
+
+        Args:
+            am: AccountManager to resolve credentials with (obj)
+            address: Address to listen on as (host, port) on loopback (tuple), or path of unix socket (str)
+            authkey: Key clients have to authenticate with, random when not set (bytes)
+        """
+
+        if isinstance(address, (list, tuple)) and address[0] not in LOOPBACK_HOSTS:
+            logging.critical('Credential broker can only listen on {} or a unix socket, not {}!'.format(
+                ', '.join(LOOPBACK_HOSTS), address[0]))
+            sys.exit(201)
+
+        self.am = am
+        self.authkey = authkey or os.urandom(16)
+
+        # Registry is kept per broker, register() changes the class it is called on.
+        accounts = _BrokerAccounts(am)
+        manager_class = type('_BrokerServerManager', (BaseManager,), {})
+        manager_class.register('accounts', callable=lambda: accounts, exposed=self.exposed)
+
+        # Unix socket is created accessible by owner only (0600).
+        umask = os.umask(0o177)
+        try:
+            self.server = manager_class(address=address, authkey=self.authkey).get_server()
+        finally:
+            os.umask(umask)
+        self.address = self.server.address  # Address clients connect to (tuple or str)
+
+    def start(self):
+        """
+        Function to serve credentials from a daemon thread of this process.
+        """
+
+        thread = threading.Thread(target=self.server.serve_forever, name='CredentialBroker')
+        thread.daemon = True
+        thread.start()
+        logging.info('Credential broker listening on {}.'.format(format_address(self.address)))
+
+    def client(self):
+        """
+        Returns:
+            object: BrokerClient for this broker, can be passed to worker processes.
+        """
+        return BrokerClient(self.address, self.authkey)
+
+
+class BrokerClient(object):
+    """
+    AccountManager replacement getting credentials from a CredentialBroker.
+    Connects lazily, so it can be pickled and passed to worker processes.
+    Passwords are never reset through the broker.
+    """
+
+    def __init__(self, address, authkey):
+        self.address = tuple(address) if isinstance(address, (list, tuple)) else address
+        self.authkey = authkey
+        self._accounts = None
+        self._pid = None
+
+    def __getstate__(self):
+        return {'address': self.address, 'authkey': self.authkey, '_accounts': None, '_pid': None}
+
+    def _get_accounts(self):
+        # Connection of parent process cannot be used after fork.
+        if self._accounts is None or self._pid != os.getpid():
+            manager = _BrokerClientManager(address=self.address, authkey=self.authkey)
+            try:
+                manager.connect()
+            except (IOError, OSError) as e:
+                logging.critical('Could not connect to credential broker {} ({})!'.format(
+                    format_address(self.address), e))
+                sys.exit(103)
+            self._accounts = manager.accounts()
+            self._pid = os.getpid()
+        return self._accounts
+
+    def get_username(self, realm):
+        return self._get_accounts().get_username(realm)
+
+    def get_password_type(self, realm):
+        return self._get_accounts().get_password_type(realm)
+
+    def get_password(self, realm, username=None, interact=True, reset=False):
+        if reset:
+            logging.warn('Password of {} cannot be reset through credential broker.'.format(realm))
+        return self._get_accounts().get_password(realm, username, interact)
+
+    def get_login(self, realm):
+        return self._get_accounts().get_login(realm)
+
+    def acquire_login(self, realm, site=None, block=True):
+        return self._get_accounts().acquire_login(realm, site, block)
@@ -12,6 +12,11 @@ __maintainer__ = "Thomas Jongerius"
 __email__ = "thomasjongerius@yaworks.nl"
 __status__ = "Development"
 
+import errno
+import re
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+import select
 import socket
 import time
 import json
@@ -68,30 +73,184 @@ def is_reachable(host, port=23):
     :return: True if host is reachable else false
     """
 
+    reachable, unreachable = reachability_sweep([host], port=port)
+    return len(reachable) > 0
+
+
+# Sockets select() can watch, poll() has no such limit (no poll() on Windows).
+SELECT_LIMIT = 500
+
+
+def _resolve(job):
+    # Resolves (index, host, port) in a resolver thread.
+    index, host, port = job
     try:
-        addresses = socket.getaddrinfo(
-            host, port, socket.AF_UNSPEC, socket.SOCK_STREAM
-        )
+        return index, host, socket.getaddrinfo(host, port, socket.AF_UNSPEC, socket.SOCK_STREAM)
     except socket.gaierror:
-        return False
-
-    for family, socktype, proto, cannonname, sockaddr in addresses:
-        sock = socket.socket(family, socket.SOCK_STREAM)
-        #sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 0)
-        sock.settimeout(5)
-        try:
-            sock.connect(sockaddr)
-        except IOError as e:
+        return index, host, []
+
+
+def reachability_sweep(hosts, port=22, timeout=5, concurrency=200, resolvers=16):
+    """
+    This function checks reachability for a list of hosts concurrently.
+    Non-blocking TCP connects, at most concurrency sockets open at a time.
+    Names are resolved by resolver threads while connecting.
+    All addresses of a host are tried (IPv4 and IPv6).
+    :param hosts list: hostnames or ip address strings, or (host, port) tuples
+    :param port number: tcp port number of hosts without port
+    :param timeout number: seconds to wait for a connect per address
+    :param concurrency number: maximum connects in progress
+    :param resolvers number: threads resolving names
+    :rtype: tuple
+    :return: (reachable, unreachable) lists of hosts, in order of hosts
+    """
+
+    in_progress = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY, 10035)
+    poller = select.poll() if hasattr(select, 'poll') else None
+    if poller is None:
+        concurrency = min(concurrency, SELECT_LIMIT)
+    pending = {}  # fd: [socket, index, host, remaining addresses, deadline]
+    result = {}
+
+    def start(index, host, addresses):
+        # Start connect to first address that does not fail directly.
+        while addresses:
+            family, socktype, proto, cannonname, sockaddr = addresses.pop(0)
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sock.setblocking(0)
+            err = sock.connect_ex(sockaddr)
+            if err in (0, errno.EISCONN):
+                sock.close()
+                result[index] = True
+                return
+            if err in in_progress:
+                pending[sock.fileno()] = [sock, index, host, addresses, time.time() + timeout]
+                if poller is not None:
+                    poller.register(sock, select.POLLOUT)
+                return
+            sock.close()
+        result[index] = False
+
+    pool = ThreadPool(max(1, min(resolvers, len(hosts))))
+    jobs = [(i,) + (h if isinstance(h, tuple) else (h, port)) for i, h in enumerate(hosts)]
+    resolved = pool.imap_unordered(_resolve, jobs)
+    pool.close()
+    resolving = True
+
+    while resolving or pending:
+        while resolving and len(pending) < concurrency:
+            try:
+                # Only wait for names when no connects are in progress.
+                index, host, addresses = resolved.next(timeout=0 if pending else None)
+            except StopIteration:
+                resolving = False
+                break
+            except TimeoutError:
+                break
+            start(index, host, addresses)
+
+        if not pending:
             continue
 
-        sock.shutdown(socket.SHUT_RDWR)
-        sock.close()
-        # Wait 2 sec for socket to shutdown
-        time.sleep(2)
-        break
-    else:
-        return False
-    return True
+        wait = max(0, min(p[4] for p in pending.values()) - time.time())
+        if poller is not None:
+            # Resolved names are picked up at least every 50ms.
+            ready = set(fd for fd, event in poller.poll(1000 * (min(wait, 0.05) if resolving else wait)))
+        else:
+            socks = [p[0] for p in pending.values()]
+            r, writable, failed = select.select([], socks, socks, min(wait, 0.05) if resolving else wait)
+            ready = set(sock.fileno() for sock in writable + failed)
+
+        now = time.time()
+        for fd in list(pending):
+            sock = pending[fd][0]
+            if fd in ready:
+                connected = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0
+            elif now >= pending[fd][4]:
+                connected = False
+            else:
+                continue
+
+            sock, index, host, addresses, deadline = pending.pop(fd)
+            if poller is not None:
+                poller.unregister(fd)
+            sock.close()
+
+            if connected:
+                result[index] = True
+            else:
+                start(index, host, addresses)
+
+    pool.join()
+
+    reachable = [h for i, h in enumerate(hosts) if result.get(i)]
+    unreachable = [h for i, h in enumerate(hosts) if not result.get(i)]
+
+    return reachable, unreachable
+
+
+# Targets safe to put on a remote command line unquoted.
+SAFE_TARGET = re.compile(r'^[A-Za-z0-9._:-]+$')
+REACHABILITY_LINE = re.compile(r'^PREFLIGHT (UP|DOWN|UNKNOWN) (\S+)/(\d+)\s*$', re.M)
+
+
+def reachability_command(hosts, timeout=5, shell='/bin/bash'):
+    """
+    This function returns a shell command checking reachability of hosts from a remote shell,
+    all hosts at once, one line per host: PREFLIGHT UP|DOWN|UNKNOWN host/port.
+    TCP connects use /dev/tcp of shell (bash) and the timeout command. When those are missing
+    hosts are UNKNOWN, not DOWN. Hosts with characters unsafe for a command line are left out.
+    :param hosts list: (host, port) tuples
+    :param timeout number: seconds to wait for a connect per host
+    :param shell string: shell with /dev/tcp support on remote host
+    :rtype: str
+    :return: command line for remote shell, None if no host can be checked
+    """
+
+    targets = ['{}/{}'.format(h, int(p)) for h, p in hosts if SAFE_TARGET.match(str(h))]
+    if not targets:
+        return None
+
+    # Exit 1 is a refused or failed connect, 124 a connect that timed out.
+    probe = ('(timeout {timeout} {shell} -c "exec 3<>/dev/tcp/$t" 2>/dev/null; r=$?; '
+             'if [ $r -eq 0 ]; then s=UP; elif [ $r -eq 1 -o $r -eq 124 ]; then s=DOWN; else s=UNKNOWN; fi; '
+             'echo "PREFLIGHT $s $t") &').format(timeout=int(timeout), shell=shell)
+
+    return "{} -c 'for t in {}; do {} done; wait'".format(shell, ' '.join(targets), probe)
+
+
+def parse_reachability(output):
+    """
+    This function parses output of reachability_command.
+    :param output string: output of command
+    :rtype: tuple
+    :return: (reachable, unreachable) lists of (host, port) tuples, hosts without result are in neither
+    """
+
+    reachable, unreachable = [], []
+    for state, host, port in REACHABILITY_LINE.findall(output or ''):
+        if state == 'UP':
+            reachable.append((host, int(port)))
+        elif state == 'DOWN':
+            unreachable.append((host, int(port)))
+
+    return reachable, unreachable
+
+
+def percentiles(values, points=(50, 95, 99)):
+    """
+    This function returns percentiles of values (nearest rank).
+    :param values list: numbers
+    :param points tuple: percentiles to return
+    :rtype: dict
+    :return: percentile -> value, None for every percentile if no values
+    """
+
+    ordered = sorted(values)
+    if not ordered:
+        return dict((p, None) for p in points)
+
+    return dict((p, ordered[max(0, int(-(-p * len(ordered) // 100)) - 1)]) for p in points)
 
 
 def read_from_json_file(filename):
@@ -0,0 +1,102 @@
+"""
+Fixtures for tests against the simulator (lib/Simulator.py), no network or routers needed.
+"""
+
+import Queue
+import os
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib import ConnectionManager, HostManager, Simulator, TransportManager  # noqa: E402
+
+
+def simulator_command(**settings):
+    """
+    Function to return connection command starting a simulated jumpserver.
+    """
+
+    simulator = os.path.splitext(os.path.abspath(Simulator.__file__))[0] + '.py'
+    options = ['--{} {}'.format(k, v) for k, v in sorted(settings.items())]
+
+    return ' '.join([sys.executable, simulator, 'simjump', '--jump'] + options)
+
+
+@pytest.fixture
+def agent_factory():
+    """
+    Factory of ConnectionAgents connected to a simulated jumpserver. Agents are closed after the test.
+    """
+
+    agents = []
+
+    def factory(timeout=5, large_output=None, **settings):
+        jumpserver = HostManager.Device('simjump', prompt=r'simjump\$', ssh='ssh USER@HOST -p PORT',
+                                        telnet='telnet HOST PORT', connection_type='SSH', timeout=timeout, port=22)
+        agent = ConnectionManager.ConnectionAgent(am=Simulator.StaticAccounts(),
+                                                  ssh_command=simulator_command(**settings),
+                                                  timeout=timeout,
+                                                  jumpservers=[jumpserver],
+                                                  large_output=large_output)
+        agents.append(agent)
+        return agent
+
+    yield factory
+
+    for agent in agents:
+        agent.close()
+
+
+class ChannelDevice(object):
+    """
+    Device on the far end of a channel: every response arrives rtt seconds after its command was sent.
+    Greeting is sent first instead of the prompt, to leave data behind the first prompt.
+    """
+
+    def __init__(self, sock, rtt=0, prompt='r1#', greeting=None, output_lines=2):
+        self.sock = sock
+        self.rtt = rtt
+        self.prompt = prompt
+        self.output_lines = output_lines
+        self.responses = Queue.Queue()
+
+        self.responses.put((time.time(), greeting or prompt))
+        for target in (self.read, self.write):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def read(self):
+        commands = self.sock.makefile('r')
+        for line in iter(commands.readline, ''):
+            command = line.rstrip('\r\n')
+            output = ''.join('r1 line {} of {}\r\n'.format(n, command) for n in range(self.output_lines))
+            self.responses.put((time.time() + self.rtt, command + '\r\n' + output + self.prompt))
+
+    def write(self):
+        while True:
+            deadline, data = self.responses.get()
+            time.sleep(max(0, deadline - time.time()))
+            self.sock.sendall(data)
+
+
+def channel_agent(rtt=0, greeting=None, output_lines=2, **settings):
+    """
+    Function to return ConnectionAgent at prompt of a ChannelDevice. Native transport without
+    jumpservers, the session is a socket pair.
+    """
+
+    agent = ConnectionManager.ConnectionAgent(am=Simulator.StaticAccounts(), transport='SOCKET', timeout=5,
+                                              **settings)
+    near, far = socket.socketpair()
+    ChannelDevice(far, rtt=rtt, greeting=greeting, output_lines=output_lines)
+
+    agent.prompt = TransportManager.ChannelSpawn(near, timeout=5)
+    agent.prompt.expect_exact('r1#')
+    agent.current_prompt = 'r1#'
+    return agent
@@ -0,0 +1,100 @@
+"""
+Tests of credential lookup: section index (exact and glob sections, in order of file) and reload.
+Login rate limits: token buckets per section, or per section and site.
+"""
+
+import time
+
+from lib import accountmgr
+
+CREDENTIALS = """
+[10.1.*]
+username = early-glob
+
+[10.1.1.1]
+username = exact-after-glob
+
+[core1]
+username = exact
+
+[core*]
+username = late-glob
+"""
+
+
+def account_manager(tmpdir, credentials=CREDENTIALS):
+    config = tmpdir.join('credentials.ini')
+    config.write(credentials)
+    return accountmgr.AccountManager(str(config))
+
+
+def test_exact_section_before_glob_wins(tmpdir):
+    am = account_manager(tmpdir)
+
+    assert am.get_username('core1') == 'exact'
+    assert am.get_username('core2') == 'late-glob'
+
+
+def test_glob_section_before_exact_wins(tmpdir):
+    am = account_manager(tmpdir)
+
+    # First matching section of the file, like fnmatch over all sections in order.
+    assert am.get_username('10.1.1.1') == 'early-glob'
+    assert am.get_username('10.1.2.3') == 'early-glob'
+
+
+def test_no_section_is_default(tmpdir):
+    am = account_manager(tmpdir)
+
+    assert am._find_section('edge1') == 'DEFAULT'
+
+
+def test_sections_only_change_on_reload(tmpdir):
+    am = account_manager(tmpdir)
+    assert am.get_username('core1') == 'exact'
+
+    tmpdir.join('credentials.ini').write("[core*]\nusername = reloaded\n")
+    assert am.get_username('core1') == 'exact'
+
+    am.reload()
+    assert am.get_username('core1') == 'reloaded'
+    assert not am.config.has_section('10.1.1.1')
+    assert am._find_section('10.1.1.1') == 'DEFAULT'
+
+
+def test_bucket_burst_then_rate():
+    bucket = accountmgr.TokenBucket(rate=20, burst=2)
+
+    waits = [bucket.acquire(block=False) for n in range(6)]
+
+    # Burst is taken at once, every following login is due 1 / rate after the one before.
+    assert waits[:2] == [0.0, 0.0]
+    for n, wait in enumerate(waits[2:]):
+        assert abs(wait - (n + 1) / 20.0) < 0.01
+
+
+def test_blocking_bucket_keeps_rate():
+    bucket = accountmgr.TokenBucket(rate=50, burst=1)
+
+    start = time.time()
+    for n in range(11):
+        bucket.acquire()
+
+    assert 10 / 50.0 - 0.01 <= time.time() - start < 10 / 50.0 + 0.1
+
+
+def test_login_rate_per_section_and_site(tmpdir):
+    am = account_manager(tmpdir, """
+[core*]
+login_rate = 1
+
+[edge*]
+login_rate = 1
+login_rate_scope = site
+""")
+
+    assert am.acquire_login('core1', site='ams', block=False) == 0.0
+    assert am.acquire_login('core2', site='fra', block=False) > 0.9
+    assert am.acquire_login('edge1', site='ams', block=False) == 0.0
+    assert am.acquire_login('edge2', site='fra', block=False) == 0.0
+    assert am.acquire_login('other', site='ams', block=False) == 0.0
@@ -0,0 +1,182 @@
+"""
+Tests of circuit breaker transitions: closed, open, half-open (one probe) and given up.
+"""
+
+import time
+
+import pytest
+
+from lib import HostManager, ProfileManager, WorkerManager
+
+SITE = ('SITE', 'ams')
+RESET = 0.05
+
+
+def open_breaker(breakers, failures=2):
+    for n in range(failures):
+        breakers.failure([SITE])
+
+
+def half_open():
+    time.sleep(RESET * 2)
+
+
+def test_opens_at_threshold():
+    breakers = WorkerManager.CircuitBreakers(threshold=2, reset_timeout=RESET)
+
+    breakers.failure([SITE])
+    assert breakers.check([SITE]) is None
+
+    breakers.failure([SITE])
+    assert breakers.check([SITE]) == SITE
+
+
+def test_success_resets_failures():
+    breakers = WorkerManager.CircuitBreakers(threshold=2, reset_timeout=RESET)
+
+    breakers.failure([SITE])
+    breakers.success([SITE])
+    breakers.failure([SITE])
+    assert breakers.check([SITE]) is None
+
+
+def test_half_open_lets_exactly_one_probe_through():
+    breakers = WorkerManager.CircuitBreakers(threshold=2, reset_timeout=RESET)
+    open_breaker(breakers)
+    half_open()
+
+    assert breakers.check([SITE]) is None
+    assert breakers.check([SITE]) == SITE
+
+
+def test_failed_probe_opens_again():
+    breakers = WorkerManager.CircuitBreakers(threshold=2, reset_timeout=RESET)
+    open_breaker(breakers)
+    half_open()
+
+    assert breakers.check([SITE]) is None
+    breakers.failure([SITE])
+    assert breakers.check([SITE]) == SITE
+
+    half_open()
+    assert breakers.check([SITE]) is None
+
+
+def test_parked_hosts_wait_for_probe_and_are_released_on_success():
+    breakers = WorkerManager.CircuitBreakers(threshold=2, reset_timeout=RESET)
+    open_breaker(breakers)
+    for host in ('r1', 'r2', 'r3'):
+        breakers.park(SITE, host)
+
+    ready, lost, wait = breakers.release()
+    assert ready == [] and lost == [] and 0 < wait <= RESET
+
+    # One parked host is released to probe, the others wait for its outcome.
+    half_open()
+    assert breakers.release()[0] == ['r1']
+    assert breakers.release()[0] == []
+    assert breakers.check([SITE]) is None
+
+    breakers.success([SITE])
+    assert breakers.release()[0] == ['r2', 'r3']
+    assert breakers.waiting() == 0
+
+
+def test_parked_hosts_given_up_after_failed_probes():
+    breakers = WorkerManager.CircuitBreakers(threshold=2, reset_timeout=RESET, probes=2)
+    open_breaker(breakers)
+    breakers.park(SITE, 'r1')
+    breakers.park(SITE, 'r2')
+
+    for n in range(2):
+        half_open()
+        assert breakers.check([SITE]) is None
+        breakers.failure([SITE])
+
+    ready, lost, wait = breakers.release()
+    assert ready == [] and lost == ['r1', 'r2']
+    assert breakers.waiting() == 0
+
+    # Following hosts are not parked anymore.
+    breakers.park(SITE, 'r3')
+    assert breakers.release()[1] == ['r3']
+
+
+def test_site_breaker_only_with_inventory_site():
+    assert WorkerManager.breaker_keys('r1') == []
+    assert WorkerManager.breaker_keys(HostManager.Device('r1', path=('jump1',))) == []
+    assert WorkerManager.breaker_keys(HostManager.Device('r1', site='ams')) == [SITE]
+
+
+def test_release_parked_yields_parked_hosts_after_inventory():
+    breakers = WorkerManager.CircuitBreakers(threshold=1, reset_timeout=RESET)
+    breakers.failure([SITE])
+
+    collected = []
+    for host in WorkerManager.release_parked(['r1', 'r2'], breakers):
+        if breakers.check([SITE]) is not None:
+            breakers.park(SITE, host)
+            continue
+        breakers.success([SITE])
+        collected.append(host)
+
+    assert sorted(collected) == ['r1', 'r2']
+
+
+class DeadChainPool(object):
+    """
+    Pool of one path whose reserved idle chain is dead and whose new chains cannot be built.
+    """
+
+    path = ('jump1',)
+
+    def claim(self, reservation):
+        return None
+
+    def checkout(self):
+        raise SystemExit(200)
+
+
+def test_dead_idle_chain_is_no_success_and_checkout_counts():
+    jump = WorkerManager.jump_keys(DeadChainPool.path)
+    breakers = WorkerManager.CircuitBreakers(threshold=2, reset_timeout=RESET)
+    worker = WorkerManager.CollectorWorker('worker-1', None, HostManager.HostManagment(), [], breakers=breakers)
+    breakers.failure(jump)
+
+    assert worker._claim(DeadChainPool(), ('idle agent', time.time())) is None
+    assert breakers.check(jump) is None
+
+    # Chain checked out instead fails to build, second failure in a row opens the breaker.
+    with pytest.raises(SystemExit):
+        worker._claim(DeadChainPool())
+    assert breakers.check(jump) == jump[0]
+
+
+class RefusingAgent(object):
+    """
+    Agent whose hosts refuse the connection.
+    """
+
+    def host_connect(self, host, **settings):
+        return 200
+
+    def pop_spans(self):
+        return []
+
+
+def test_parked_host_is_profiled_once_when_collected(tmpdir):
+    breakers = WorkerManager.CircuitBreakers(threshold=1, reset_timeout=RESET)
+    profiler = ProfileManager.Profiler(str(tmpdir))
+    hm = HostManager.HostManagment()
+    device = HostManager.Device('r1', site='ams')
+    breakers.failure([SITE])
+
+    assert WorkerManager.collect_host(RefusingAgent(), hm, device, ['show clock'], breakers=breakers,
+                                      profiler=profiler) == 203
+    assert profiler.host_files == []
+
+    half_open()
+    assert WorkerManager.collect_host(RefusingAgent(), hm, device, ['show clock'], breakers=breakers,
+                                      profiler=profiler) == 200
+    assert profiler.host_files == [str(tmpdir.join('hosts', 'r1.prof'))]
+    assert list(profiler.host_counters) == ['r1']
@@ -0,0 +1,38 @@
+"""
+Tests of streaming NDJSON export: records reach the file while collecting, also without more writes.
+"""
+
+import gzip
+import json
+import time
+
+from lib import HostManager
+
+
+def records(filename):
+    with open(filename) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_records_flushed_by_timer_while_idle(tmpdir):
+    filename = str(tmpdir.join('output.ndjson'))
+    exporter = HostManager.NDJSONExporter(filename, flush_every=100, flush_interval=0.1)
+
+    exporter.write_spans('r1', [])
+    # Collector waits on a slow host, no write follows to flush the record.
+    time.sleep(0.5)
+
+    assert records(filename) == [{'HOST': 'r1', 'SPANS': []}]
+    exporter.close()
+
+
+def test_close_flushes_and_closes_once(tmpdir):
+    filename = str(tmpdir.join('output.ndjson.gz'))
+    exporter = HostManager.NDJSONExporter(filename, flush_every=100, flush_interval=60)
+
+    exporter.write_spans('r1', [])
+    exporter.close()
+    exporter.close()
+
+    with gzip.open(filename) as f:
+        assert [json.loads(line) for line in f] == [{'HOST': 'r1', 'SPANS': []}]
@@ -0,0 +1,80 @@
+"""
+Tests of reading inventories: device lists, CSV and JSON lines, read one device at a time.
+"""
+
+import types
+
+import pytest
+
+from lib import InventoryManager
+
+
+def inventory(tmpdir, filename, content):
+    path = tmpdir.join(filename)
+    path.write(content)
+    return list(InventoryManager.read_inventory(str(path)))
+
+
+def test_device_list_with_comments(tmpdir):
+    devices = inventory(tmpdir, 'devices.txt', "r1\n# core routers\n\nr2  # spare\n")
+
+    assert [d.name for d in devices] == ['r1', 'r2']
+    assert devices[0].path is None
+
+
+def test_csv_columns(tmpdir):
+    devices = inventory(tmpdir, 'devices.csv',
+                        "Name,ipv4,port,connection_type,profile,path,site,owner\n"
+                        "r1,10.0.0.1,2222,telnet,nxos,jump1 jump2,ams,noc\n"
+                        "r2,,,,,jump1;jump3,,\n")
+
+    r1, r2 = devices
+    assert (r1.name, r1.ipv4, r1.path, r1.site) == ('r1', '10.0.0.1', ('jump1', 'jump2'), 'ams')
+    assert r1.connection_settings['CONNECTION_PORT'] == 2222
+    assert r1.connection_settings['CONNECTION_TYPE'] == 'TELNET'
+    assert r1.connection_settings['PROFILE'] == 'NXOS'
+    assert (r2.ipv4, r2.path, r2.connection_settings['CONNECTION_TYPE']) == (None, ('jump1', 'jump3'), None)
+
+
+def test_invalid_values_ignored_and_nameless_records_skipped(tmpdir):
+    devices = inventory(tmpdir, 'devices.csv', "name,port,timeout\nr1,ssh,30\n,22,\n")
+
+    assert [d.name for d in devices] == ['r1']
+    assert devices[0].connection_settings['CONNECTION_PORT'] is None
+    assert devices[0].connection_settings['TIMEOUT'] == 30
+
+
+def test_json_lines(tmpdir):
+    devices = inventory(tmpdir, 'devices.jsonl',
+                        '{"name": "r1", "path": ["jump1", "jump2"], "port": 22}\n'
+                        '\n'
+                        '{"name": "r2", broken\n'
+                        '{"name": "r3", "prompt": "r3#"}\n')
+
+    assert [d.name for d in devices] == ['r1', 'r3']
+    assert devices[0].path == ('jump1', 'jump2')
+    assert devices[1].connection_settings['PROMPT'] == 'r3#'
+
+
+def test_read_lazily_but_open_right_away(tmpdir):
+    path = tmpdir.join('devices.ndjson')
+    path.write('{"name": "r1"}\n')
+
+    devices = InventoryManager.read_inventory(str(path))
+    assert isinstance(devices, types.GeneratorType)
+    assert [d.name for d in devices] == ['r1']
+
+    with pytest.raises(IOError):
+        InventoryManager.read_inventory(str(tmpdir.join('missing.csv')))
+
+
+def test_address_and_port(tmpdir):
+    r1, r2, r3 = inventory(tmpdir, 'devices.csv', "name,ipv4,port,connection_type\n"
+                                                  "r1,10.0.0.1,,\n"
+                                                  "r2,,2222,\n"
+                                                  "r3,,,telnet\n")
+
+    assert InventoryManager.address(r1) == '10.0.0.1'
+    assert InventoryManager.address(r2) == 'r2'
+    assert [InventoryManager.port(d) for d in (r1, r2, r3)] == [22, 2222, 23]
+    assert InventoryManager.port(r1, connection_type='TELNET') == 23
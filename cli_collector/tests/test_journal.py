@@ -0,0 +1,69 @@
+"""
+Tests of resuming an interrupted run from its journal.
+"""
+
+import json
+
+import pytest
+
+from lib import HostManager, WorkerManager
+
+
+def test_resume_collects_only_pending_commands(agent_factory, tmpdir):
+    storage = HostManager.DiskStorage(str(tmpdir.join('storage')))
+    journal = HostManager.RunJournal(str(tmpdir.join('runs')), storage=storage)
+    hm = HostManager.HostManagment(storage=storage, journal=journal)
+
+    # Interrupted run, only first command collected.
+    agent = agent_factory(output_lines=2)
+    assert WorkerManager.collect_host(agent, hm, 'r1', ['show version']) == 100
+    first = hm.get_output('r1', 'show version')
+    journal.close()
+
+    resumed = HostManager.RunJournal(str(tmpdir.join('runs')), run_id=journal.run_id, storage=storage)
+    hm = HostManager.HostManagment(storage=storage, journal=resumed)
+    commands = ['show version', 'show clock']
+
+    assert hm.pending_commands('r1', commands) == ['show clock']
+    assert WorkerManager.collect_host(agent, hm, 'r1', commands) == 100
+    assert hm.get_output('r1', 'show version') == first
+    assert b'r1 line 1 of show clock' in hm.get_output('r1', 'show clock')
+
+    # Nothing left, host is not connected again.
+    assert WorkerManager.collect_host(None, hm, 'r1', commands) == 100
+    resumed.close()
+    storage.close()
+
+
+def test_journal_keeps_references_not_output(tmpdir):
+    journal = HostManager.RunJournal(str(tmpdir), storage=HostManager.MemoryStorage())
+    hm = HostManager.HostManagment(journal=journal)
+
+    hm.add_command('r1', 'show version', 'caf\xe9 output')
+    journal.close()
+
+    with open(journal.filename) as f:
+        records = [json.loads(line) for line in f]
+    assert records[1]['HOST'] == 'r1'
+    assert 'OUTPUT' not in records[1]['ENTRY']
+
+    # Output in memory is gone, resume collects it again.
+    resumed = HostManager.RunJournal(str(tmpdir), run_id=journal.run_id, storage=HostManager.MemoryStorage())
+    assert resumed.entries == []
+    resumed.close()
+
+
+def test_resume_refuses_other_storage_location(tmpdir):
+    storage = HostManager.DiskStorage(str(tmpdir.join('storage')))
+    journal = HostManager.RunJournal(str(tmpdir.join('runs')), storage=storage)
+    journal.close()
+
+    # Entries are offsets into the data file of the run, not of another storage directory.
+    other = HostManager.DiskStorage(str(tmpdir.join('other')))
+    with pytest.raises(SystemExit):
+        HostManager.RunJournal(str(tmpdir.join('runs')), run_id=journal.run_id, storage=other)
+
+    resumed = HostManager.RunJournal(str(tmpdir.join('runs')), run_id=journal.run_id,
+                                     storage=HostManager.DiskStorage(str(tmpdir.join('storage'))))
+    assert resumed.entries == []
+    resumed.close()
@@ -0,0 +1,42 @@
+"""
+Tests of large output mode: output is complete and the next command does not see stale output.
+"""
+
+from conftest import channel_agent
+
+
+def lines(output):
+    return [line for line in output.splitlines() if ' line ' in line]
+
+
+def test_large_output_complete(agent_factory):
+    agent = agent_factory(output_lines=5000, large_output=['show tech'])
+    assert agent.host_connect('r1') in (100, 101)
+
+    output = agent.send_command('show tech')
+
+    assert lines(output) == ['r1 line {} of show tech'.format(n) for n in range(5000)]
+
+
+def test_command_after_large_output_gets_own_output(agent_factory):
+    agent = agent_factory(output_lines=3000, large_output=['show tech'])
+    assert agent.host_connect('r1') in (100, 101)
+
+    agent.send_command('show tech')
+    agent.send_command('show tech')
+    output = agent.send_command('show clock')
+
+    # Output of the large command before must not match the prompt of the next command.
+    assert lines(output) == ['r1 line {} of show clock'.format(n) for n in range(3000)]
+    assert lines(agent.send_commands(['show version'], batch_size=1)[0][1])[0] == 'r1 line 0 of show version'
+
+
+def test_data_left_after_prompt_not_repeated_after_large_output():
+    # Data after the first prompt stays in the buffers of the spawn, it belongs to the next command only.
+    agent = channel_agent(greeting='r1#LEFTOVER', output_lines=3000, large_output=['show tech'])
+
+    assert agent.send_command('show tech').startswith('LEFTOVER')
+    output = agent.send_command('show clock')
+
+    assert 'LEFTOVER' not in output
+    assert lines(output) == ['r1 line {} of show clock'.format(n) for n in range(3000)]
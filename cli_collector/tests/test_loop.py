@@ -0,0 +1,86 @@
+"""
+Tests of collecting on the poll loop: many sessions driven from one thread.
+"""
+
+import functools
+import threading
+import time
+
+from lib import HostManager, LoopManager, Simulator
+from conftest import simulator_command
+
+COMMANDS = ['show version', 'show clock']
+
+
+def loop_pool(hm, sessions, pipeline=0, timeout=5, max_retry=5, **settings):
+    jumpserver = HostManager.Device('simjump', prompt=r'simjump\$', ssh='ssh USER@HOST -p PORT',
+                                    telnet='telnet HOST PORT', connection_type='SSH', timeout=timeout, port=22)
+    factory = functools.partial(LoopManager.LoopAgent, am=Simulator.StaticAccounts(),
+                                ssh_command=simulator_command(**settings), timeout=timeout, max_retry=max_retry)
+
+    return LoopManager.LoopPool(factory, hm, {'simjump': jumpserver}, default_path=['simjump'],
+                                sessions=sessions, pipeline=pipeline)
+
+
+def lines(output):
+    return [line for line in output.splitlines() if ' line ' in line]
+
+
+def test_all_hosts_collected(tmpdir):
+    hm = HostManager.HostManagment()
+    hosts = ['r{}'.format(n) for n in range(6)]
+
+    assert loop_pool(hm, sessions=3, output_lines=3).run(iter(hosts), COMMANDS) == []
+
+    for host in hosts:
+        for command in COMMANDS:
+            assert lines(hm.get_output(host, command)) == ['{} line {} of {}'.format(host, n, command)
+                                                           for n in range(3)]
+    assert set(span['PHASE'] for span in hm.spans['r0']) >= {'LOGIN', 'PROMPT_DETECT', 'COMMAND', 'DISCONNECT'}
+
+
+def test_sessions_run_concurrently_in_one_thread():
+    hm = HostManager.HostManagment()
+    hosts = ['r{}'.format(n) for n in range(8)]
+    threads = threading.active_count()
+
+    # Every login waits 0.5s, one session after another would take 8 * 0.5s.
+    start = time.time()
+    assert loop_pool(hm, sessions=8, connect_latency=0.5).run(hosts, COMMANDS) == []
+
+    assert time.time() - start < 8 * 0.5 / 2
+    assert threading.active_count() == threads
+
+
+def test_pipelined_commands_on_loop():
+    hm = HostManager.HostManagment()
+    commands = ['show version', 'show ip route', 'show clock']
+
+    assert loop_pool(hm, sessions=2, pipeline=3, output_lines=4).run(['r1', 'r2'], commands) == []
+
+    for command in commands:
+        assert lines(hm.get_output('r2', command)) == ['r2 line {} of {}'.format(n, command) for n in range(4)]
+
+
+def test_denied_login_fails_host_only():
+    hm = HostManager.HostManagment()
+    hosts = ['r{}'.format(n) for n in range(6)]
+
+    # Denied login of simulator is noticed by timeout, after retry.
+    failed = loop_pool(hm, sessions=3, timeout=1, max_retry=2, fail_rate=0.5, seed=3).run(hosts, COMMANDS)
+
+    assert 0 < len(failed) < len(hosts)
+    collected = [h for h in hosts if h not in failed]
+    assert all(hm.get_output(h, 'show clock') for h in collected)
+
+
+def test_hanging_host_times_out_and_chain_is_rebuilt():
+    hm = HostManager.HostManagment()
+    hosts = ['r{}'.format(n) for n in range(6)]
+
+    failed = loop_pool(hm, sessions=2, timeout=1, hang_rate=0.3, seed=1).run(hosts, COMMANDS)
+
+    assert 0 < len(failed) < len(hosts)
+    for host in hosts:
+        if host not in failed:
+            assert lines(hm.get_output(host, 'show clock'))
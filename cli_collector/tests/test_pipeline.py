@@ -0,0 +1,62 @@
+"""
+Tests of pipelined commands: output of a batch is split on the echoed prompt.
+"""
+
+import time
+
+from conftest import channel_agent
+
+COMMANDS = ['show version', 'show ip route', 'show clock']
+
+
+def lines(output):
+    return [line for line in output.splitlines() if ' line ' in line]
+
+
+def test_pipelined_output_split_per_command(agent_factory):
+    agent = agent_factory(output_lines=5)
+    assert agent.host_connect('r1') in (100, 101)
+
+    outputs = agent.send_commands(COMMANDS, batch_size=len(COMMANDS))
+
+    assert [command for command, output in outputs] == COMMANDS
+    for command, output in outputs:
+        assert lines(output) == ['r1 line {} of {}'.format(n, command) for n in range(5)]
+
+
+def test_pipelined_output_same_as_one_by_one(agent_factory):
+    agent = agent_factory(output_lines=3)
+    assert agent.host_connect('r1') in (100, 101)
+
+    single = [(command, agent.send_command(command)) for command in COMMANDS]
+    pipelined = agent.send_commands(COMMANDS, batch_size=2)
+
+    assert [(c, lines(o)) for c, o in pipelined] == [(c, lines(o)) for c, o in single]
+
+
+def test_commands_not_executed_get_none(agent_factory):
+    agent = agent_factory(output_lines=1)
+    assert agent.host_connect('r1') in (100, 101)
+
+    outputs = agent.send_commands(['show version', 'reload', 'show clock'], batch_size=3)
+
+    assert outputs[1] == ('reload', None)
+    assert lines(outputs[2][1]) == ['r1 line 0 of show clock']
+
+
+def test_batch_takes_one_round_trip():
+    rtt = 0.2
+    commands = ['show {}'.format(n) for n in range(5)]
+    agent = channel_agent(rtt=rtt)
+
+    start = time.time()
+    single = [(command, agent.send_command(command)) for command in commands]
+    single_seconds = time.time() - start
+
+    start = time.time()
+    pipelined = agent.send_commands(commands, batch_size=len(commands))
+    pipelined_seconds = time.time() - start
+
+    assert [(c, lines(o)) for c, o in pipelined] == [(c, lines(o)) for c, o in single]
+    assert single_seconds >= len(commands) * rtt
+    assert pipelined_seconds < 2 * rtt
@@ -0,0 +1,80 @@
+"""
+Tests of preflight reachability checks: from this machine, and by the shell of a jumpserver.
+"""
+
+import argparse
+import socket
+import subprocess
+
+import cli_collector
+from lib import HostManager, utils
+
+
+def listening():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(5)
+    return sock, sock.getsockname()[1]
+
+
+def closed_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def test_sweep_splits_reachable_and_unreachable():
+    sock, up = listening()
+    down = closed_port()
+    hosts = [('127.0.0.1', up), ('127.0.0.1', down), ('localhost', up)]
+
+    reachable, unreachable = utils.reachability_sweep(hosts, timeout=2, concurrency=2)
+
+    assert reachable == [('127.0.0.1', up), ('localhost', up)]
+    assert unreachable == [('127.0.0.1', down)]
+    sock.close()
+
+
+def test_sweep_unresolvable_host_is_unreachable():
+    assert utils.reachability_sweep(['nonexistent.invalid'], port=22, timeout=2) == ([], ['nonexistent.invalid'])
+
+
+def test_remote_command_reports_every_host():
+    sock, up = listening()
+    down = closed_port()
+
+    command = utils.reachability_command([('127.0.0.1', up), ('127.0.0.1', down), ('r1; reboot', 22)], timeout=2)
+    output = subprocess.check_output(['sh', '-c', command])
+
+    # Unsafe host is left out of the command line, it is neither reachable nor unreachable.
+    assert 'reboot' not in command
+    assert utils.parse_reachability(output) == ([('127.0.0.1', up)], [('127.0.0.1', down)])
+    sock.close()
+
+
+def test_remote_shell_without_dev_tcp_is_unknown():
+    command = utils.reachability_command([('127.0.0.1', closed_port())], timeout=2, shell='/bin/sh')
+    output = subprocess.check_output(['sh', '-c', command])
+
+    assert 'PREFLIGHT UNKNOWN' in output
+    assert utils.parse_reachability(output) == ([], [])
+
+
+def test_preflight_reads_inventory_lazily():
+    sock, up = listening()
+    down = closed_port()
+    read = []
+
+    def inventory():
+        for name, port in [('r1', up), ('r2', down), ('r3', up)]:
+            read.append(name)
+            yield HostManager.Device(name, ipv4='127.0.0.1', port=port)
+
+    args = argparse.Namespace(connection='SSH', transport='PEXPECT', preflight_concurrency=10, preflight='')
+    hosts = cli_collector.preflight(inventory(), None, {}, [], args)
+    assert read == []
+
+    assert [d.name for d in hosts] == ['r1', 'r3']
+    sock.close()
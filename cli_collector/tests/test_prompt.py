@@ -0,0 +1,20 @@
+"""
+Tests of prompt detection: a host without prompt fails with a status, it does not raise.
+"""
+
+
+def test_no_prompt_after_retries_is_failure(agent_factory):
+    agent = agent_factory(timeout=1, hang_rate=1.0)
+    assert agent.host_connect('r1') in (100, 101)
+
+    # Device hangs after a command, it never returns a prompt.
+    agent.prompt.sendline('show version')
+
+    assert agent.prompt_detect('r1') == 200
+
+
+def test_eof_while_detecting_prompt_is_failure(agent_factory):
+    agent = agent_factory(timeout=1)
+    agent.prompt.sendline('exit')
+
+    assert agent.prompt_detect('simjump') == 200
@@ -0,0 +1,93 @@
+"""
+Tests of scheduling hosts over jump paths: fair turns per path and session limits of jumpservers.
+"""
+
+from lib import ConnectionManager, HostManager, WorkerManager
+
+
+class FakeAgent(object):
+    """
+    Jump chain that is always alive, nothing is connected.
+    """
+
+    def __init__(self, jumpservers=None):
+        self.jumpservers = jumpservers
+
+    def chain_alive(self, check=False):
+        return True
+
+    def close(self):
+        pass
+
+
+def path_pools(max_sessions=None, max_startups=None):
+    jumpservers = dict((j, HostManager.Device(j)) for j in ('shared', 'j1', 'j2'))
+    return ConnectionManager.PathPools(FakeAgent, jumpservers, size=4, max_sessions=max_sessions,
+                                       max_startups=max_startups)
+
+
+def test_limiter_counts_sessions_on_every_jumpserver_of_path():
+    limiter = ConnectionManager.SessionLimiter(max_sessions={'shared': 1})
+
+    with limiter.condition:
+        assert limiter.available(('shared', 'j1'))
+        limiter.acquire(('shared', 'j1'))
+
+        # Other path over the same jumpserver has no session left.
+        assert not limiter.available(('shared', 'j2'))
+        assert limiter.available(('j2',))
+        assert limiter.full(('shared', 'j2')) == ['shared']
+
+        limiter.release(('shared', 'j1'))
+        assert limiter.available(('shared', 'j2'))
+
+
+def test_limiter_counts_startups_until_started():
+    limiter = ConnectionManager.SessionLimiter(max_startups={'j1': 1})
+
+    with limiter.condition:
+        limiter.acquire(('j1',))
+        assert not limiter.available(('j1',))
+
+    limiter.started(('j1',))
+    with limiter.condition:
+        assert limiter.available(('j1',))
+
+
+def test_paths_take_turns_and_busy_path_waits():
+    pools = path_pools()
+    slow, other = pools.get(['j1']), pools.get(['j2'])
+    scheduler = WorkerManager.PathScheduler(pools.condition)
+    for n in range(4):
+        scheduler.put(slow, 'slow{}'.format(n))
+    for n in range(2):
+        scheduler.put(other, 'other{}'.format(n))
+    scheduler.close()
+
+    # Hosts of the slow path stay in progress, the other path is not starved behind its queue.
+    assert [scheduler.get()[1] for n in range(4)] == ['slow0', 'other0', 'slow1', 'other1']
+
+    assert scheduler.get()[1] == 'slow2'
+
+
+def test_sessions_of_shared_jumpserver_are_not_exceeded():
+    pools = path_pools(max_sessions={'shared': 2})
+    first, second = pools.get(['shared', 'j1']), pools.get(['shared', 'j2'])
+    scheduler = WorkerManager.PathScheduler(pools.condition)
+    for n in range(3):
+        scheduler.put(first, 'first{}'.format(n))
+        scheduler.put(second, 'second{}'.format(n))
+
+    taken = [scheduler.get() for n in range(2)]
+    assert sorted(host for pool, host, reservation in taken) == ['first0', 'second0']
+    with pools.condition:
+        assert not first.ready() and not second.ready()
+
+    # Chain of first path is built and closed, its session on the shared jumpserver is free again.
+    pool, host, reservation = taken[0]
+    pool.checkin(pool.claim(reservation), broken=True)
+    scheduler.done(pool)
+
+    assert scheduler.get()[1] in ('first1', 'second1')
+    with pools.condition:
+        assert pools.limiter.sessions['shared'] == 2
@@ -0,0 +1,76 @@
+"""
+Tests of storage backends: output stored is the output loaded, also across runs.
+"""
+
+import pytest
+
+from lib import HostManager
+
+OUTPUTS = [b'R1 uptime is 5 weeks\r\n' * 50, b'caf\xe9 \xff not UTF-8\r\n', b'']
+
+
+def backends(tmpdir):
+    return [HostManager.MemoryStorage(),
+            HostManager.DiskStorage(str(tmpdir.join('disk'))),
+            HostManager.ContentStorage(str(tmpdir.join('content'))),
+            HostManager.ContentStorage(str(tmpdir.join('delta')), delta=True)]
+
+
+@pytest.mark.parametrize('index', range(4))
+def test_round_trip(tmpdir, index):
+    storage = backends(tmpdir)[index]
+
+    entries = [storage.store('r1', 'show {}'.format(n), output) for n, output in enumerate(OUTPUTS)]
+
+    assert [storage.load(entry) for entry in entries] == OUTPUTS
+    storage.close()
+
+
+@pytest.mark.parametrize('index', range(4))
+def test_no_output(tmpdir, index):
+    storage = backends(tmpdir)[index]
+
+    assert storage.load(storage.store('r1', 'show version', None)) is None
+    storage.close()
+
+
+def test_content_storage_deduplicates(tmpdir):
+    storage = HostManager.ContentStorage(str(tmpdir))
+
+    first = storage.store('r1', 'show version', OUTPUTS[0])
+    second = storage.store('r2', 'show version', OUTPUTS[0])
+
+    assert first['HASH'] == second['HASH']
+    storage.close()
+
+
+@pytest.mark.parametrize('delta', [False, True])
+def test_content_storage_across_runs(tmpdir, delta):
+    previous = ''.join('interface Gi0/{}\r\n description uplink\r\n'.format(n) for n in range(100)).encode('ascii')
+    current = previous.replace(b'Gi0/42\r\n description uplink', b'Gi0/42\r\n description changed')
+
+    storage = HostManager.ContentStorage(str(tmpdir), delta=delta)
+    first = storage.store('r1', 'show run', previous)
+    storage.close()
+
+    # Next run compares against index of previous run.
+    storage = HostManager.ContentStorage(str(tmpdir), delta=delta)
+    entry = storage.store('r1', 'show run', current)
+
+    assert entry['PREVIOUS'] == first['HASH']
+    assert HostManager.ContentStorage.changed(entry)
+    assert storage.load(entry) == current
+    assert storage.load(first) == previous
+    storage.close()
+
+
+@pytest.mark.parametrize('index', range(4))
+def test_parsed_round_trip(tmpdir, index):
+    hm = HostManager.HostManagment(storage=backends(tmpdir)[index])
+    parsed = [{'hostname': 'R1', 'uptime': '5 weeks'}]
+
+    hm.add_command('r1', 'show version', OUTPUTS[0])
+    hm.add_parsed('r1', 'show version', parsed)
+
+    assert hm.get_parsed('r1', 'show version') == parsed
+    assert hm.export_host('r1')['show version']['PARSED'] == parsed
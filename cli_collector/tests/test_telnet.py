@@ -0,0 +1,92 @@
+"""
+Tests of Telnet IAC stripping and option negotiation of TelnetChannel.
+"""
+
+import socket
+
+from lib import TransportManager
+from lib.TransportManager import IAC, DO, DONT, WILL, WONT, SB, SE, ECHO, SGA
+
+TTYPE = 24
+
+
+def channel():
+    local, remote = socket.socketpair()
+    remote.settimeout(1)
+    return TransportManager.TelnetChannel(local), remote
+
+
+def command(*codes):
+    return bytes(bytearray(codes))
+
+
+def test_commands_stripped_from_data():
+    telnet, remote = channel()
+
+    remote.sendall(b'Username' + command(IAC, WILL, ECHO) + b': ')
+    assert telnet.recv(1024) == b'Username: '
+    assert remote.recv(1024) == command(IAC, DO, ECHO)
+
+
+def test_escaped_iac_is_data():
+    telnet, remote = channel()
+
+    remote.sendall(b'a' + command(IAC, IAC) + b'b')
+    assert telnet.recv(1024) == b'a\xffb'
+
+
+def test_only_commands_returns_none():
+    telnet, remote = channel()
+
+    remote.sendall(command(IAC, DO, SGA))
+    assert telnet.recv(1024) is None
+    assert remote.recv(1024) == command(IAC, WILL, SGA)
+
+
+def test_unsupported_options_refused():
+    telnet, remote = channel()
+
+    remote.sendall(command(IAC, DO, TTYPE, IAC, WILL, TTYPE))
+    assert telnet.recv(1024) is None
+    assert remote.recv(1024) == command(IAC, WONT, TTYPE, IAC, DONT, TTYPE)
+
+
+def test_subnegotiation_skipped():
+    telnet, remote = channel()
+
+    remote.sendall(b'R1' + command(IAC, SB, TTYPE, 1, IAC, SE) + b'#')
+    assert telnet.recv(1024) == b'R1#'
+
+
+def test_sequence_split_over_reads():
+    telnet, remote = channel()
+
+    remote.sendall(b'R1' + command(IAC))
+    assert telnet.recv(1024) == b'R1'
+    remote.sendall(command(WILL, ECHO) + b'#')
+    assert telnet.recv(1024) == b'#'
+    assert remote.recv(1024) == command(IAC, DO, ECHO)
+
+
+def test_negotiation_answered_once():
+    telnet, remote = channel()
+
+    remote.sendall(command(IAC, WILL, ECHO))
+    telnet.recv(1024)
+    remote.sendall(command(IAC, WILL, ECHO) + b'x')
+    assert telnet.recv(1024) == b'x'
+
+    remote.settimeout(0.1)
+    assert remote.recv(1024) == command(IAC, DO, ECHO)
+    try:
+        extra = remote.recv(1024)
+    except socket.timeout:
+        extra = b''
+    assert extra == b''
+
+
+def test_sendall_escapes_iac_and_newline():
+    telnet, remote = channel()
+
+    telnet.sendall(b'show \xff\n')
+    assert remote.recv(1024) == b'show \xff\xff\r\n'
@@ -0,0 +1,63 @@
+"""
+Tests of adaptive timeouts: p99 of latency history times margin, within floor and ceiling.
+"""
+
+from lib import TimeoutManager
+
+
+def test_default_until_enough_samples():
+    timeouts = TimeoutManager.AdaptiveTimeouts(min_samples=3)
+    timeouts.observe('r1', 'show version', 1.0)
+    timeouts.observe('r1', 'show version', 1.0)
+
+    assert timeouts.timeout('r1', 'show version', 10) == 10
+
+    timeouts.observe('r1', 'show version', 1.0)
+    assert timeouts.timeout('r1', 'show version', 10) == 3.0
+
+
+def test_p99_times_margin():
+    timeouts = TimeoutManager.AdaptiveTimeouts(margin=2.0, floor=0.1)
+    for seconds in (1.0, 1.5, 4.0):
+        timeouts.observe('r1', 'LOGIN', seconds)
+
+    assert timeouts.timeout('r1', 'LOGIN', 10) == 8.0
+
+
+def test_floor_and_ceiling():
+    timeouts = TimeoutManager.AdaptiveTimeouts(margin=3.0, floor=2.0, ceiling=30.0)
+    for n in range(3):
+        timeouts.observe('fast', 'TERM_LEN', 0.01)
+        timeouts.observe('slow', 'show tech', 20.0)
+
+    assert timeouts.timeout('fast', 'TERM_LEN', 10) == 2.0
+    assert timeouts.timeout('slow', 'show tech', 10) == 30.0
+
+
+def test_host_without_history_uses_all_hosts():
+    timeouts = TimeoutManager.AdaptiveTimeouts(margin=2.0, floor=0.1)
+    for host in ('r1', 'r2', 'r3'):
+        timeouts.observe(host, 'show clock', 0.5)
+
+    assert timeouts.timeout('r4', 'show clock', 10) == 1.0
+    assert timeouts.timeout('r4', 'show version', 10) == 10
+
+
+def test_history_window_forgets_old_latencies():
+    timeouts = TimeoutManager.AdaptiveTimeouts(margin=1.0, floor=0.1, window=4)
+    timeouts.observe('r1', 'LOGIN', 9.0)
+    for n in range(4):
+        timeouts.observe('r1', 'LOGIN', 1.0)
+
+    assert timeouts.history['r1']['LOGIN'] == [1.0] * 4
+    assert timeouts.timeout('r1', 'LOGIN', 10) == 1.0
+
+
+def test_history_saved_and_loaded(tmpdir):
+    filename = str(tmpdir.join('history.json'))
+    timeouts = TimeoutManager.AdaptiveTimeouts(filename, margin=2.0, floor=0.1)
+    for n in range(3):
+        timeouts.observe('r1', 'LOGIN', 0.5)
+    timeouts.save()
+
+    assert TimeoutManager.AdaptiveTimeouts(filename, margin=2.0, floor=0.1).timeout('r1', 'LOGIN', 10) == 1.0
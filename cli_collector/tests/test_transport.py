@@ -0,0 +1,21 @@
+"""
+Tests of the pexpect transport: lines are sent without pexpect's delay before every send.
+"""
+
+import time
+
+from lib import TransportManager
+
+
+def test_pexpect_spawn_sends_without_delay():
+    transport = TransportManager.PexpectTransport(timeout=5)
+    spawn = transport.open('localhost', 'cat')
+
+    start = time.time()
+    for n in range(10):
+        spawn.sendline('line {}'.format(n))
+    spawn.expect_exact('line 9')
+
+    # pexpect sleeps 50ms before every send by default, 0.5s for 10 lines.
+    assert time.time() - start < 0.25
+    transport.close()